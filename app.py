@@ -5,8 +5,13 @@ A professional multi-user Streamlit application for jewellery shops
 import streamlit as st
 import pandas as pd
 from database import Database
-from utils import format_currency, generate_invoice_number, generate_account_number, validate_phone, calculate_item_totals
+from connection_pool import close_pool
+from rollups import forget_tenant, get_tenant_totals, rebuild_all
+from metal_rates import get_metal_settings, set_shop_rates, set_tenant_overrides, tenant_overrides_from, forget_tenant_rates
+from rate_history import rate_at, record_rate, get_rate_history
+from utils import format_currency, generate_invoice_number, generate_account_number, validate_phone, calculate_item_totals, calculate_item_totals_batch, numeric_array, calculate_invoice_totals, from_paise
 from pdf_generator import create_invoice_pdf, get_pdf_download_link, create_thermal_invoice_pdf
+from pdf_cache import get_invoice_pdf, get_thermal_invoice_pdf, forget_tenant_pdfs
 from auth import show_login_page, show_user_menu, require_auth, require_admin
 import os
 import hashlib
@@ -14,6 +19,9 @@ import platform
 import streamlit.components.v1 as components
 from datetime import datetime, timedelta
 
+# Type-ahead customer pickers show at most this many matches
+CUSTOMER_SEARCH_LIMIT = 50
+
 
 # Page configuration
 st.set_page_config(
@@ -278,22 +286,25 @@ def init_session_state():
 def load_user_settings(db):
     """Load user settings from database after login"""
     if st.session_state.get('logged_in') and st.session_state.get('settings_loaded') != True:
+        # One cached snapshot of every saved setting
+        saved = db.get_settings()
+        
         # Load metal settings
-        saved_metal_settings = db.get_setting('metal_settings')
+        saved_metal_settings = saved.get('metal_settings')
         if saved_metal_settings:
             st.session_state.metal_settings = saved_metal_settings
         
         # Load tax settings
-        saved_cgst = db.get_setting('cgst')
+        saved_cgst = saved.get('cgst')
         if saved_cgst is not None:
             st.session_state.cgst = saved_cgst
         
-        saved_sgst = db.get_setting('sgst')
+        saved_sgst = saved.get('sgst')
         if saved_sgst is not None:
             st.session_state.sgst = saved_sgst
         
         # Load custom fields
-        saved_custom_fields = db.get_setting('custom_fields')
+        saved_custom_fields = saved.get('custom_fields')
         if saved_custom_fields:
             st.session_state.custom_fields = saved_custom_fields
         
@@ -337,6 +348,12 @@ db = Database(st.session_state.db_path)
 # Load user settings from database
 load_user_settings(db)
 
+# Once the admin has set shop-wide rates they (with this user's overrides) replace the saved blob.
+# The shared cache makes this a version check on most runs, so rate changes show up right away.
+shop_metal_settings = get_metal_settings(db.db_path)
+if shop_metal_settings:
+    st.session_state.metal_settings = shop_metal_settings
+
 # Header
 st.markdown('<div class="main-header"><h1>💎 JewelCalc</h1></div>', unsafe_allow_html=True)
 
@@ -362,6 +379,10 @@ with tab_settings:
     st.markdown("### ⚙️ Base Settings")
     
     st.markdown("#### Metal Settings")
+    if require_admin():
+        st.caption("Rates saved here apply to every user; users can override them for their own invoices.")
+    else:
+        st.caption("Rates come from the shop-wide table; values you change here are kept as your own overrides.")
     
     # Edit metal settings
     metals_data = []
@@ -459,11 +480,15 @@ with tab_settings:
             st.session_state.custom_fields = new_custom_fields
         
         # Persist settings to database
-        db.save_setting('metal_settings', new_settings)
-        db.save_setting('cgst', cgst)
-        db.save_setting('sgst', sgst)
+        settings_to_save = {'metal_settings': new_settings, 'cgst': cgst, 'sgst': sgst}
+        if require_admin():
+            settings_to_save['custom_fields'] = new_custom_fields
+        db.save_settings(settings_to_save)
         if require_admin():
-            db.save_setting('custom_fields', new_custom_fields)
+            set_shop_rates(new_settings)
+            set_tenant_overrides(db.db_path, {})
+        else:
+            set_tenant_overrides(db.db_path, tenant_overrides_from(db.db_path, new_settings))
         
         st.success("✅ Settings saved successfully!")
     
@@ -488,10 +513,10 @@ with tab_settings:
             st.session_state.custom_fields = []
             
             # Save to database
-            db.save_setting('metal_settings', default_settings)
-            db.save_setting('cgst', 1.5)
-            db.save_setting('sgst', 1.5)
-            db.save_setting('custom_fields', [])
+            db.save_settings({'metal_settings': default_settings, 'cgst': 1.5, 'sgst': 1.5, 'custom_fields': []})
+            if require_admin():
+                set_shop_rates(default_settings)
+            set_tenant_overrides(db.db_path, {})
             
             st.session_state.confirm_reset_settings = False
             st.success("✅ Settings reset to defaults!")
@@ -517,6 +542,8 @@ with tab_customers:
             customers_df = db.get_all_customers_admin()
             if not customers_df.empty:
                 st.info(f"🔐 **Admin View**: Showing {len(customers_df)} customers from all databases")
+            for failure in customers_df.attrs.get('failures', []):
+                st.warning(f"⚠️ Skipped {failure['database']} ({failure['db_path']}): {failure['error']}")
         else:
             st.warning("⚠️ Admin cross-database view is temporarily unavailable. Showing only admin database customers.")
             customers_df = db.get_customers()
@@ -568,18 +595,15 @@ with tab_customers:
             search_query = st.text_input("🔍 Search Customer (type name or phone)", "", 
                                          help="Start typing to filter customers")
             
-            # Filter customers based on search query
-            if search_query:
-                mask = (customers_df['name'].str.contains(search_query, case=False, na=False) | 
-                       customers_df['phone'].str.contains(search_query, case=False, na=False))
-                filtered_customers = customers_df[mask]
-            else:
-                filtered_customers = customers_df
+            # Top matches from the customer search index
+            filtered_customers = db.search_customers(search_query, limit=CUSTOMER_SEARCH_LIMIT)
             
             if not filtered_customers.empty:
                 # Create options from filtered customers
-                customer_options = {f"{row['name']} ({row['phone']})": row['id'] 
-                                  for _, row in filtered_customers.iterrows()}
+                customer_options = dict(zip(
+                    (filtered_customers['name'] + " (" + filtered_customers['phone'] + ")").tolist(),
+                    filtered_customers['id'].tolist()
+                ))
                 
                 selected = st.selectbox("Select Customer", options=list(customer_options.keys()), 
                                        key="edit_customer_select")
@@ -632,18 +656,15 @@ with tab_customers:
                                          key="delete_search",
                                          help="Start typing to filter customers")
             
-            # Filter customers based on search query
-            if search_query:
-                mask = (customers_df['name'].str.contains(search_query, case=False, na=False) | 
-                       customers_df['phone'].str.contains(search_query, case=False, na=False))
-                filtered_customers = customers_df[mask]
-            else:
-                filtered_customers = customers_df
+            # Top matches from the customer search index
+            filtered_customers = db.search_customers(search_query, limit=CUSTOMER_SEARCH_LIMIT)
             
             if not filtered_customers.empty:
                 # Create options from filtered customers
-                customer_options = {f"{row['name']} ({row['phone']})": row['id'] 
-                                  for _, row in filtered_customers.iterrows()}
+                customer_options = dict(zip(
+                    (filtered_customers['name'] + " (" + filtered_customers['phone'] + ")").tolist(),
+                    filtered_customers['id'].tolist()
+                ))
                 
                 selected = st.selectbox("Select Customer to Delete", options=list(customer_options.keys()),
                                        key="delete_customer_select")
@@ -664,10 +685,13 @@ with tab_customers:
     st.markdown("#### All Customers")
     if not customers_df.empty:
         search = st.text_input("🔍 Search customers", "")
-        if search:
-            mask = (customers_df['name'].str.contains(search, case=False) | 
-                   customers_df['phone'].str.contains(search, case=False))
+        if search and 'database' in customers_df.columns:
+            # The admin list spans every database, so it is filtered in memory
+            mask = (customers_df['name'].str.contains(search, case=False, regex=False) | 
+                   customers_df['phone'].str.contains(search, case=False, regex=False))
             customers_df = customers_df[mask]
+        elif search:
+            customers_df = db.search_customers(search, limit=None)
         
         # For admin, show database source column
         if require_admin() and 'database' in customers_df.columns:
@@ -686,9 +710,7 @@ with tab_customers:
 with tab_invoice:
     st.markdown("### 📝 Create Invoice")
     
-    customers_df = db.get_customers()
-    
-    if customers_df.empty:
+    if db.search_customers("", limit=1).empty:
         st.warning("⚠️ No customers found. Please add a customer first in the Customers tab.")
     else:
         # Customer selection with type-ahead search
@@ -699,17 +721,14 @@ with tab_invoice:
                                      key="create_invoice_search",
                                      help="Start typing to filter customers")
         
-        # Filter customers based on search query
-        if search_query:
-            mask = (customers_df['name'].str.contains(search_query, case=False, na=False) | 
-                   customers_df['phone'].str.contains(search_query, case=False, na=False))
-            filtered_customers = customers_df[mask]
-        else:
-            filtered_customers = customers_df
+        # Top matches from the customer search index
+        filtered_customers = db.search_customers(search_query, limit=CUSTOMER_SEARCH_LIMIT)
         
         if not filtered_customers.empty:
-            customer_options = {f"{row['name']} ({row['phone']})": row['id'] 
-                              for _, row in filtered_customers.iterrows()}
+            customer_options = dict(zip(
+                (filtered_customers['name'] + " (" + filtered_customers['phone'] + ")").tolist(),
+                filtered_customers['id'].tolist()
+            ))
             
             selected_customer = st.selectbox(
                 "Select Customer *",
@@ -816,18 +835,19 @@ with tab_invoice:
                 # Invoice summary
                 st.markdown("#### Invoice Summary")
                 
-                subtotal = sum(item['line_total'] for item in st.session_state.current_invoice_items)
-                
                 col1, col2 = st.columns(2)
                 with col1:
                     discount_pct = st.number_input("Discount %", min_value=0.0, value=st.session_state.discount, format="%.2f")
                     st.session_state.discount = discount_pct
                 
-                discount_amt = subtotal * (discount_pct / 100)
-                taxable_amount = subtotal - discount_amt
-                cgst_amt = taxable_amount * (st.session_state.cgst / 100)
-                sgst_amt = taxable_amount * (st.session_state.sgst / 100)
-                total = taxable_amount + cgst_amt + sgst_amt
+                totals = calculate_invoice_totals(
+                    [item['line_total'] for item in st.session_state.current_invoice_items],
+                    discount_pct, st.session_state.cgst, st.session_state.sgst
+                )
+                subtotal, discount_amt, taxable_amount, cgst_amt, sgst_amt, total = (
+                    from_paise(totals[key]) for key in
+                    ('subtotal', 'discount_amount', 'taxable_amount', 'cgst_amount', 'sgst_amount', 'total')
+                )
                 
                 # Display summary
                 st.markdown("---")
@@ -867,53 +887,118 @@ with tab_invoice:
 with tab_view:
     st.markdown("### 📋 View Invoices")
     
+    # Check if we're editing an invoice
+    editing_invoice_id = st.session_state.get('editing_invoice_id')
+    
+    # Search, date range and page size
+    col1, col2, col3, col4 = st.columns([3, 1, 1, 1])
+    with col1:
+        search = st.text_input("🔍 Search invoices", "",
+                               help="Invoice number, customer name, phone or account number")
+    with col2:
+        search_from = st.date_input("From", value=None, key="invoice_search_from")
+    with col3:
+        search_to = st.date_input("To", value=None, key="invoice_search_to")
+    with col4:
+        page_size = st.selectbox("Invoices per page", [10, 25, 50, 100], index=1, key="invoice_page_size")
+    search_start = search_from.strftime("%Y-%m-%d") if search_from else None
+    search_end = (search_to + timedelta(days=1)).strftime("%Y-%m-%d") if search_to else None
+    
+    # Go back to the first page whenever the search, dates or page size change.
+    # invoice_page_cursors holds the (date, id) of the last row of each previous page.
+    if st.session_state.get('invoice_page_state') != (search, search_start, search_end, page_size):
+        st.session_state.invoice_page_state = (search, search_start, search_end, page_size)
+        st.session_state.invoice_page_cursors = []
+    page_cursors = st.session_state.invoice_page_cursors
+    
     # Admin sees all invoices from all databases
+    admin_view = False
     if require_admin():
         # Check if method exists to handle potential deployment issues
-        if hasattr(db, 'get_all_invoices_admin'):
-            invoices_df = db.get_all_invoices_admin()
-            if not invoices_df.empty:
-                st.info(f"🔐 **Admin View**: Showing {len(invoices_df)} invoices from all databases")
+        if hasattr(db, 'get_recent_invoices_admin'):
+            admin_view = True
+            # Heap-merge the newest rows of every database; only one page is ever loaded
+            before = page_cursors[-1] if page_cursors else None
+            page_df = db.get_recent_invoices_admin(page_size + 1, before=before, search=search or None,
+                                                   start_date=search_start, end_date=search_end)
+            for failure in page_df.attrs.get('failures', []):
+                st.warning(f"⚠️ Skipped {failure['database']} ({failure['db_path']}): {failure['error']}")
+            if not page_df.empty:
+                st.info("🔐 **Admin View**: Showing invoices from all databases")
         else:
             st.warning("⚠️ Admin cross-database view is temporarily unavailable. Showing only admin database invoices.")
-            invoices_df = db.get_invoices()
-    else:
-        invoices_df = db.get_invoices()
     
-    if invoices_df.empty:
-        st.info("No invoices yet. Create your first invoice in the Create Invoice tab!")
+    if not admin_view:
+        # Keyset pagination: fetch one extra row to know whether a next page exists
+        before = page_cursors[-1] if page_cursors else None
+        page_df = db.get_invoices(limit=page_size + 1, before=before, search=search or None,
+                                  start_date=search_start, end_date=search_end)
+    
+    has_next_page = len(page_df) > page_size
+    page_df = page_df.iloc[:page_size]
+    
+    if page_df.empty and not page_cursors:
+        if search or search_start or search_end:
+            st.info("No invoices match your search")
+        else:
+            st.info("No invoices yet. Create your first invoice in the Create Invoice tab!")
     else:
-        # Check if we're editing an invoice
-        editing_invoice_id = st.session_state.get('editing_invoice_id')
+        # Compact invoice list for the current page
+        list_columns = ['invoice_no', 'date', 'customer_name', 'customer_phone', 'total']
+        if admin_view and 'database' in page_df.columns:
+            list_columns.append('database')
+        list_df = page_df[list_columns].copy()
+        list_df['total'] = list_df['total'].apply(format_currency)
+        st.dataframe(list_df, width='stretch', hide_index=True)
         
-        # Search
-        search = st.text_input("🔍 Search invoices", "")
-        if search:
-            mask = (invoices_df['invoice_no'].str.contains(search, case=False) | 
-                   invoices_df['customer_name'].str.contains(search, case=False, na=False) |
-                   invoices_df['customer_phone'].str.contains(search, case=False, na=False))
-            invoices_df = invoices_df[mask]
+        # Pager
+        col1, col2, col3 = st.columns([1, 2, 1])
+        with col1:
+            if page_cursors and st.button("⬅️ Previous", key="invoice_page_prev", use_container_width=True):
+                page_cursors.pop()
+                st.rerun()
+        with col2:
+            st.markdown(f"<div style='text-align:center'>Page {len(page_cursors) + 1}</div>", unsafe_allow_html=True)
+        with col3:
+            if has_next_page and st.button("Next ➡️", key="invoice_page_next", use_container_width=True):
+                last_row = page_df.iloc[-1]
+                if admin_view:
+                    page_cursors.append((int(last_row['sort_ts']), last_row['db_path'], int(last_row['id'])))
+                else:
+                    page_cursors.append((int(last_row['sort_ts']), int(last_row['id'])))
+                st.rerun()
+        
+        # Master-detail: only the selected invoice's details and PDFs are loaded
+        invoice_options = {}
+        for position, (_, row) in enumerate(page_df.iterrows()):
+            label = f"📄 {row['invoice_no']} | {row['customer_name']} | {format_currency(row['total'])} | {row['date']}"
+            # For admin viewing all databases, show database source in the label
+            if admin_view and 'database' in row and pd.notna(row.get('database')):
+                label += f" | 🗄️ {row['database']}"
+            invoice_options[label] = position
+        
+        selected_invoice = st.selectbox("Select invoice to view", options=[""] + list(invoice_options.keys()),
+                                        key="view_invoice_select")
         
-        # Display invoices
-        for _, row in invoices_df.iterrows():
+        if selected_invoice:
+            row = page_df.iloc[invoice_options[selected_invoice]]
+            
             # Create a unique key suffix for widgets in this invoice
             # Use row id and database path to ensure uniqueness across all databases
             db_path_key = str(row.get('db_path', 'default')).replace('.', '_').replace('/', '_')
             unique_key_suffix = f"{row['id']}_{db_path_key}"
             
-            # For admin viewing all databases, show database source in title
-            if require_admin() and 'database' in row and pd.notna(row.get('database')):
-                invoice_title = f"📄 {row['invoice_no']} | {row['customer_name']} | {format_currency(row['total'])} | {row['date']} | 🗄️ {row['database']}"
+            # For admin viewing cross-database, read from the invoice's source database
+            if admin_view and 'db_path' in row and pd.notna(row.get('db_path')):
+                source_db = Database(row['db_path'])
             else:
-                invoice_title = f"📄 {row['invoice_no']} | {row['customer_name']} | {format_currency(row['total'])} | {row['date']}"
+                source_db = db
+            invoice, items_df, customer = source_db.get_invoice_by_id(row['id'])
             
-            with st.expander(invoice_title):
-                # For admin viewing cross-database, use the appropriate database connection
-                if require_admin() and 'db_path' in row and pd.notna(row.get('db_path')):
-                    temp_db = Database(row['db_path'])
-                    invoice, items_df, customer = temp_db.get_invoice_by_number(row['invoice_no'])
-                else:
-                    invoice, items_df, customer = db.get_invoice_by_number(row['invoice_no'])
+            if invoice is None:
+                st.warning("⚠️ Invoice details not found")
+            else:
+                st.markdown("---")
                 
                 # Customer info
                 col1, col2 = st.columns(2)
@@ -959,12 +1044,11 @@ with tab_view:
                 # Action buttons
                 col1, col2, col3, col4, col5 = st.columns(5)
                 
-                # PDF download (direct download)
+                # PDF download - rendered only when clicked, served from the PDF cache
                 with col1:
-                    pdf_buffer = create_invoice_pdf(invoice, items_df, customer)
                     st.download_button(
                         label="📄 Download PDF",
-                        data=pdf_buffer,
+                        data=lambda: get_invoice_pdf(invoice, items_df, customer, source_db.db_path),
                         file_name=f"{row['invoice_no']}.pdf",
                         mime="application/pdf",
                         key=f"dl_{unique_key_suffix}",
@@ -976,11 +1060,9 @@ with tab_view:
                 
                 # Thermal print
                 with col2:
-                    from pdf_generator import create_thermal_invoice_pdf
-                    thermal_buffer = create_thermal_invoice_pdf(invoice, items_df, customer)
                     st.download_button(
                         label="🧾 Thermal Print",
-                        data=thermal_buffer,
+                        data=lambda: get_thermal_invoice_pdf(invoice, items_df, customer, source_db.db_path),
                         file_name=f"{row['invoice_no']}_thermal.pdf",
                         mime="application/pdf",
                         key=f"thermal_{unique_key_suffix}"
@@ -1029,229 +1111,188 @@ with tab_view:
             st.markdown("---")
             st.markdown("## ✏️ Edit Invoice")
             
-            # Find the invoice being edited
-            for _, row in invoices_df.iterrows():
-                invoice, items_df, customer = db.get_invoice_by_number(row['invoice_no'])
+            # Look up the invoice being edited directly by ID
+            invoice, items_df, customer = db.get_invoice_by_id(editing_invoice_id)
+            
+            if invoice and invoice['invoice_no'] == st.session_state.get('editing_invoice_no'):
+                st.info(f"📝 Editing Invoice: **{invoice['invoice_no']}** | Customer: **{customer['name']}**")
                 
-                if invoice and invoice['id'] == editing_invoice_id:
-                    st.info(f"📝 Editing Invoice: **{row['invoice_no']}** | Customer: **{customer['name']}**")
-                    
-                    # Load items into editable list - use session state to persist changes
-                    if 'temp_edit_items' not in st.session_state or st.session_state.get('temp_edit_items_invoice_id') != invoice['id']:
-                        edit_items = []
-                        for _, item in items_df.iterrows():
-                            edit_items.append({
-                                'metal': item['metal'],
-                                'weight': float(item['weight']),
-                                'rate': float(item['rate']),
-                                'wastage_percent': float(item['wastage_percent']),
-                                'making_percent': float(item['making_percent']),
-                                'item_value': float(item['item_value']),
-                                'wastage_amount': float(item['wastage_amount']),
-                                'making_amount': float(item['making_amount']),
-                                'line_total': float(item['line_total'])
-                            })
-                        st.session_state.temp_edit_items = edit_items
-                        st.session_state.temp_edit_items_invoice_id = invoice['id']
-                    else:
-                        edit_items = st.session_state.temp_edit_items
-                    
-                    # Convert to DataFrame for inline editing
-                    df_edit = pd.DataFrame(edit_items)
-                    if df_edit.empty:
-                        df_edit = pd.DataFrame(columns=[
-                            'metal', 'weight', 'rate', 'wastage_percent', 'making_percent',
-                            'item_value', 'wastage_amount', 'making_amount', 'line_total'
-                        ])
-                    
-                    # Ensure columns exist and in desired order
-                    cols_order = ['metal', 'weight', 'rate', 'wastage_percent', 'making_percent',
-                                  'item_value', 'wastage_amount', 'making_amount', 'line_total']
-                    for c in cols_order:
-                        if c not in df_edit.columns:
-                            df_edit[c] = 0.0 if c not in ('metal',) else ''
-                    df_edit = df_edit[cols_order]
-                    
-                    st.markdown("**Edit Items Inline:**")
-                    
-                    # Use data_editor to let user edit rows inline.
-                    # Editable columns: metal, weight, rate, wastage_percent, making_percent.
-                    # Computed columns are displayed as read-only and will be recalculated live.
-                    try:
-                        edited_df = st.data_editor(
-                            df_edit,
-                            column_config={
-                                'metal': st.column_config.SelectboxColumn('Metal', options=list(st.session_state.metal_settings.keys())),
-                                'weight': st.column_config.NumberColumn('Weight (g)', format="%.3f"),
-                                'rate': st.column_config.NumberColumn('Rate/g', format="%.2f"),
-                                'wastage_percent': st.column_config.NumberColumn('Wastage %', format="%.2f"),
-                                'making_percent': st.column_config.NumberColumn('Making %', format="%.2f"),
-                                'item_value': st.column_config.NumberColumn('Item Value', format="%.2f", disabled=True),
-                                'wastage_amount': st.column_config.NumberColumn('Wastage Amt', format="%.2f", disabled=True),
-                                'making_amount': st.column_config.NumberColumn('Making Amt', format="%.2f", disabled=True),
-                                'line_total': st.column_config.NumberColumn('Total', format="%.2f", disabled=True),
-                            },
-                            hide_index=True,
-                            use_container_width=True,
-                            key=f"items_editor_{invoice['id']}"
-                        )
-                    except Exception:
-                        # Fallback if column_config API isn't available in older Streamlit versions
-                        edited_df = st.data_editor(
-                            df_edit,
-                            hide_index=True,
-                            use_container_width=True,
-                            key=f"items_editor_{invoice['id']}"
-                        )
-                    
-                    # Recalculate totals for rows based on edited numeric inputs
-                    recalculated_rows = []
-                    for _, row_edit in edited_df.iterrows():
-                        try:
-                            metal = str(row_edit.get('metal', '')).strip() or list(st.session_state.metal_settings.keys())[0]
-                            # Some values may be NaN or empty strings; coerce safely to floats
-                            try:
-                                weight = float(row_edit.get('weight') or 0.0)
-                            except Exception:
-                                weight = 0.0
-                            try:
-                                rate = float(row_edit.get('rate') or 0.0)
-                            except Exception:
-                                rate = 0.0
-                            try:
-                                wastage_pct = float(row_edit.get('wastage_percent') or 0.0)
-                            except Exception:
-                                wastage_pct = 0.0
-                            try:
-                                making_pct = float(row_edit.get('making_percent') or 0.0)
-                            except Exception:
-                                making_pct = 0.0
-                            
-                            if weight > 0 and rate > 0:
-                                totals = calculate_item_totals(weight, rate, wastage_pct, making_pct)
-                                item_value = totals['item_value']
-                                wastage_amount = totals['wastage_amount']
-                                making_amount = totals['making_amount']
-                                line_total = totals['line_total']
-                            else:
-                                item_value = 0.0
-                                wastage_amount = 0.0
-                                making_amount = 0.0
-                                line_total = 0.0
-                        except Exception:
-                            item_value = 0.0
-                            wastage_amount = 0.0
-                            making_amount = 0.0
-                            line_total = 0.0
-                        
-                        recalculated_rows.append({
-                            'metal': metal,
-                            'weight': weight,
-                            'rate': rate,
-                            'wastage_percent': wastage_pct,
-                            'making_percent': making_pct,
-                            'item_value': item_value,
-                            'wastage_amount': wastage_amount,
-                            'making_amount': making_amount,
-                            'line_total': line_total
+                # Load items into editable list - use session state to persist changes
+                if 'temp_edit_items' not in st.session_state or st.session_state.get('temp_edit_items_invoice_id') != invoice['id']:
+                    edit_items = []
+                    for _, item in items_df.iterrows():
+                        edit_items.append({
+                            'metal': item['metal'],
+                            'weight': float(item['weight']),
+                            'rate': float(item['rate']),
+                            'wastage_percent': float(item['wastage_percent']),
+                            'making_percent': float(item['making_percent']),
+                            'item_value': float(item['item_value']),
+                            'wastage_amount': float(item['wastage_amount']),
+                            'making_amount': float(item['making_amount']),
+                            'line_total': float(item['line_total'])
                         })
-                    
-                    # Persist recalculated rows back to session state
-                    st.session_state.temp_edit_items = recalculated_rows
-                    
-                    # Add / select and delete item buttons (affect session_state.temp_edit_items)
-                    col_a, col_b, col_c = st.columns([2, 2, 1])
-                    with col_a:
-                        if st.button("➕ Add Empty Item", key=f"add_empty_{invoice['id']}"):
-                            st.session_state.temp_edit_items.append({
-                                'metal': list(st.session_state.metal_settings.keys())[0],
-                                'weight': 0.0,
-                                'rate': 0.0,
-                                'wastage_percent': 0.0,
-                                'making_percent': 0.0,
-                                'item_value': 0.0,
-                                'wastage_amount': 0.0,
-                                'making_amount': 0.0,
-                                'line_total': 0.0
-                            })
-                            st.rerun()
-                    with col_b:
-                        if len(st.session_state.temp_edit_items) > 0:
-                            item_options = {f"Item {i+1}: {item['metal']} {item['weight']:.3f}g": i 
-                                          for i, item in enumerate(st.session_state.temp_edit_items)}
-                            selected_item = st.selectbox("Select to delete", options=list(item_options.keys()), 
-                                                        key=f"delete_edit_item_{invoice['id']}")
-                    with col_c:
-                        if len(st.session_state.temp_edit_items) > 0:
-                            st.markdown("<br>", unsafe_allow_html=True)  # Add spacing
-                            if st.button("🗑️ Delete", key=f"remove_selected_{invoice['id']}", type="secondary"):
-                                item_index = item_options[selected_item]
-                                st.session_state.temp_edit_items.pop(item_index)
-                                st.rerun()
-                    
-                    # Edit discount (live)
-                    edit_discount = st.number_input(
-                        "Discount %", 
-                        min_value=0.0, 
-                        value=float(invoice.get('discount_percent', 0.0)), 
-                        format="%.2f",
-                        key=f"edit_discount_{invoice['id']}"
+                    st.session_state.temp_edit_items = edit_items
+                    st.session_state.temp_edit_items_invoice_id = invoice['id']
+                else:
+                    edit_items = st.session_state.temp_edit_items
+                
+                # Convert to DataFrame for inline editing
+                df_edit = pd.DataFrame(edit_items)
+                if df_edit.empty:
+                    df_edit = pd.DataFrame(columns=[
+                        'metal', 'weight', 'rate', 'wastage_percent', 'making_percent',
+                        'item_value', 'wastage_amount', 'making_amount', 'line_total'
+                    ])
+                
+                # Ensure columns exist and in desired order
+                cols_order = ['metal', 'weight', 'rate', 'wastage_percent', 'making_percent',
+                              'item_value', 'wastage_amount', 'making_amount', 'line_total']
+                for c in cols_order:
+                    if c not in df_edit.columns:
+                        df_edit[c] = 0.0 if c not in ('metal',) else ''
+                df_edit = df_edit[cols_order]
+                
+                st.markdown("**Edit Items Inline:**")
+                
+                # Use data_editor to let user edit rows inline.
+                # Editable columns: metal, weight, rate, wastage_percent, making_percent.
+                # Computed columns are displayed as read-only and will be recalculated live.
+                try:
+                    edited_df = st.data_editor(
+                        df_edit,
+                        column_config={
+                            'metal': st.column_config.SelectboxColumn('Metal', options=list(st.session_state.metal_settings.keys())),
+                            'weight': st.column_config.NumberColumn('Weight (g)', format="%.3f"),
+                            'rate': st.column_config.NumberColumn('Rate/g', format="%.2f"),
+                            'wastage_percent': st.column_config.NumberColumn('Wastage %', format="%.2f"),
+                            'making_percent': st.column_config.NumberColumn('Making %', format="%.2f"),
+                            'item_value': st.column_config.NumberColumn('Item Value', format="%.2f", disabled=True),
+                            'wastage_amount': st.column_config.NumberColumn('Wastage Amt', format="%.2f", disabled=True),
+                            'making_amount': st.column_config.NumberColumn('Making Amt', format="%.2f", disabled=True),
+                            'line_total': st.column_config.NumberColumn('Total', format="%.2f", disabled=True),
+                        },
+                        hide_index=True,
+                        use_container_width=True,
+                        key=f"items_editor_{invoice['id']}"
                     )
-                    
-                    # Calculate invoice summary from recalculated rows
-                    subtotal_edit = sum(item['line_total'] for item in st.session_state.temp_edit_items) if st.session_state.temp_edit_items else 0.0
-                    discount_amt_edit = subtotal_edit * (edit_discount / 100)
-                    taxable_edit = subtotal_edit - discount_amt_edit
-                    cgst_amt_edit = taxable_edit * (invoice.get('cgst_percent', 0.0) / 100)
-                    sgst_amt_edit = taxable_edit * (invoice.get('sgst_percent', 0.0) / 100)
-                    total_edit = taxable_edit + cgst_amt_edit + sgst_amt_edit
-                    
-                    st.markdown("---")
-                    col1, col2 = st.columns(2)
-                    with col2:
-                        st.markdown(f"**Subtotal:** {format_currency(subtotal_edit)}")
-                        if edit_discount > 0:
-                            st.markdown(f"**Discount ({edit_discount}%):** -{format_currency(discount_amt_edit)}")
-                            st.markdown(f"**Taxable Amount:** {format_currency(taxable_edit)}")
-                        st.markdown(f"**CGST ({invoice.get('cgst_percent', 0.0)}%):** {format_currency(cgst_amt_edit)}")
-                        st.markdown(f"**SGST ({invoice.get('sgst_percent', 0.0)}%):** {format_currency(sgst_amt_edit)}")
-                        st.markdown(f"### **Total:** {format_currency(total_edit)}")
-                    
-                    # Save changes
-                    col1, col2 = st.columns(2)
-                    with col1:
-                        if st.button("💾 Save Changes", key=f"save_edit_{invoice['id']}"):
-                            try:
-                                # Validate: must have at least one non-zero item
-                                valid_items = [it for it in st.session_state.temp_edit_items if it['line_total'] > 0]
-                                if not valid_items:
-                                    st.error("Invoice must have at least one non-zero item")
-                                else:
-                                    db.update_invoice(
-                                        invoice['id'],
-                                        st.session_state.temp_edit_items,
-                                        invoice.get('cgst_percent', 0.0),
-                                        invoice.get('sgst_percent', 0.0),
-                                        edit_discount
-                                    )
-                                    st.success("✅ Invoice updated successfully!")
-                                    # Clean up edit state
-                                    for k in ('editing_invoice_id', 'editing_invoice_no', 'temp_edit_items', 'temp_edit_items_invoice_id'):
-                                        if k in st.session_state:
-                                            del st.session_state[k]
-                                    st.rerun()
-                            except Exception as e:
-                                st.error(f"Error updating invoice: {str(e)}")
-                    
-                    with col2:
-                        if st.button("❌ Cancel Edit", key=f"cancel_edit_{invoice['id']}"):
-                            # discard changes
-                            for k in ('editing_invoice_id', 'editing_invoice_no', 'temp_edit_items', 'temp_edit_items_invoice_id'):
-                                if k in st.session_state:
-                                    del st.session_state[k]
+                except Exception:
+                    # Fallback if column_config API isn't available in older Streamlit versions
+                    edited_df = st.data_editor(
+                        df_edit,
+                        hide_index=True,
+                        use_container_width=True,
+                        key=f"items_editor_{invoice['id']}"
+                    )
+                
+                # Recalculate totals for all rows at once; NaN or blank inputs count as 0
+                default_metal = list(st.session_state.metal_settings.keys())[0]
+                metals = edited_df['metal'].fillna('').astype(str).str.strip().replace('', default_metal)
+                inputs = {column: numeric_array(edited_df[column])
+                          for column in ['weight', 'rate', 'wastage_percent', 'making_percent']}
+                recalculated_df = pd.DataFrame({
+                    'metal': metals.to_numpy(),
+                    **inputs,
+                    **calculate_item_totals_batch(**inputs)
+                })
+                recalculated_rows = recalculated_df.to_dict('records')
+                
+                # Persist recalculated rows back to session state
+                st.session_state.temp_edit_items = recalculated_rows
+                
+                # Add / select and delete item buttons (affect session_state.temp_edit_items)
+                col_a, col_b, col_c = st.columns([2, 2, 1])
+                with col_a:
+                    if st.button("➕ Add Empty Item", key=f"add_empty_{invoice['id']}"):
+                        st.session_state.temp_edit_items.append({
+                            'metal': list(st.session_state.metal_settings.keys())[0],
+                            'weight': 0.0,
+                            'rate': 0.0,
+                            'wastage_percent': 0.0,
+                            'making_percent': 0.0,
+                            'item_value': 0.0,
+                            'wastage_amount': 0.0,
+                            'making_amount': 0.0,
+                            'line_total': 0.0
+                        })
+                        st.rerun()
+                with col_b:
+                    if len(st.session_state.temp_edit_items) > 0:
+                        item_options = {f"Item {i+1}: {item['metal']} {item['weight']:.3f}g": i 
+                                      for i, item in enumerate(st.session_state.temp_edit_items)}
+                        selected_item = st.selectbox("Select to delete", options=list(item_options.keys()), 
+                                                    key=f"delete_edit_item_{invoice['id']}")
+                with col_c:
+                    if len(st.session_state.temp_edit_items) > 0:
+                        st.markdown("<br>", unsafe_allow_html=True)  # Add spacing
+                        if st.button("🗑️ Delete", key=f"remove_selected_{invoice['id']}", type="secondary"):
+                            item_index = item_options[selected_item]
+                            st.session_state.temp_edit_items.pop(item_index)
                             st.rerun()
-                    
-                    break  # Exit loop after processing the editing invoice
+                
+                # Edit discount (live)
+                edit_discount = st.number_input(
+                    "Discount %", 
+                    min_value=0.0, 
+                    value=float(invoice.get('discount_percent', 0.0)), 
+                    format="%.2f",
+                    key=f"edit_discount_{invoice['id']}"
+                )
+                
+                # Calculate invoice summary from recalculated rows
+                totals_edit = calculate_invoice_totals(
+                    [item['line_total'] for item in st.session_state.temp_edit_items or []],
+                    edit_discount, invoice.get('cgst_percent', 0.0), invoice.get('sgst_percent', 0.0)
+                )
+                subtotal_edit, discount_amt_edit, taxable_edit, cgst_amt_edit, sgst_amt_edit, total_edit = (
+                    from_paise(totals_edit[key]) for key in
+                    ('subtotal', 'discount_amount', 'taxable_amount', 'cgst_amount', 'sgst_amount', 'total')
+                )
+                
+                st.markdown("---")
+                col1, col2 = st.columns(2)
+                with col2:
+                    st.markdown(f"**Subtotal:** {format_currency(subtotal_edit)}")
+                    if edit_discount > 0:
+                        st.markdown(f"**Discount ({edit_discount}%):** -{format_currency(discount_amt_edit)}")
+                        st.markdown(f"**Taxable Amount:** {format_currency(taxable_edit)}")
+                    st.markdown(f"**CGST ({invoice.get('cgst_percent', 0.0)}%):** {format_currency(cgst_amt_edit)}")
+                    st.markdown(f"**SGST ({invoice.get('sgst_percent', 0.0)}%):** {format_currency(sgst_amt_edit)}")
+                    st.markdown(f"### **Total:** {format_currency(total_edit)}")
+                
+                # Save changes
+                col1, col2 = st.columns(2)
+                with col1:
+                    if st.button("💾 Save Changes", key=f"save_edit_{invoice['id']}"):
+                        try:
+                            # Validate: must have at least one non-zero item
+                            valid_items = [it for it in st.session_state.temp_edit_items if it['line_total'] > 0]
+                            if not valid_items:
+                                st.error("Invoice must have at least one non-zero item")
+                            else:
+                                db.update_invoice(
+                                    invoice['id'],
+                                    st.session_state.temp_edit_items,
+                                    invoice.get('cgst_percent', 0.0),
+                                    invoice.get('sgst_percent', 0.0),
+                                    edit_discount
+                                )
+                                st.success("✅ Invoice updated successfully!")
+                                # Clean up edit state
+                                for k in ('editing_invoice_id', 'editing_invoice_no', 'temp_edit_items', 'temp_edit_items_invoice_id'):
+                                    if k in st.session_state:
+                                        del st.session_state[k]
+                                st.rerun()
+                        except Exception as e:
+                            st.error(f"Error updating invoice: {str(e)}")
+                
+                with col2:
+                    if st.button("❌ Cancel Edit", key=f"cancel_edit_{invoice['id']}"):
+                        # discard changes
+                        for k in ('editing_invoice_id', 'editing_invoice_no', 'temp_edit_items', 'temp_edit_items_invoice_id'):
+                            if k in st.session_state:
+                                del st.session_state[k]
+                        st.rerun()
 
 
 # ============================================================================
@@ -1262,7 +1303,7 @@ with tab_reports:
     
     report_type = st.radio(
         "Select Report Type",
-        ["📅 Sales Report", "👥 Customer Analysis", "📦 Category Report"],
+        ["📅 Sales Report", "👥 Customer Analysis", "📦 Category Report", "📈 Board Rates", "🔮 What-if Repricing"],
         horizontal=True
     )
     
@@ -1300,42 +1341,64 @@ with tab_reports:
             start_date_str = start_of_month.strftime("%Y-%m-%d")
             end_date_str = (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")
         
-        # Get sales report
-        sales_df = db.get_sales_report(start_date_str, end_date_str)
+        # Aggregate first: totals and the per-day series come from the daily summary
+        summary_df = db.get_sales_summary(start_date_str, end_date_str)
         
-        if not sales_df.empty:
+        if not summary_df.empty:
             st.markdown(f"**Report Period:** {start_date_str} to {end_date_str}")
-            st.markdown(f"**Total Invoices:** {len(sales_df)}")
+            st.markdown(f"**Total Invoices:** {int(summary_df['invoice_count'].sum())}")
             
             # Summary metrics
             col1, col2, col3, col4 = st.columns(4)
             with col1:
-                st.metric("Total Sales", format_currency(sales_df['total'].sum()))
+                st.metric("Total Sales", format_currency(summary_df['total'].sum()))
             with col2:
-                st.metric("Subtotal", format_currency(sales_df['subtotal'].sum()))
+                st.metric("Subtotal", format_currency(summary_df['subtotal'].sum()))
             with col3:
-                st.metric("Total Discount", format_currency(sales_df['discount_amount'].sum()))
+                st.metric("Total Discount", format_currency(summary_df['discount_amount'].sum()))
             with col4:
-                st.metric("Total Tax", format_currency(sales_df['cgst_amount'].sum() + sales_df['sgst_amount'].sum()))
+                st.metric("Total Tax", format_currency(summary_df['cgst_amount'].sum() + summary_df['sgst_amount'].sum()))
             
             st.markdown("---")
             
-            # Display detailed report
-            st.markdown("**Detailed Sales Report:**")
-            display_df = sales_df.copy()
-            display_df['subtotal'] = display_df['subtotal'].apply(format_currency)
-            display_df['discount_amount'] = display_df['discount_amount'].apply(format_currency)
-            display_df['cgst_amount'] = display_df['cgst_amount'].apply(format_currency)
-            display_df['sgst_amount'] = display_df['sgst_amount'].apply(format_currency)
-            display_df['total'] = display_df['total'].apply(format_currency)
+            # Per-period series: days come from the daily summary, weeks and months
+            # are bucketed from the integer invoice timestamps
+            period_titles = {"Day": "Daily", "Week": "Weekly", "Month": "Monthly"}
+            sales_period = st.radio("Group by", list(period_titles), horizontal=True, key="sales_period")
+            if sales_period == "Day":
+                period_df = summary_df
+                period_column = 'day'
+            else:
+                period_df = db.get_sales_by_period(sales_period.lower(), start_date_str, end_date_str)
+                period_column = 'period_start'
+            st.markdown(f"**{period_titles[sales_period]} Sales:**")
+            if len(period_df) > 1:
+                st.bar_chart(period_df.set_index(period_column)['total'])
+            daily_display = period_df.copy()
+            for column in ['subtotal', 'discount_amount', 'cgst_amount', 'sgst_amount', 'total']:
+                daily_display[column] = daily_display[column].apply(format_currency)
+            st.dataframe(daily_display, width='stretch', hide_index=True)
             
-            st.dataframe(display_df, width='stretch', hide_index=True)
+            # Detail rows are only fetched for the day the user drills into
+            drill_day = st.selectbox("View invoices for day", [""] + summary_df['day'].tolist()[::-1],
+                                     key="sales_drill_day")
+            if drill_day:
+                next_day = (datetime.strptime(drill_day, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+                sales_df = db.get_sales_report(drill_day, next_day)
+                st.markdown(f"**Invoices on {drill_day}:**")
+                display_df = sales_df.copy()
+                display_df['subtotal'] = display_df['subtotal'].apply(format_currency)
+                display_df['discount_amount'] = display_df['discount_amount'].apply(format_currency)
+                display_df['cgst_amount'] = display_df['cgst_amount'].apply(format_currency)
+                display_df['sgst_amount'] = display_df['sgst_amount'].apply(format_currency)
+                display_df['total'] = display_df['total'].apply(format_currency)
+                
+                st.dataframe(display_df, width='stretch', hide_index=True)
             
-            # Export option
-            csv_data = sales_df.to_csv(index=False)
+            # Export option - the detailed rows are only read when the button is clicked
             st.download_button(
                 label="📥 Export to CSV",
-                data=csv_data,
+                data=lambda: db.get_sales_report(start_date_str, end_date_str).to_csv(index=False),
                 file_name=f"sales_report_{start_date_str}_to_{end_date_str}.csv",
                 mime="text/csv"
             )
@@ -1354,18 +1417,23 @@ with tab_reports:
         )
         
         if analysis_type == "Specific Customer":
-            customers_df = db.get_customers()
+            analysis_search = st.text_input("🔍 Search Customer (type name or phone)", "",
+                                            key="analysis_customer_search")
+            customers_df = db.search_customers(analysis_search, limit=CUSTOMER_SEARCH_LIMIT)
             if not customers_df.empty:
-                customer_options = {f"{row['name']} ({row['account_no']})": row['id'] 
-                                   for _, row in customers_df.iterrows()}
-                selected_customer = st.selectbox("Select Customer", options=list(customer_options.keys()))
-                customer_id = customer_options[selected_customer]
-                analysis_df = db.get_customer_purchase_analysis(customer_id)
+                customer_labels = dict(zip(
+                    customers_df['id'],
+                    customers_df['name'] + " (" + customers_df['account_no'] + ")"
+                ))
+                customer_id = st.selectbox("Select Customer", options=list(customer_labels),
+                                           format_func=customer_labels.get)
+                analysis_df = db.get_customer_purchase_analysis(int(customer_id))
             else:
                 st.warning("No customers found")
                 analysis_df = pd.DataFrame()
         else:
-            analysis_df = db.get_customer_purchase_analysis()
+            top_n = st.selectbox("Show", ["Top 10", "Top 50", "Top 100", "All"], key="customer_analysis_top_n")
+            analysis_df = db.get_top_customers(None if top_n == "All" else int(top_n.split()[1]))
         
         if not analysis_df.empty:
             st.markdown("**Customer Purchase Summary:**")
@@ -1380,21 +1448,35 @@ with tab_reports:
             st.dataframe(display_df, width='stretch', hide_index=True)
             
             # Export option
-            csv_data = analysis_df.to_csv(index=False)
             st.download_button(
                 label="📥 Export to CSV",
-                data=csv_data,
+                data=lambda: analysis_df.to_csv(index=False),
                 file_name=f"customer_analysis_{datetime.now().strftime('%Y%m%d')}.csv",
                 mime="text/csv"
             )
         else:
             st.info("No customer purchase data found")
     
-    else:  # Category Report
+    elif report_type == "📦 Category Report":
         st.markdown("#### Category (Metal Type) Wise Report")
         st.info("View sales breakdown by metal type")
         
-        category_df = db.get_category_report()
+        # Figures come from the per-metal monthly rollup; "Exact recompute" re-reads every item
+        category_months = db.get_category_months()
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            category_start = st.selectbox("From Month", ["All"] + category_months[::-1], key="category_start_month")
+        with col2:
+            category_end = st.selectbox("To Month", ["All"] + category_months, key="category_end_month")
+        with col3:
+            category_exact = st.checkbox("Exact recompute", key="category_exact",
+                                         help="Recompute from invoice items instead of the rollup")
+        
+        category_df = db.get_category_report(
+            start_month=None if category_start == "All" else category_start,
+            end_month=None if category_end == "All" else category_end,
+            exact=category_exact
+        )
         
         if not category_df.empty:
             # Display summary
@@ -1421,15 +1503,146 @@ with tab_reports:
             st.dataframe(display_df, width='stretch', hide_index=True)
             
             # Export option
-            csv_data = category_df.to_csv(index=False)
             st.download_button(
                 label="📥 Export to CSV",
-                data=csv_data,
+                data=lambda: category_df.to_csv(index=False),
                 file_name=f"category_report_{datetime.now().strftime('%Y%m%d')}.csv",
                 mime="text/csv"
             )
         else:
             st.info("No category data found")
+    
+    elif report_type == "📈 Board Rates":
+        st.markdown("#### Invoiced vs Board Rates")
+        st.info("Compare the rates on invoices with the shop-wide board rate in effect on each invoice date")
+        
+        board_months = db.get_category_months()
+        col1, col2 = st.columns(2)
+        with col1:
+            board_start = st.selectbox("From Month", ["All"] + board_months[::-1], key="board_start_month")
+        with col2:
+            board_end = st.selectbox("To Month", ["All"] + board_months, key="board_end_month")
+        
+        comparison_df = db.get_board_rate_comparison(
+            start_month=None if board_start == "All" else board_start,
+            end_month=None if board_end == "All" else board_end
+        )
+        
+        if not comparison_df.empty:
+            display_df = comparison_df.copy()
+            display_df['total_weight'] = display_df['total_weight'].apply(lambda x: f"{x:.3f}g")
+            for column in ['invoiced_rate', 'board_rate', 'difference']:
+                display_df[column] = display_df[column].apply(lambda x: format_currency(x) if pd.notna(x) else "—")
+            display_df['difference_pct'] = display_df['difference_pct'].apply(lambda x: f"{x:+.2f}%" if pd.notna(x) else "—")
+            st.dataframe(display_df, width='stretch', hide_index=True)
+            
+            st.download_button(
+                label="📥 Export to CSV",
+                data=lambda: comparison_df.to_csv(index=False),
+                file_name=f"board_rates_{datetime.now().strftime('%Y%m%d')}.csv",
+                mime="text/csv"
+            )
+        else:
+            st.info("No invoice items found")
+        
+        st.markdown("---")
+        st.markdown("**Board rate on a date:**")
+        col1, col2 = st.columns(2)
+        with col1:
+            lookup_metal = st.selectbox("Metal", list(st.session_state.metal_settings.keys()), key="board_lookup_metal")
+        with col2:
+            lookup_date = st.date_input("Date", value=datetime.now().date(), key="board_lookup_date")
+        # The whole day counts, so a rate set that morning is the one shown
+        board_rate = rate_at(lookup_metal, f"{lookup_date:%Y-%m-%d} 23:59:59")
+        if board_rate:
+            st.markdown(f"Rate {format_currency(board_rate['rate'])}/g · Wastage {board_rate['wastage']}% · "
+                        f"Making {board_rate['making']}%")
+        else:
+            st.info(f"No board rate recorded for {lookup_metal} on or before {lookup_date:%Y-%m-%d}")
+        
+        if require_admin():
+            with st.expander("➕ Record a past board rate"):
+                col1, col2 = st.columns(2)
+                with col1:
+                    past_metal = st.text_input("Metal", value=lookup_metal, key="past_rate_metal")
+                    past_date = st.date_input("Effective from", value=datetime.now().date(), key="past_rate_date")
+                with col2:
+                    past_rate = st.number_input("Rate (per gram)", min_value=0.0, format="%.2f", key="past_rate_rate")
+                    past_wastage = st.number_input("Wastage %", min_value=0.0, format="%.2f", key="past_rate_wastage")
+                    past_making = st.number_input("Making %", min_value=0.0, format="%.2f", key="past_rate_making")
+                if st.button("💾 Record Rate", key="past_rate_save"):
+                    if not past_metal.strip() or past_rate <= 0:
+                        st.error("Metal and a positive rate are required")
+                    else:
+                        record_rate(past_metal.strip(), past_rate, past_wastage, past_making, f"{past_date:%Y-%m-%d}")
+                        st.success(f"✅ Recorded {past_metal.strip()} at {format_currency(past_rate)} from {past_date:%Y-%m-%d}")
+            
+            history_df = get_rate_history()
+            if not history_df.empty:
+                st.markdown("**Rate history:**")
+                st.dataframe(history_df.drop(columns=['effective_ts']), width='stretch', hide_index=True)
+    
+    else:  # What-if Repricing
+        st.markdown("#### What-if Repricing")
+        st.info("See what invoices in a date range would come to at different metal rates")
+        
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            whatif_start = st.date_input("Start Date", value=datetime.now().date() - timedelta(days=30), key="whatif_start")
+        with col2:
+            whatif_end = st.date_input("End Date", value=datetime.now().date(), key="whatif_end")
+        with col3:
+            whatif_metals = st.multiselect("Metals", list(st.session_state.metal_settings.keys()), key="whatif_metals",
+                                           placeholder="All metals")
+        
+        st.markdown("**New rates** (start from the current settings):")
+        whatif_rates_df = pd.DataFrame([
+            {'Metal': metal, 'Rate (per gram)': settings['rate'], 'Wastage %': settings['wastage'], 'Making %': settings['making']}
+            for metal, settings in st.session_state.metal_settings.items()
+        ])
+        edited_whatif = st.data_editor(whatif_rates_df, width='stretch', hide_index=True, disabled=['Metal'],
+                                       key="whatif_rates")
+        whatif_settings = {
+            row['Metal']: {'rate': row['Rate (per gram)'], 'wastage': row['Wastage %'], 'making': row['Making %']}
+            for _, row in edited_whatif.iterrows()
+        }
+        
+        repriced_df, whatif_summary = db.reprice_invoices(
+            whatif_settings,
+            start_date=whatif_start.strftime("%Y-%m-%d"),
+            end_date=(whatif_end + timedelta(days=1)).strftime("%Y-%m-%d"),
+            metals=whatif_metals or None
+        )
+        
+        if not repriced_df.empty:
+            col1, col2, col3, col4 = st.columns(4)
+            with col1:
+                st.metric("Invoices", whatif_summary['invoice_count'])
+            with col2:
+                st.metric("Items Repriced", whatif_summary['repriced_items'])
+            with col3:
+                st.metric("Current Total", format_currency(whatif_summary['current_total']))
+            with col4:
+                st.metric("New Total", format_currency(whatif_summary['new_total']),
+                          delta=f"{whatif_summary['delta']:+,.2f}")
+            
+            st.markdown("---")
+            st.markdown("**Per-invoice impact** (largest changes first):")
+            display_df = repriced_df.reindex(repriced_df['delta'].abs().sort_values(ascending=False).index)
+            display_df = display_df.drop(columns=['invoice_id'])
+            for column in ['current_subtotal', 'current_tax', 'current_total', 'new_subtotal', 'new_tax', 'new_total', 'delta']:
+                display_df[column] = display_df[column].apply(format_currency)
+            display_df['delta_pct'] = display_df['delta_pct'].apply(lambda x: f"{x:+.2f}%" if pd.notna(x) else "—")
+            st.dataframe(display_df, width='stretch', hide_index=True)
+            
+            st.download_button(
+                label="📥 Export to CSV",
+                data=lambda: repriced_df.to_csv(index=False),
+                file_name=f"repricing_{datetime.now().strftime('%Y%m%d')}.csv",
+                mime="text/csv"
+            )
+        else:
+            st.info("No invoices found for the selected filters")
 
 
 # ============================================================================
@@ -1509,11 +1722,19 @@ with tab_database:
     with col2:
         uploaded_customers = st.file_uploader("📤 Import Customers (CSV)", type=['csv'], key="import_customers")
         if uploaded_customers is not None:
-            csv_content = uploaded_customers.read().decode('utf-8')
+            existing_phone_action = st.radio(
+                "If a phone number already exists",
+                ["Skip row", "Update customer"],
+                horizontal=True,
+                key="import_customers_mode"
+            )
             if st.button("⬆️ Import Customers", width='stretch'):
-                imported, errors = db.import_customers_csv(csv_content)
+                mode = 'upsert' if existing_phone_action == "Update customer" else 'skip'
+                imported, updated, errors = db.import_customers_csv(uploaded_customers, mode=mode)
                 if imported > 0:
                     st.success(f"✅ Imported {imported} customers")
+                if updated > 0:
+                    st.success(f"✅ Updated {updated} existing customers")
                 if errors:
                     st.warning(f"⚠️ {len(errors)} errors occurred")
                     for error in errors[:5]:
@@ -1528,22 +1749,37 @@ with tab_database:
     
     with col1:
         if st.button("📥 Export Invoices (JSON)", width='stretch'):
-            json_data = db.export_invoices_json()
             from datetime import datetime
+            
+            # Streamlit turns download data into bytes, so the export is built in memory,
+            # but only when a download button is clicked
+            export_name = f"invoices_{st.session_state.username}_{datetime.now().strftime('%Y%m%d')}"
             st.download_button(
                 label="💾 Download JSON",
-                data=json_data,
-                file_name=f"invoices_{st.session_state.username}_{datetime.now().strftime('%Y%m%d')}.json",
+                data=db.export_invoices_json,
+                file_name=f"{export_name}.json",
                 mime="application/json",
                 key="download_invoices_json"
             )
+            st.download_button(
+                label="💾 Download NDJSON (large histories)",
+                data=db.export_invoices_ndjson,
+                file_name=f"{export_name}.ndjson",
+                mime="application/x-ndjson",
+                key="download_invoices_ndjson"
+            )
     
     with col2:
-        uploaded_invoices = st.file_uploader("📤 Import Invoices (JSON)", type=['json'], key="import_invoices")
+        uploaded_invoices = st.file_uploader("📤 Import Invoices (JSON / NDJSON)", type=['json', 'ndjson', 'jsonl'],
+                                             key="import_invoices")
         if uploaded_invoices is not None:
-            json_content = uploaded_invoices.read().decode('utf-8')
             if st.button("⬆️ Import Invoices", width='stretch'):
-                imported, errors = db.import_invoices_json(json_content)
+                if uploaded_invoices.name.lower().endswith(('.ndjson', '.jsonl')):
+                    # Parsed one line at a time straight from the upload
+                    imported, errors = db.import_invoices_ndjson(uploaded_invoices)
+                else:
+                    json_content = uploaded_invoices.read().decode('utf-8')
+                    imported, errors = db.import_invoices_json(json_content)
                 if imported > 0:
                     st.success(f"✅ Imported {imported} invoices")
                 if errors:
@@ -1576,7 +1812,12 @@ with tab_database:
                         # Delete the database file
                         db_path = st.session_state.db_path
                         if os.path.basename(db_path) == db_path and os.path.exists(db_path):
+                            # Release pooled handles first so the file can be removed
+                            close_pool(db_path)
                             os.remove(db_path)
+                            forget_tenant(db_path)
+                            forget_tenant_rates(db_path)
+                            forget_tenant_pdfs(db_path)
                         
                         # Reset session state
                         st.session_state.metal_settings = {
@@ -1759,6 +2000,7 @@ if require_admin():
                             if st.button("🗑️ Delete User", key=f"delete_{user['id']}", type="secondary"):
                                 if st.session_state.get(f'confirm_delete_{user["id"]}'):
                                     auth_db.reject_user(user['id'])
+                                    forget_tenant_pdfs(f'jewelcalc_user_{user["id"]}.db')
                                     st.success(f"✅ User deleted")
                                     st.rerun()
                                 else:
@@ -1912,45 +2154,35 @@ if require_admin():
         with admin_tab4:
             st.markdown("#### Database Overview")
             
-            # Get all user databases and admin database
-            import glob
-            user_dbs = glob.glob('jewelcalc_user_*.db')
-            
-            # Include admin database if it exists
-            admin_db_path = 'jewelcalc_admin.db'
-            all_dbs = []
-            if os.path.exists(admin_db_path):
-                all_dbs.append(('admin', admin_db_path, 'Admin'))
-            
-            for db_file in user_dbs:
-                user_id = db_file.replace('jewelcalc_user_', '').replace('.db', '')
-                user_info = all_users[all_users['id'] == int(user_id)]
-                username = user_info.iloc[0]['username'] if not user_info.empty else f"User {user_id}"
-                all_dbs.append(('user', db_file, username))
+            # Totals come from the central rollups, kept current by every invoice write
+            db_stats = get_tenant_totals()
+            usernames = dict(zip(all_users['id'].astype(str), all_users['username']))
             
-            if all_dbs:
-                st.markdown(f"**Total Databases:** {len(all_dbs)} (including admin)")
+            if not db_stats.empty:
+                col1, col2 = st.columns([3, 1])
+                with col1:
+                    st.markdown(f"**Total Databases:** {len(db_stats)} (including admin)")
+                with col2:
+                    if st.button("🔄 Rebuild Totals", key="rebuild_rollups", use_container_width=True):
+                        rebuild_all()
+                        st.rerun()
                 
                 # Show statistics for each database
-                for db_type, db_file, display_name in all_dbs:
-                    try:
-                        user_db = Database(db_file)
-                        customers = user_db.get_customers()
-                        invoices = user_db.get_invoices()
-                        
-                        with st.expander(f"📊 {display_name} - {db_file}"):
-                            col1, col2, col3 = st.columns(3)
-                            with col1:
-                                st.metric("Customers", len(customers))
-                            with col2:
-                                st.metric("Invoices", len(invoices))
-                            with col3:
-                                if not invoices.empty:
-                                    total_revenue = invoices['total'].sum()
-                                    st.metric("Total Revenue", format_currency(total_revenue))
-                                else:
-                                    st.metric("Total Revenue", format_currency(0))
-                    except Exception as e:
-                        st.error(f"Error reading {db_file}: {str(e)}")
+                for _, stats in db_stats.iterrows():
+                    user_id = stats['db_path'].replace('jewelcalc_user_', '').replace('.db', '')
+                    display_name = 'Admin' if stats['db_path'] == 'jewelcalc_admin.db' else usernames.get(user_id, f"User {user_id}")
+                    with st.expander(f"📊 {display_name} - {stats['db_path']}"):
+                        col1, col2, col3 = st.columns(3)
+                        with col1:
+                            st.metric("Customers", int(stats['customers']))
+                        with col2:
+                            st.metric("Invoices", int(stats['invoices']))
+                        with col3:
+                            st.metric("Total Revenue", format_currency(stats['revenue']))
+                        col1, col2, col3 = st.columns(3)
+                        with col1:
+                            st.metric("Tax Collected", format_currency(stats['tax']))
+                        with col2:
+                            st.metric("Discounts Given", format_currency(stats['discount']))
             else:
                 st.info("No databases found")
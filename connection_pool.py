@@ -0,0 +1,215 @@
+"""SQLite connection pooling for JewelCalc"""
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Defaults used for every pool created through get_pool()
+DEFAULT_MAX_SIZE = 8
+DEFAULT_IDLE_TIMEOUT = 300  # seconds an idle connection is kept before eviction
+DEFAULT_ACQUIRE_TIMEOUT = 30  # seconds to wait for a free connection
+
+
+def file_identity(db_path):
+    """Return (device, inode) of a database file, or None if it doesn't exist"""
+    try:
+        st = os.stat(db_path)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino)
+
+
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection that goes back to its pool when closed.
+
+    Subclassing sqlite3.Connection keeps pandas.read_sql_query and every
+    other caller working unchanged; close() simply hands the connection back.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pool = None
+        self._file_id = None
+        self._last_used = time.monotonic()
+
+    def close(self):
+        """Return the connection to its pool (or really close it if unpooled)"""
+        if self._pool is not None:
+            self._pool.release(self)
+        else:
+            sqlite3.Connection.close(self)
+
+    def _close_for_real(self):
+        """Close the underlying SQLite handle"""
+        self._pool = None
+        try:
+            sqlite3.Connection.close(self)
+        except sqlite3.Error:
+            pass
+
+
+class ConnectionPool:
+    """Thread-safe pool of reusable connections to one SQLite file"""
+
+    def __init__(self, db_path, max_size=DEFAULT_MAX_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 acquire_timeout=DEFAULT_ACQUIRE_TIMEOUT):
+        self.db_path = db_path
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+        self._idle = []  # LIFO stack of idle connections
+        self._in_use = 0
+        self._closed = False
+        self._cond = threading.Condition(threading.Lock())
+
+    def _open(self):
+        """Open a new connection bound to this pool"""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, factory=PooledConnection)
+        conn._pool = self
+        conn._file_id = file_identity(self.db_path)
+        return conn
+
+    def _is_healthy(self, conn):
+        """Check that an idle connection is still usable and points at the current file"""
+        if conn._file_id is None or conn._file_id != file_identity(self.db_path):
+            # The file was deleted or replaced (e.g. "Reset My Data") since we opened it
+            return False
+        try:
+            conn.execute('SELECT 1').fetchone()
+        except sqlite3.Error:
+            return False
+        return True
+
+    def _evict_idle(self, now):
+        """Close connections that have been idle longer than idle_timeout (lock held)"""
+        keep = []
+        for conn in self._idle:
+            if now - conn._last_used > self.idle_timeout:
+                conn._close_for_real()
+            else:
+                keep.append(conn)
+        self._idle = keep
+
+    def acquire(self):
+        """Get a connection from the pool, opening a new one if needed"""
+        deadline = time.monotonic() + self.acquire_timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise sqlite3.ProgrammingError("Connection pool is closed")
+                self._evict_idle(time.monotonic())
+                if self._idle:
+                    conn = self._idle.pop()
+                    self._in_use += 1
+                    break
+                if self._in_use < self.max_size:
+                    conn = None
+                    self._in_use += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise sqlite3.OperationalError(
+                        f"Timed out waiting for a connection to {self.db_path}"
+                    )
+                self._cond.wait(remaining)
+
+        # Health checks and connects happen outside the lock
+        try:
+            if conn is not None and not self._is_healthy(conn):
+                conn._close_for_real()
+                conn = None
+            if conn is None:
+                conn = self._open()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def release(self, conn):
+        """Return a connection to the pool"""
+        if conn._pool is not self:
+            return  # Already released or belongs elsewhere
+
+        reusable = True
+        try:
+            if conn.in_transaction:
+                # Uncommitted work is discarded, same as closing a plain connection
+                conn.rollback()
+        except sqlite3.Error:
+            reusable = False
+
+        with self._cond:
+            self._in_use -= 1
+            if reusable and not self._closed:
+                conn._last_used = time.monotonic()
+                self._idle.append(conn)
+            else:
+                conn._close_for_real()
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Context manager that acquires a connection and always releases it"""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def clear(self):
+        """Close all idle connections (checked-out ones close when released)"""
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn._close_for_real()
+
+    def close(self):
+        """Close the pool; it can't be used afterwards"""
+        with self._cond:
+            self._closed = True
+        self.clear()
+
+    def stats(self):
+        """Return a snapshot of pool usage"""
+        with self._cond:
+            return {'idle': len(self._idle), 'in_use': self._in_use, 'max_size': self.max_size}
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _pool_key(db_path):
+    return os.path.abspath(db_path)
+
+
+def get_pool(db_path):
+    """Get the process-wide pool for a database file, creating it on first use"""
+    key = _pool_key(db_path)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(db_path)
+            _pools[key] = pool
+        return pool
+
+
+def close_pool(db_path):
+    """Close and forget the pool for a database file (e.g. before replacing the file)"""
+    with _pools_lock:
+        pool = _pools.pop(_pool_key(db_path), None)
+    if pool is not None:
+        pool.close()
+
+
+def close_all_pools():
+    """Close every pool in the process"""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
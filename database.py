@@ -1,10 +1,143 @@
 """Database operations for JewelCalc"""
 import sqlite3
 import pandas as pd
+import numpy as np
 from datetime import datetime
 import json
 import csv
+import heapq
+import itertools
+import copy
+import os
+import threading
 from io import StringIO
+from connection_pool import get_pool, close_pool, file_identity
+from migrations import ensure_schema
+from federation import federated_query, tenant_databases
+import rollups
+import rate_history
+from utils import generate_account_number, validate_phones, calculate_item_totals_batch
+from utils import calculate_invoice_totals, calculate_invoice_totals_batch, from_paise
+
+
+# Stay well below SQLite's bound-parameter limit in IN (...) lists
+MAX_SQL_PARAMS = 500
+
+# Largest possible rowid, used as an open upper bound in keyset cursors
+MAX_ROWID = 2 ** 63 - 1
+
+
+def _select_in(conn, query, values):
+    """Run a query with an IN ({}) placeholder over values, chunking long lists"""
+    frames = []
+    for start in range(0, max(len(values), 1), MAX_SQL_PARAMS):
+        chunk = values[start:start + MAX_SQL_PARAMS]
+        if not chunk:
+            # Still run once so the caller gets the right columns
+            frames.append(pd.read_sql_query(query.format('NULL'), conn))
+            break
+        frames.append(pd.read_sql_query(query.format(', '.join('?' * len(chunk))), conn, params=chunk))
+    return frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+
+
+# A date/datetime string parameter as epoch seconds, matching invoices.date_ts.
+# It is a constant expression, so range conditions on date_ts still use its index.
+EPOCH_PARAM = "CAST(strftime('%s', ?) AS INTEGER)"
+
+# Invoice list order (with i.id as tie-break). Dates that never parsed have a NULL
+# date_ts; the -1 sentinel sorts them last and keeps them reachable by keyset pages.
+# Indexed as idx_invoices_order.
+INVOICE_ORDER_SQL = 'COALESCE(i.date_ts, -1)'
+
+# Sales report buckets as whole days since the epoch. 1970-01-01 was a Thursday,
+# so shifting by 3 days makes weeks start on Monday.
+SALES_PERIOD_BUCKETS = {
+    'day': 'date_ts / 86400',
+    'week': '(date_ts / 86400 + 3) / 7 * 7 - 3',
+    'month': "CAST(julianday(date_ts, 'unixepoch', 'start of month') - 2440587.5 AS INTEGER)",
+}
+
+
+# Parsed settings per database file, shared by every Database instance in the process:
+# absolute path -> (file identity, settings_version, {key: value}). Every settings write
+# bumps settings_version (by trigger), so other sessions and processes spot a stale
+# snapshot with one primary-key read and reload all keys in one query.
+_settings_cache = {}
+_settings_lock = threading.Lock()
+
+
+# metal_settings fields and the invoice_items columns they reprice
+REPRICE_FIELDS = {'rate': 'rate', 'wastage': 'wastage_percent', 'making': 'making_percent'}
+
+
+def _month_range(start_month, end_month):
+    """Conditions and params limiting invoices i to a 'YYYY-MM' month range (inclusive)"""
+    conditions = []
+    params = []
+    if start_month:
+        conditions.append("i.date_ts >= CAST(strftime('%s', ? || '-01') AS INTEGER)")
+        params.append(start_month)
+    if end_month:
+        conditions.append("i.date_ts < CAST(strftime('%s', ? || '-01', '+1 month') AS INTEGER)")
+        params.append(end_month)
+    return conditions, params
+
+
+ITEM_AMOUNT_FIELDS = ('item_value', 'wastage_amount', 'making_amount', 'line_total')
+
+
+def _price_missing_amounts(items):
+    """Return import items with any missing amounts priced from weight, rate and the percents"""
+    items = [dict(item) for item in items]
+    unpriced = [item for item in items if any(item.get(field) is None for field in ITEM_AMOUNT_FIELDS)]
+    if unpriced:
+        totals = calculate_item_totals_batch(
+            *([item.get(field) for item in unpriced] for field in ('weight', 'rate', 'wastage_percent', 'making_percent'))
+        )
+        for n, item in enumerate(unpriced):
+            item.update({field: float(totals[field][n]) for field in ITEM_AMOUNT_FIELDS})
+    return items
+
+
+def _invoice_amounts(items, discount_percent, cgst_percent, sgst_percent):
+    """(subtotal, discount_amount, cgst_amount, sgst_amount, total) in rupees, computed in paise"""
+    totals = calculate_invoice_totals(
+        [item['line_total'] for item in items], discount_percent, cgst_percent, sgst_percent
+    )
+    return tuple(from_paise(totals[key]) for key in
+                 ('subtotal', 'discount_amount', 'cgst_amount', 'sgst_amount', 'total'))
+
+
+def _fts_phrase(text):
+    """Quote text as a single FTS5 phrase (a substring match under the trigram tokenizer)"""
+    return '"' + text.replace('"', '""') + '"'
+
+
+def _like_escape(text):
+    """Escape LIKE wildcards in text, for use with ESCAPE '\\'"""
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _tenant_invoice_stream(label, path, limit, before, search, failures, start_date=None, end_date=None):
+    """Yield one database's invoices for get_recent_invoices_admin, newest first.
+    before is a cross-database (sort_ts, db_path, id) cursor; errors are appended to failures."""
+    tenant_before = None
+    if before is not None:
+        sort_ts, before_path, before_id = before
+        if path == before_path:
+            tenant_before = (sort_ts, before_id)
+        elif path < before_path:
+            tenant_before = (sort_ts, MAX_ROWID)  # Later in the order: rows at the same time remain
+        else:
+            tenant_before = (sort_ts, 0)  # Earlier in the order: only older times remain
+    try:
+        for row in Database(path).iter_invoices(limit=limit, before=tenant_before, search=search,
+                                                start_date=start_date, end_date=end_date):
+            row['database'] = label
+            row['db_path'] = path
+            yield row
+    except sqlite3.Error as e:
+        failures.append({'database': label, 'db_path': path, 'error': str(e)})
 
 
 class Database:
@@ -15,419 +148,340 @@ class Database:
         self._init_database()
     
     def get_connection(self):
-        """Get database connection"""
-        return sqlite3.connect(self.db_path, check_same_thread=False)
+        """Get a pooled database connection (close() returns it to the pool)"""
+        return get_pool(self.db_path).acquire()
+    
+    def connection(self):
+        """Context manager yielding a pooled connection, released on exit"""
+        return get_pool(self.db_path).connection()
     
     def _init_database(self):
-        """Initialize database tables"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Users table for authentication
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                full_name TEXT NOT NULL,
-                email TEXT,
-                phone TEXT,
-                role TEXT DEFAULT 'user',
-                status TEXT DEFAULT 'pending',
-                created_at TEXT NOT NULL,
-                approved_at TEXT,
-                approved_by INTEGER,
-                FOREIGN KEY(approved_by) REFERENCES users(id)
-            )
-        ''')
-        
-        # Password reset requests table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS password_reset_requests (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                username TEXT NOT NULL,
-                email TEXT,
-                phone TEXT,
-                request_type TEXT NOT NULL,
-                status TEXT DEFAULT 'pending',
-                requested_at TEXT NOT NULL,
-                resolved_at TEXT,
-                resolved_by INTEGER,
-                FOREIGN KEY(user_id) REFERENCES users(id),
-                FOREIGN KEY(resolved_by) REFERENCES users(id)
-            )
-        ''')
-        
-        # Customers table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS customers (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                account_no TEXT UNIQUE,
-                name TEXT NOT NULL,
-                phone TEXT UNIQUE NOT NULL,
-                address TEXT
-            )
-        ''')
-        
-        # Invoices table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS invoices (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                invoice_no TEXT UNIQUE NOT NULL,
-                customer_id INTEGER NOT NULL,
-                date TEXT NOT NULL,
-                subtotal REAL NOT NULL,
-                cgst_percent REAL NOT NULL,
-                sgst_percent REAL NOT NULL,
-                cgst_amount REAL NOT NULL,
-                sgst_amount REAL NOT NULL,
-                discount_percent REAL DEFAULT 0,
-                discount_amount REAL DEFAULT 0,
-                total REAL NOT NULL,
-                FOREIGN KEY(customer_id) REFERENCES customers(id)
-            )
-        ''')
-        
-        # Settings table for persistent user settings
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS settings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                key TEXT UNIQUE NOT NULL,
-                value TEXT NOT NULL,
-                updated_at TEXT NOT NULL
-            )
-        ''')
-        
-        # Invoice items table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS invoice_items (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                invoice_id INTEGER NOT NULL,
-                item_no INTEGER NOT NULL,
-                metal TEXT NOT NULL,
-                weight REAL NOT NULL,
-                rate REAL NOT NULL,
-                wastage_percent REAL NOT NULL,
-                making_percent REAL NOT NULL,
-                item_value REAL NOT NULL,
-                wastage_amount REAL NOT NULL,
-                making_amount REAL NOT NULL,
-                line_total REAL NOT NULL,
-                FOREIGN KEY(invoice_id) REFERENCES invoices(id)
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
+        """Bring the database schema up to date (no-op after the first call per process)"""
+        ensure_schema(self.db_path)
     
     # User operations
     def add_user(self, username, password_hash, full_name, email="", phone="", role="user"):
         """Add a new user (signup)"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'INSERT INTO users (username, password_hash, full_name, email, phone, role, status, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
-            (username, password_hash, full_name, email, phone, role, 'pending', datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-        )
-        conn.commit()
-        user_id = cursor.lastrowid
-        conn.close()
-        return user_id
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'INSERT INTO users (username, password_hash, full_name, email, phone, role, status, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (username, password_hash, full_name, email, phone, role, 'pending', datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            )
+            conn.commit()
+            user_id = cursor.lastrowid
+            return user_id
     
     def get_user_by_username(self, username):
         """Get user by username"""
-        conn = self.get_connection()
-        df = pd.read_sql_query(
-            'SELECT * FROM users WHERE username = ?',
-            conn,
-            params=(username,)
-        )
-        conn.close()
-        return df.iloc[0].to_dict() if not df.empty else None
+        with self.connection() as conn:
+            df = pd.read_sql_query(
+                'SELECT * FROM users WHERE username = ?',
+                conn,
+                params=(username,)
+            )
+            return df.iloc[0].to_dict() if not df.empty else None
     
     def get_all_users(self):
         """Get all users"""
-        conn = self.get_connection()
-        df = pd.read_sql_query(
-            'SELECT id, username, full_name, email, phone, role, status, created_at, approved_at FROM users ORDER BY created_at DESC',
-            conn
-        )
-        conn.close()
-        return df
+        with self.connection() as conn:
+            df = pd.read_sql_query(
+                'SELECT id, username, full_name, email, phone, role, status, created_at, approved_at FROM users ORDER BY created_at DESC',
+                conn
+            )
+            return df
     
     def get_pending_users(self):
         """Get users with pending approval"""
-        conn = self.get_connection()
-        df = pd.read_sql_query(
-            'SELECT id, username, full_name, email, phone, created_at FROM users WHERE status = ? ORDER BY created_at DESC',
-            conn,
-            params=('pending',)
-        )
-        conn.close()
-        return df
+        with self.connection() as conn:
+            df = pd.read_sql_query(
+                'SELECT id, username, full_name, email, phone, created_at FROM users WHERE status = ? ORDER BY created_at DESC',
+                conn,
+                params=('pending',)
+            )
+            return df
     
     def approve_user(self, user_id, admin_id):
         """Approve a user"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'UPDATE users SET status=?, approved_at=?, approved_by=? WHERE id=?',
-            ('approved', datetime.now().strftime("%Y-%m-%d %H:%M:%S"), admin_id, user_id)
-        )
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'UPDATE users SET status=?, approved_at=?, approved_by=? WHERE id=?',
+                ('approved', datetime.now().strftime("%Y-%m-%d %H:%M:%S"), admin_id, user_id)
+            )
+            conn.commit()
     
     def reject_user(self, user_id):
         """Reject/delete a user"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM users WHERE id=?', (user_id,))
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM users WHERE id=?', (user_id,))
+            conn.commit()
     
     def update_user_role(self, user_id, role):
         """Update user role"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'UPDATE users SET role=? WHERE id=?',
-            (role, user_id)
-        )
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'UPDATE users SET role=? WHERE id=?',
+                (role, user_id)
+            )
+            conn.commit()
     
     def update_user_password(self, user_id, new_password_hash):
         """Update user password"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'UPDATE users SET password_hash=? WHERE id=?',
-            (new_password_hash, user_id)
-        )
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'UPDATE users SET password_hash=? WHERE id=?',
+                (new_password_hash, user_id)
+            )
+            conn.commit()
     
     def update_user_profile(self, user_id, email=None, phone=None):
         """Update user profile (email and phone)"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Build dynamic update query based on provided fields
-        updates = []
-        params = []
-        
-        if email is not None:
-            updates.append('email=?')
-            params.append(email)
-        
-        if phone is not None:
-            updates.append('phone=?')
-            params.append(phone)
-        
-        if updates:
-            params.append(user_id)
-            query = f'UPDATE users SET {", ".join(updates)} WHERE id=?'
-            cursor.execute(query, params)
-            conn.commit()
-        
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            # Build dynamic update query based on provided fields
+            updates = []
+            params = []
+            
+            if email is not None:
+                updates.append('email=?')
+                params.append(email)
+            
+            if phone is not None:
+                updates.append('phone=?')
+                params.append(phone)
+            
+            if updates:
+                params.append(user_id)
+                query = f'UPDATE users SET {", ".join(updates)} WHERE id=?'
+                cursor.execute(query, params)
+                conn.commit()
     
     def add_user_with_approval(self, username, password_hash, full_name, email="", phone="", role="user", admin_id=None):
         """Add a new user with immediate approval (for admin creation)"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        cursor.execute(
-            'INSERT INTO users (username, password_hash, full_name, email, phone, role, status, created_at, approved_at, approved_by) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
-            (username, password_hash, full_name, email, phone, role, 'approved', now, now, admin_id)
-        )
-        conn.commit()
-        user_id = cursor.lastrowid
-        conn.close()
-        return user_id
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            cursor.execute(
+                'INSERT INTO users (username, password_hash, full_name, email, phone, role, status, created_at, approved_at, approved_by) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (username, password_hash, full_name, email, phone, role, 'approved', now, now, admin_id)
+            )
+            conn.commit()
+            user_id = cursor.lastrowid
+            return user_id
     
     def create_password_reset_request(self, username="", email="", phone="", request_type="password"):
         """Create a password reset request - supports lookup by username, email, or phone"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Try to find user by username, email, or phone
-        user = None
-        if username:
-            cursor.execute('SELECT id, username, email, phone FROM users WHERE username = ?', (username,))
-            user = cursor.fetchone()
-        
-        if not user and email:
-            cursor.execute('SELECT id, username, email, phone FROM users WHERE email = ?', (email,))
-            user = cursor.fetchone()
-        
-        if not user and phone:
-            cursor.execute('SELECT id, username, email, phone FROM users WHERE phone = ?', (phone,))
-            user = cursor.fetchone()
-        
-        if user is None:
-            conn.close()
-            return None
-        
-        user_id = user[0]
-        username_found = user[1]
-        user_email = user[2] or ""
-        user_phone = user[3] or ""
-        
-        cursor.execute(
-            'INSERT INTO password_reset_requests (user_id, username, email, phone, request_type, status, requested_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
-            (user_id, username_found, email or user_email, phone or user_phone, request_type, 'pending', datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-        )
-        conn.commit()
-        request_id = cursor.lastrowid
-        conn.close()
-        return request_id
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            # Try to find user by username, email, or phone
+            user = None
+            if username:
+                cursor.execute('SELECT id, username, email, phone FROM users WHERE username = ?', (username,))
+                user = cursor.fetchone()
+            
+            if not user and email:
+                cursor.execute('SELECT id, username, email, phone FROM users WHERE email = ?', (email,))
+                user = cursor.fetchone()
+            
+            if not user and phone:
+                cursor.execute('SELECT id, username, email, phone FROM users WHERE phone = ?', (phone,))
+                user = cursor.fetchone()
+            
+            if user is None:
+                return None
+            
+            user_id = user[0]
+            username_found = user[1]
+            user_email = user[2] or ""
+            user_phone = user[3] or ""
+            
+            cursor.execute(
+                'INSERT INTO password_reset_requests (user_id, username, email, phone, request_type, status, requested_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (user_id, username_found, email or user_email, phone or user_phone, request_type, 'pending', datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            )
+            conn.commit()
+            request_id = cursor.lastrowid
+            return request_id
     
     def get_pending_password_reset_requests(self):
         """Get all pending password reset requests"""
-        conn = self.get_connection()
-        df = pd.read_sql_query(
-            'SELECT id, user_id, username, email, phone, request_type, requested_at FROM password_reset_requests WHERE status = ? ORDER BY requested_at DESC',
-            conn,
-            params=('pending',)
-        )
-        conn.close()
-        return df
+        with self.connection() as conn:
+            df = pd.read_sql_query(
+                'SELECT id, user_id, username, email, phone, request_type, requested_at FROM password_reset_requests WHERE status = ? ORDER BY requested_at DESC',
+                conn,
+                params=('pending',)
+            )
+            return df
     
     def resolve_password_reset_request(self, request_id, admin_id, new_password_hash=None):
         """Resolve a password reset request and optionally set new password"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Get request details
-        cursor.execute('SELECT user_id FROM password_reset_requests WHERE id = ?', (request_id,))
-        result = cursor.fetchone()
-        
-        if result is None:
-            conn.close()
-            return False
-        
-        user_id = result[0]
-        
-        # Update password if provided
-        if new_password_hash:
-            cursor.execute('UPDATE users SET password_hash=? WHERE id=?', (new_password_hash, user_id))
-        
-        # Mark request as resolved
-        cursor.execute(
-            'UPDATE password_reset_requests SET status=?, resolved_at=?, resolved_by=? WHERE id=?',
-            ('resolved', datetime.now().strftime("%Y-%m-%d %H:%M:%S"), admin_id, request_id)
-        )
-        
-        conn.commit()
-        conn.close()
-        return True
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            # Get request details
+            cursor.execute('SELECT user_id FROM password_reset_requests WHERE id = ?', (request_id,))
+            result = cursor.fetchone()
+            
+            if result is None:
+                return False
+            
+            user_id = result[0]
+            
+            # Update password if provided
+            if new_password_hash:
+                cursor.execute('UPDATE users SET password_hash=? WHERE id=?', (new_password_hash, user_id))
+            
+            # Mark request as resolved
+            cursor.execute(
+                'UPDATE password_reset_requests SET status=?, resolved_at=?, resolved_by=? WHERE id=?',
+                ('resolved', datetime.now().strftime("%Y-%m-%d %H:%M:%S"), admin_id, request_id)
+            )
+            
+            conn.commit()
+            return True
     
     def reject_password_reset_request(self, request_id):
         """Reject a password reset request"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'UPDATE password_reset_requests SET status=?, resolved_at=? WHERE id=?',
-            ('rejected', datetime.now().strftime("%Y-%m-%d %H:%M:%S"), request_id)
-        )
-        conn.commit()
-        conn.close()
-        return True
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'UPDATE password_reset_requests SET status=?, resolved_at=? WHERE id=?',
+                ('rejected', datetime.now().strftime("%Y-%m-%d %H:%M:%S"), request_id)
+            )
+            conn.commit()
+            return True
     
     def create_admin_if_not_exists(self):
         """Create default admin user if no admin exists"""
         import hashlib
         import os
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM users WHERE role = ?', ('admin',))
-        count = cursor.fetchone()[0]
-        
-        if count == 0:
-            # Default admin: username=admin, password=admin123
-            # Use PBKDF2 for secure password hashing
-            salt = os.urandom(32)
-            pwd_hash = hashlib.pbkdf2_hmac('sha256', "admin123".encode('utf-8'), salt, 100000)
-            password_hash = salt.hex() + ':' + pwd_hash.hex()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT COUNT(*) FROM users WHERE role = ?', ('admin',))
+            count = cursor.fetchone()[0]
             
-            cursor.execute(
-                'INSERT INTO users (username, password_hash, full_name, email, phone, role, status, created_at, approved_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
-                ('admin', password_hash, 'Administrator', '', '', 'admin', 'approved', 
-                 datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 
-                 datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-            )
-            conn.commit()
-        conn.close()
+            if count == 0:
+                # Default admin: username=admin, password=admin123
+                # Use PBKDF2 for secure password hashing
+                salt = os.urandom(32)
+                pwd_hash = hashlib.pbkdf2_hmac('sha256', "admin123".encode('utf-8'), salt, 100000)
+                password_hash = salt.hex() + ':' + pwd_hash.hex()
+                
+                cursor.execute(
+                    'INSERT INTO users (username, password_hash, full_name, email, phone, role, status, created_at, approved_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    ('admin', password_hash, 'Administrator', '', '', 'admin', 'approved', 
+                     datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 
+                     datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+                )
+                conn.commit()
     
     # Customer operations
     def add_customer(self, account_no, name, phone, address=""):
         """Add a new customer"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'INSERT INTO customers (account_no, name, phone, address) VALUES (?, ?, ?, ?)',
-            (account_no, name, phone, address)
-        )
-        conn.commit()
-        customer_id = cursor.lastrowid
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'INSERT INTO customers (account_no, name, phone, address) VALUES (?, ?, ?, ?)',
+                (account_no, name, phone, address)
+            )
+            conn.commit()
+            customer_id = cursor.lastrowid
+        rollups.record_customers(self.db_path, 1)
         return customer_id
     
     def get_customers(self):
         """Get all customers as DataFrame"""
-        conn = self.get_connection()
-        df = pd.read_sql_query(
-            'SELECT id, account_no, name, phone, address FROM customers ORDER BY id DESC',
-            conn
-        )
-        conn.close()
-        return df
+        with self.connection() as conn:
+            df = pd.read_sql_query(
+                'SELECT id, account_no, name, phone, address FROM customers ORDER BY id DESC',
+                conn
+            )
+            return df
+    
+    def search_customers(self, query, limit=20):
+        """Customers whose name, phone, account number or address contain query, best matches first.
+        Uses the trigram index in customers_fts; an empty query returns the newest customers.
+        limit=None returns every match."""
+        query = (query or '').strip()
+        limit = -1 if limit is None else limit
+        columns = 'c.id, c.account_no, c.name, c.phone, c.address'
+        with self.connection() as conn:
+            if not query:
+                sql = f'SELECT {columns} FROM customers c ORDER BY c.id DESC LIMIT ?'
+                params = (limit,)
+            elif len(query) >= 3:
+                # Quoted as one phrase, i.e. a case-insensitive substring match
+                sql = f'''
+                    SELECT {columns}
+                    FROM customers_fts f
+                    JOIN customers c ON c.id = f.rowid
+                    WHERE customers_fts MATCH ?
+                    ORDER BY f.rank
+                    LIMIT ?
+                '''
+                params = (_fts_phrase(query), limit)
+            else:
+                # Trigrams need three characters; shorter queries match name/phone prefixes
+                pattern = _like_escape(query) + '%'
+                sql = f'''
+                    SELECT {columns} FROM customers c
+                    WHERE c.name LIKE ? ESCAPE '\\' OR c.phone LIKE ? ESCAPE '\\'
+                    ORDER BY c.id DESC
+                    LIMIT ?
+                '''
+                params = (pattern, pattern, limit)
+            return pd.read_sql_query(sql, conn, params=params)
     
     def get_customer_by_id(self, customer_id):
         """Get customer by ID"""
-        conn = self.get_connection()
-        df = pd.read_sql_query(
-            'SELECT * FROM customers WHERE id = ?',
-            conn,
-            params=(customer_id,)
-        )
-        conn.close()
-        return df.iloc[0].to_dict() if not df.empty else None
+        with self.connection() as conn:
+            df = pd.read_sql_query(
+                'SELECT * FROM customers WHERE id = ?',
+                conn,
+                params=(customer_id,)
+            )
+            return df.iloc[0].to_dict() if not df.empty else None
     
     def update_customer(self, customer_id, account_no, name, phone, address=""):
         """Update customer details"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'UPDATE customers SET account_no=?, name=?, phone=?, address=? WHERE id=?',
-            (account_no, name, phone, address, customer_id)
-        )
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'UPDATE customers SET account_no=?, name=?, phone=?, address=? WHERE id=?',
+                (account_no, name, phone, address, customer_id)
+            )
+            conn.commit()
     
     def delete_customer(self, customer_id):
         """Delete customer and related invoices"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Get invoice IDs
-        cursor.execute('SELECT id FROM invoices WHERE customer_id=?', (customer_id,))
-        invoice_ids = [row[0] for row in cursor.fetchall()]
-        
-        # Delete invoice items
-        for invoice_id in invoice_ids:
-            cursor.execute('DELETE FROM invoice_items WHERE invoice_id=?', (invoice_id,))
-        
-        # Delete invoices
-        cursor.execute('DELETE FROM invoices WHERE customer_id=?', (customer_id,))
-        
-        # Delete customer
-        cursor.execute('DELETE FROM customers WHERE id=?', (customer_id,))
-        
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            # Get invoice IDs
+            cursor.execute('SELECT id FROM invoices WHERE customer_id=?', (customer_id,))
+            invoice_ids = [row[0] for row in cursor.fetchall()]
+            removed_totals = self._invoice_day_totals(cursor, 'customer_id = ?', (customer_id,))
+            
+            # Delete invoice items
+            for invoice_id in invoice_ids:
+                cursor.execute('DELETE FROM invoice_items WHERE invoice_id=?', (invoice_id,))
+            
+            # Delete invoices
+            cursor.execute('DELETE FROM invoices WHERE customer_id=?', (customer_id,))
+            
+            # Delete customer
+            cursor.execute('DELETE FROM customers WHERE id=?', (customer_id,))
+            customers_removed = cursor.rowcount
+            
+            conn.commit()
+        rollups.record_invoices(self.db_path, removed_totals, sign=-1)
+        rollups.record_customers(self.db_path, -customers_removed)
     
     # Invoice operations
     def save_invoice(self, customer_id, invoice_no, items, cgst_percent, sgst_percent, discount_percent=0):
@@ -435,278 +489,565 @@ class Database:
         if not items:
             raise ValueError("Invoice must have at least one item")
         
-        # Calculate totals
-        subtotal = sum(item['line_total'] for item in items)
-        discount_amount = subtotal * (discount_percent / 100)
-        taxable_amount = subtotal - discount_amount
-        cgst_amount = taxable_amount * (cgst_percent / 100)
-        sgst_amount = taxable_amount * (sgst_percent / 100)
-        total = taxable_amount + cgst_amount + sgst_amount
-        
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Insert invoice
-        cursor.execute('''
-            INSERT INTO invoices (
-                invoice_no, customer_id, date, subtotal, cgst_percent, sgst_percent,
-                cgst_amount, sgst_amount, discount_percent, discount_amount, total
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            invoice_no, customer_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            subtotal, cgst_percent, sgst_percent, cgst_amount, sgst_amount,
-            discount_percent, discount_amount, total
-        ))
-        
-        invoice_id = cursor.lastrowid
+        # Calculate totals in integer paise
+        subtotal, discount_amount, cgst_amount, sgst_amount, total = _invoice_amounts(
+            items, discount_percent, cgst_percent, sgst_percent
+        )
         
-        # Insert invoice items
-        for idx, item in enumerate(items, start=1):
+        invoice_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        # Ids taken from a DataFrame are numpy integers, which sqlite3 would store as blobs
+        customer_id = int(customer_id)
+
+        with self.connection() as conn:
+            cursor = conn.cursor()
+
+            # Insert invoice
             cursor.execute('''
-                INSERT INTO invoice_items (
-                    invoice_id, item_no, metal, weight, rate, wastage_percent,
-                    making_percent, item_value, wastage_amount, making_amount, line_total
+                INSERT INTO invoices (
+                    invoice_no, customer_id, date, subtotal, cgst_percent, sgst_percent,
+                    cgst_amount, sgst_amount, discount_percent, discount_amount, total
                 ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', (
-                invoice_id, idx, item['metal'], item['weight'], item['rate'],
-                item['wastage_percent'], item['making_percent'], item['item_value'],
-                item['wastage_amount'], item['making_amount'], item['line_total']
+                invoice_no, customer_id, invoice_date,
+                subtotal, cgst_percent, sgst_percent, cgst_amount, sgst_amount,
+                discount_percent, discount_amount, total
             ))
-        
-        conn.commit()
-        conn.close()
+            
+            invoice_id = cursor.lastrowid
+            
+            # Insert invoice items
+            for idx, item in enumerate(items, start=1):
+                cursor.execute('''
+                    INSERT INTO invoice_items (
+                        invoice_id, item_no, metal, weight, rate, wastage_percent,
+                        making_percent, item_value, wastage_amount, making_amount, line_total
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (
+                    invoice_id, idx, item['metal'], item['weight'], item['rate'],
+                    item['wastage_percent'], item['making_percent'], item['item_value'],
+                    item['wastage_amount'], item['making_amount'], item['line_total']
+                ))
+            
+            conn.commit()
+        rollups.record_invoices(self.db_path, [(
+            invoice_date[:10], 1, subtotal, discount_amount, cgst_amount, sgst_amount, total
+        )])
         return invoice_no
     
-    def get_invoices(self):
-        """Get all invoices as DataFrame"""
-        conn = self.get_connection()
-        df = pd.read_sql_query('''
+    def _invoice_list_query(self, limit=None, before=None, search=None, start_date=None, end_date=None):
+        """Build the invoice list query shared by get_invoices and iter_invoices"""
+        columns = f'''
             SELECT 
-                i.id, i.invoice_no, i.date, i.total,
+                i.id, i.invoice_no, i.date, {INVOICE_ORDER_SQL} AS sort_ts, i.total,
                 c.name as customer_name, c.phone as customer_phone, c.account_no
+        '''
+        query = columns + '''
             FROM invoices i
             LEFT JOIN customers c ON i.customer_id = c.id
-            ORDER BY i.date DESC
-        ''', conn)
-        conn.close()
-        return df
+        '''
+        conditions = []
+        params = []
+        tokens = search.split() if search else []
+        
+        # Every token must appear in the invoice number or the customer's name, phone or
+        # account number. Tokens of 3+ characters are looked up in the trigram indexes and
+        # only the matching invoices are read; shorter ones filter those rows with LIKE.
+        indexed_tokens = [token for token in tokens if len(token) >= 3]
+        if indexed_tokens:
+            matches = []
+            for token in indexed_tokens:
+                matches.append('''
+                    SELECT id FROM (
+                        SELECT rowid AS id FROM invoices_fts WHERE invoices_fts MATCH ?
+                        UNION
+                        SELECT m.id FROM customers_fts f JOIN invoices m ON m.customer_id = f.rowid
+                        WHERE customers_fts MATCH ?
+                    )
+                ''')
+                params.extend([_fts_phrase(token), '{name phone account_no} : ' + _fts_phrase(token)])
+            query = 'WITH matches(id) AS (' + ' INTERSECT '.join(matches) + ')' + columns + '''
+                FROM matches
+                JOIN invoices i ON i.id = matches.id
+                LEFT JOIN customers c ON i.customer_id = c.id
+            '''
+        for token in tokens:
+            if len(token) < 3:
+                pattern = '%' + _like_escape(token) + '%'
+                conditions.append("(i.invoice_no LIKE ? ESCAPE '\\' OR c.name LIKE ? ESCAPE '\\' "
+                                  "OR c.phone LIKE ? ESCAPE '\\')")
+                params.extend([pattern, pattern, pattern])
+        
+        if before is not None:
+            # Spelled out: SQLite only seeks an expression index for a plain comparison
+            conditions.append(f'{INVOICE_ORDER_SQL} <= ? AND ({INVOICE_ORDER_SQL} < ? OR i.id < ?)')
+            params.extend([int(before[0]), int(before[0]), int(before[1])])
+        if start_date:
+            conditions.append(f'i.date_ts >= {EPOCH_PARAM}')
+            params.append(start_date)
+        if end_date:
+            conditions.append(f'i.date_ts < {EPOCH_PARAM}')
+            params.append(end_date)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        
+        query += f' ORDER BY {INVOICE_ORDER_SQL} DESC, i.id DESC'
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(int(limit))
+        return query, params
+    
+    def get_invoices(self, limit=None, before=None, search=None, start_date=None, end_date=None):
+        """Get invoices as DataFrame, newest first.
+        For keyset pagination pass a page size as limit, and the (sort_ts, id) of the
+        last row of the previous page as before. search matches invoice number,
+        customer name, phone or account number (case-insensitive substrings, every
+        word must match); start_date/end_date bound the date (end exclusive)."""
+        query, params = self._invoice_list_query(limit, before, search, start_date, end_date)
+        with self.connection() as conn:
+            df = pd.read_sql_query(query, conn, params=params if params else None)
+            return df
+    
+    def iter_invoices(self, limit=None, before=None, search=None, start_date=None, end_date=None):
+        """Like get_invoices, but yields dict rows lazily from an open cursor"""
+        query, params = self._invoice_list_query(limit, before, search, start_date, end_date)
+        with self.connection() as conn:
+            cursor = conn.execute(query, params)
+            columns = [d[0] for d in cursor.description]
+            for row in cursor:
+                yield dict(zip(columns, row))
+    
+    def _invoice_day_totals(self, cursor, where, params):
+        """Per-day invoice count and amount sums for the invoices matching where (for rollups)"""
+        cursor.execute(f'''
+            SELECT COALESCE(date(date_ts, 'unixepoch'), ''), COUNT(*), SUM(subtotal_paise) / 100.0,
+                   SUM(discount_paise) / 100.0, SUM(cgst_paise) / 100.0, SUM(sgst_paise) / 100.0,
+                   SUM(total_paise) / 100.0
+            FROM invoices
+            WHERE {where}
+            GROUP BY 1
+        ''', params)
+        return cursor.fetchall()
     
     def get_invoice_by_number(self, invoice_no):
         """Get invoice details by invoice number"""
-        conn = self.get_connection()
-        
-        # Get invoice
-        invoice_df = pd.read_sql_query(
-            'SELECT * FROM invoices WHERE invoice_no = ?',
-            conn,
-            params=(invoice_no,)
-        )
-        
-        if invoice_df.empty:
-            conn.close()
-            return None, None, None
-        
-        invoice = invoice_df.iloc[0].to_dict()
-        
-        # Get invoice items
-        items_df = pd.read_sql_query(
-            'SELECT * FROM invoice_items WHERE invoice_id = ? ORDER BY item_no',
-            conn,
-            params=(invoice['id'],)
-        )
-        
-        # Get customer
-        customer_df = pd.read_sql_query(
-            'SELECT * FROM customers WHERE id = ?',
-            conn,
-            params=(invoice['customer_id'],)
-        )
-        
-        customer = customer_df.iloc[0].to_dict() if not customer_df.empty else None
-        
-        conn.close()
-        return invoice, items_df, customer
+        with self.connection() as conn:
+            
+            # Get invoice
+            invoice_df = pd.read_sql_query(
+                'SELECT * FROM invoices WHERE invoice_no = ?',
+                conn,
+                params=(invoice_no,)
+            )
+            
+            if invoice_df.empty:
+                return None, None, None
+            
+            invoice = invoice_df.iloc[0].to_dict()
+            
+            # Get invoice items
+            items_df = pd.read_sql_query(
+                'SELECT * FROM invoice_items WHERE invoice_id = ? ORDER BY item_no',
+                conn,
+                params=(invoice['id'],)
+            )
+            
+            # Get customer
+            customer_df = pd.read_sql_query(
+                'SELECT * FROM customers WHERE id = ?',
+                conn,
+                params=(invoice['customer_id'],)
+            )
+            
+            customer = customer_df.iloc[0].to_dict() if not customer_df.empty else None
+            
+            return invoice, items_df, customer
+    
+    def get_invoice_by_id(self, invoice_id):
+        """Get invoice details by invoice ID"""
+        details = self.get_invoice_details(invoice_ids=[invoice_id])
+        return details.get(int(invoice_id), (None, None, None))
+    
+    def get_invoice_details(self, invoice_ids=None, invoice_nos=None):
+        """Get headers, items and customers for many invoices at once.
+        Uses one query per table (per chunk of IDs) instead of three per invoice.
+        Returns a dict of invoice_id -> (invoice, items_df, customer)."""
+        with self.connection() as conn:
+            if invoice_ids is not None:
+                invoices_df = _select_in(conn, 'SELECT * FROM invoices WHERE id IN ({})',
+                                         [int(i) for i in invoice_ids])
+            else:
+                invoices_df = _select_in(conn, 'SELECT * FROM invoices WHERE invoice_no IN ({})',
+                                         list(invoice_nos or []))
+            
+            if invoices_df.empty:
+                return {}
+            
+            ids = [int(i) for i in invoices_df['id']]
+            items_df = _select_in(
+                conn, 'SELECT * FROM invoice_items WHERE invoice_id IN ({}) ORDER BY invoice_id, item_no', ids
+            )
+            customer_ids = sorted({int(c) for c in invoices_df['customer_id']})
+            customers_df = _select_in(conn, 'SELECT * FROM customers WHERE id IN ({})', customer_ids)
+        
+        items_by_invoice = {int(k): g.reset_index(drop=True) for k, g in items_df.groupby('invoice_id')}
+        customers = {int(row['id']): row for row in customers_df.to_dict('records')}
+        
+        details = {}
+        for invoice in invoices_df.to_dict('records'):
+            invoice_id = int(invoice['id'])
+            invoice_items = items_by_invoice.get(invoice_id, items_df.iloc[0:0])
+            details[invoice_id] = (invoice, invoice_items, customers.get(int(invoice['customer_id'])))
+        return details
     
     def update_invoice(self, invoice_id, items, cgst_percent, sgst_percent, discount_percent=0):
         """Update an existing invoice"""
         if not items:
             raise ValueError("Invoice must have at least one item")
         
-        # Calculate totals
-        subtotal = sum(item['line_total'] for item in items)
-        discount_amount = subtotal * (discount_percent / 100)
-        taxable_amount = subtotal - discount_amount
-        cgst_amount = taxable_amount * (cgst_percent / 100)
-        sgst_amount = taxable_amount * (sgst_percent / 100)
-        total = taxable_amount + cgst_amount + sgst_amount
-        
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Update invoice
-        cursor.execute('''
-            UPDATE invoices SET
-                subtotal=?, cgst_percent=?, sgst_percent=?,
-                cgst_amount=?, sgst_amount=?, discount_percent=?, discount_amount=?, total=?
-            WHERE id=?
-        ''', (
-            subtotal, cgst_percent, sgst_percent, cgst_amount, sgst_amount,
-            discount_percent, discount_amount, total, invoice_id
-        ))
-        
-        # Delete existing items
-        cursor.execute('DELETE FROM invoice_items WHERE invoice_id=?', (invoice_id,))
+        # Calculate totals in integer paise
+        subtotal, discount_amount, cgst_amount, sgst_amount, total = _invoice_amounts(
+            items, discount_percent, cgst_percent, sgst_percent
+        )
         
-        # Insert new items
-        for idx, item in enumerate(items, start=1):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            old_totals = self._invoice_day_totals(cursor, 'id = ?', (invoice_id,))
+            
+            # Update invoice
             cursor.execute('''
-                INSERT INTO invoice_items (
-                    invoice_id, item_no, metal, weight, rate, wastage_percent,
-                    making_percent, item_value, wastage_amount, making_amount, line_total
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                UPDATE invoices SET
+                    subtotal=?, cgst_percent=?, sgst_percent=?,
+                    cgst_amount=?, sgst_amount=?, discount_percent=?, discount_amount=?, total=?
+                WHERE id=?
             ''', (
-                invoice_id, idx, item['metal'], item['weight'], item['rate'],
-                item['wastage_percent'], item['making_percent'], item['item_value'],
-                item['wastage_amount'], item['making_amount'], item['line_total']
+                subtotal, cgst_percent, sgst_percent, cgst_amount, sgst_amount,
+                discount_percent, discount_amount, total, invoice_id
             ))
-        
-        conn.commit()
-        conn.close()
+            
+            # Delete existing items
+            cursor.execute('DELETE FROM invoice_items WHERE invoice_id=?', (invoice_id,))
+            
+            # Insert new items
+            for idx, item in enumerate(items, start=1):
+                cursor.execute('''
+                    INSERT INTO invoice_items (
+                        invoice_id, item_no, metal, weight, rate, wastage_percent,
+                        making_percent, item_value, wastage_amount, making_amount, line_total
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (
+                    invoice_id, idx, item['metal'], item['weight'], item['rate'],
+                    item['wastage_percent'], item['making_percent'], item['item_value'],
+                    item['wastage_amount'], item['making_amount'], item['line_total']
+                ))
+            
+            new_totals = self._invoice_day_totals(cursor, 'id = ?', (invoice_id,))
+            conn.commit()
+        rollups.record_invoices(self.db_path, old_totals, sign=-1)
+        rollups.record_invoices(self.db_path, new_totals)
     
     def delete_invoice(self, invoice_id):
         """Delete an invoice and its items"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Delete invoice items first (foreign key constraint)
-        cursor.execute('DELETE FROM invoice_items WHERE invoice_id=?', (invoice_id,))
-        
-        # Delete invoice
-        cursor.execute('DELETE FROM invoices WHERE id=?', (invoice_id,))
-        
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            removed_totals = self._invoice_day_totals(cursor, 'id = ?', (invoice_id,))
+            
+            # Delete invoice items first (foreign key constraint)
+            cursor.execute('DELETE FROM invoice_items WHERE invoice_id=?', (invoice_id,))
+            
+            # Delete invoice
+            cursor.execute('DELETE FROM invoices WHERE id=?', (invoice_id,))
+            
+            conn.commit()
+        rollups.record_invoices(self.db_path, removed_totals, sign=-1)
     
     # Import/Export operations
     def export_customers_csv(self):
         """Export customers to CSV format"""
-        conn = self.get_connection()
-        df = pd.read_sql_query('SELECT * FROM customers', conn)
-        conn.close()
-        return df.to_csv(index=False)
-    
-    def import_customers_csv(self, csv_content):
-        """Import customers from CSV content"""
-        df = pd.read_csv(StringIO(csv_content))
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        imported = 0
-        errors = []
-        
-        for _, row in df.iterrows():
-            try:
-                cursor.execute(
-                    'INSERT INTO customers (account_no, name, phone, address) VALUES (?, ?, ?, ?)',
-                    (row.get('account_no', ''), row.get('name', ''), 
-                     row.get('phone', ''), row.get('address', ''))
-                )
-                imported += 1
-            except sqlite3.IntegrityError as e:
-                errors.append(f"Row {_ + 1}: {str(e)}")
-        
-        conn.commit()
-        conn.close()
-        return imported, errors
+        with self.connection() as conn:
+            df = pd.read_sql_query('SELECT * FROM customers', conn)
+            return df.to_csv(index=False)
     
-    def export_invoices_json(self):
-        """Export all invoices with items to JSON format"""
-        conn = self.get_connection()
-        
-        # Get all invoices
-        invoices_df = pd.read_sql_query('SELECT * FROM invoices', conn)
-        
-        export_data = []
-        for _, invoice_row in invoices_df.iterrows():
-            invoice_dict = invoice_row.to_dict()
+    def import_customers_csv(self, csv_content, mode='skip', chunksize=5000):
+        """Import customers from CSV content (a string or file object).
+        Rows are read in chunks and validated up front; conflicts with existing customers
+        (same phone) are skipped in 'skip' mode or updated in place in 'upsert' mode.
+        Blank account numbers are assigned the next free CUS-xxxxx number.
+        Returns (customers added, customers updated, errors)."""
+        if mode not in ('skip', 'upsert'):
+            raise ValueError("mode must be 'skip' or 'upsert'")
+        source = StringIO(csv_content) if isinstance(csv_content, str) else csv_content
+        
+        with self.connection() as conn:
+            cursor = conn.cursor()
             
-            # Get items for this invoice
-            items_df = pd.read_sql_query(
-                'SELECT * FROM invoice_items WHERE invoice_id = ?',
-                conn,
-                params=(invoice_dict['id'],)
-            )
-            invoice_dict['items'] = items_df.to_dict('records')
+            # Set/dict lookups for conflicts against the database and earlier rows of the file
+            phone_to_customer = {}
+            account_to_phone = {}
+            for customer_id, account_no, phone in cursor.execute('SELECT id, account_no, phone FROM customers'):
+                phone_to_customer[str(phone)] = (customer_id, account_no)
+                if account_no:
+                    account_to_phone[account_no] = str(phone)
+            next_account = int(generate_account_number(account_to_phone)[len('CUS-'):])
+            seen_phones = set()
+            seen_accounts = set()
             
-            # Get customer info
-            customer_df = pd.read_sql_query(
-                'SELECT * FROM customers WHERE id = ?',
-                conn,
-                params=(invoice_dict['customer_id'],)
-            )
-            if not customer_df.empty:
-                invoice_dict['customer'] = customer_df.iloc[0].to_dict()
+            imported = 0
+            updated = 0
+            errors = []
             
-            export_data.append(invoice_dict)
-        
-        conn.close()
-        return json.dumps(export_data, indent=2, default=str)
-    
-    def import_invoices_json(self, json_content):
-        """Import invoices from JSON content"""
-        data = json.loads(json_content)
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        imported = 0
-        errors = []
-        
-        for idx, invoice_data in enumerate(data):
             try:
-                # Check if customer exists
-                customer_id = invoice_data.get('customer_id')
-                cursor.execute('SELECT id FROM customers WHERE id = ?', (customer_id,))
-                if not cursor.fetchone():
-                    errors.append(f"Invoice {idx + 1}: Customer ID {customer_id} not found")
-                    continue
+                chunks = pd.read_csv(source, dtype=str, keep_default_na=False, chunksize=chunksize)
+            except pd.errors.EmptyDataError:
+                return 0, 0, []
+            
+            for chunk in chunks:
+                chunk = chunk.reindex(columns=['account_no', 'name', 'phone', 'address'], fill_value='')
+                chunk = chunk.apply(lambda column: column.str.strip())
                 
-                # Insert invoice
-                cursor.execute('''
-                    INSERT INTO invoices (
-                        invoice_no, customer_id, date, subtotal, cgst_percent, sgst_percent,
-                        cgst_amount, sgst_amount, discount_percent, discount_amount, total
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    invoice_data['invoice_no'], customer_id, invoice_data['date'],
-                    invoice_data['subtotal'], invoice_data['cgst_percent'], 
-                    invoice_data['sgst_percent'], invoice_data['cgst_amount'], 
-                    invoice_data['sgst_amount'], invoice_data.get('discount_percent', 0),
-                    invoice_data.get('discount_amount', 0), invoice_data['total']
-                ))
+                # Vectorized format checks
+                bad_phone = ~validate_phones(chunk['phone'])
+                no_name = chunk['name'] == ''
                 
-                invoice_id = cursor.lastrowid
+                # Restored if the chunk fails to load, so its rows don't block later ones
+                lookups = (set(seen_phones), set(seen_accounts), dict(account_to_phone), next_account)
+                inserts = []
+                updates = []
+                for row_idx, account_no, name, phone, address, phone_invalid, name_missing in zip(
+                    chunk.index, chunk['account_no'], chunk['name'], chunk['phone'], chunk['address'],
+                    bad_phone, no_name
+                ):
+                    row_label = f"Row {row_idx + 1}"
+                    if phone_invalid:
+                        errors.append(f"{row_label}: Invalid phone '{phone}' (must be 10 digits)")
+                        continue
+                    if name_missing:
+                        errors.append(f"{row_label}: Name is required")
+                        continue
+                    if phone in seen_phones:
+                        errors.append(f"{row_label}: Duplicate phone {phone} in file")
+                        continue
+                    if account_no and account_no in seen_accounts:
+                        errors.append(f"{row_label}: Duplicate account number {account_no} in file")
+                        continue
+                    if account_no and account_to_phone.get(account_no, phone) != phone:
+                        errors.append(f"{row_label}: Account number {account_no} belongs to another customer")
+                        continue
+                    seen_phones.add(phone)
+                    
+                    existing = phone_to_customer.get(phone)
+                    if existing is not None:
+                        if mode == 'skip':
+                            errors.append(f"{row_label}: Phone {phone} already exists (skipped)")
+                            continue
+                        customer_id, existing_account = existing
+                        account_no = account_no or existing_account
+                        if account_no:
+                            seen_accounts.add(account_no)
+                            account_to_phone[account_no] = phone
+                        updates.append((account_no, name, address, customer_id))
+                        continue
+                    
+                    if not account_no:
+                        while f"CUS-{next_account:05d}" in account_to_phone:
+                            next_account += 1
+                        account_no = f"CUS-{next_account:05d}"
+                        next_account += 1
+                    seen_accounts.add(account_no)
+                    account_to_phone[account_no] = phone
+                    inserts.append((account_no, name, phone, address))
                 
-                # Insert items
-                for item in invoice_data.get('items', []):
-                    cursor.execute('''
-                        INSERT INTO invoice_items (
-                            invoice_id, item_no, metal, weight, rate, wastage_percent,
-                            making_percent, item_value, wastage_amount, making_amount, line_total
-                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    ''', (
-                        invoice_id, item['item_no'], item['metal'], item['weight'],
-                        item['rate'], item['wastage_percent'], item['making_percent'],
-                        item['item_value'], item['wastage_amount'], item['making_amount'],
-                        item['line_total']
-                    ))
+                # Load the chunk as one unit; a failure leaves none of it behind
+                if not conn.in_transaction:
+                    cursor.execute('BEGIN')
+                cursor.execute('SAVEPOINT import_customers')
+                try:
+                    cursor.executemany(
+                        'INSERT INTO customers (account_no, name, phone, address) VALUES (?, ?, ?, ?)', inserts
+                    )
+                    cursor.executemany('UPDATE customers SET account_no=?, name=?, address=? WHERE id=?', updates)
+                except sqlite3.IntegrityError as e:
+                    cursor.execute('ROLLBACK TO import_customers')
+                    cursor.execute('RELEASE import_customers')
+                    errors.append(f"Rows {chunk.index[0] + 1}-{chunk.index[-1] + 1}: {str(e)}")
+                    seen_phones, seen_accounts, account_to_phone, next_account = lookups
+                    continue
+                cursor.execute('RELEASE import_customers')
+                conn.commit()
+                rollups.record_customers(self.db_path, len(inserts))
+                imported += len(inserts)
+                updated += len(updates)
+            
+            return imported, updated, errors
+    
+    def iter_invoice_records(self):
+        """Yield every invoice as a dict with its 'items' list and 'customer' dict.
+        Uses two ordered queries merged in step, so memory stays flat however many invoices exist."""
+        with self.connection() as conn:
+            customer_columns = [row[1] for row in conn.execute('PRAGMA table_info(customers)')]
+            customer_select = ', '.join(f'customers.{c} AS "customer.{c}"' for c in customer_columns)
+            invoices_cursor = conn.execute(f'''
+                SELECT invoices.*, {customer_select}
+                FROM invoices
+                LEFT JOIN customers ON customers.id = invoices.customer_id
+                ORDER BY invoices.id
+            ''')
+            items_cursor = conn.execute('SELECT * FROM invoice_items ORDER BY invoice_id, item_no')
+            
+            invoice_columns = [d[0] for d in invoices_cursor.description]
+            item_columns = [d[0] for d in items_cursor.description]
+            invoice_id_pos = item_columns.index('invoice_id')
+            item = items_cursor.fetchone()
+            
+            for row in invoices_cursor:
+                invoice = {}
+                customer = {}
+                for column, value in zip(invoice_columns, row):
+                    if column.startswith('customer.'):
+                        customer[column[len('customer.'):]] = value
+                    else:
+                        invoice[column] = value
                 
-                imported += 1
-            except Exception as e:
-                errors.append(f"Invoice {idx + 1}: {str(e)}")
-        
-        conn.commit()
-        conn.close()
-        return imported, errors
+                # Both cursors are ordered by invoice id; skip orphaned items
+                items = []
+                while item is not None and item[invoice_id_pos] <= invoice['id']:
+                    if item[invoice_id_pos] == invoice['id']:
+                        items.append(dict(zip(item_columns, item)))
+                    item = items_cursor.fetchone()
+                invoice['items'] = items
+                
+                if customer.get('id') is not None:
+                    invoice['customer'] = customer
+                yield invoice
+    
+    def iter_invoices_json(self):
+        """Yield the JSON export of all invoices in chunks of text"""
+        first = True
+        yield '['
+        for invoice in self.iter_invoice_records():
+            yield ('\n' if first else ',\n') + json.dumps(invoice, indent=2, default=str)
+            first = False
+        yield '\n]' if not first else ']'
+    
+    def export_invoices_json(self, fileobj=None):
+        """Export all invoices with items to JSON format.
+        Streams into fileobj (a text file) if given, otherwise returns the JSON string."""
+        if fileobj is None:
+            return ''.join(self.iter_invoices_json())
+        for chunk in self.iter_invoices_json():
+            fileobj.write(chunk)
+        return fileobj
+    
+    def iter_invoices_ndjson(self):
+        """Yield the NDJSON export of all invoices, one invoice (with items and customer) per line"""
+        for invoice in self.iter_invoice_records():
+            yield json.dumps(invoice, default=str) + '\n'
+    
+    def export_invoices_ndjson(self, fileobj=None):
+        """Export all invoices as newline-delimited JSON.
+        Streams into fileobj (a text file) if given, otherwise returns the NDJSON string."""
+        if fileobj is None:
+            return ''.join(self.iter_invoices_ndjson())
+        for line in self.iter_invoices_ndjson():
+            fileobj.write(line)
+        return fileobj
+    
+    def _import_invoice_records(self, records, batch_size, label):
+        """Insert (number, invoice_data) pairs, committing every batch_size invoices.
+        Each invoice goes in under a savepoint so a bad record leaves nothing behind."""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            customer_ids = {row[0] for row in cursor.execute('SELECT id FROM customers')}
+            
+            imported = 0
+            errors = []
+            pending = []  # Day totals of imported invoices not yet committed
+            
+            for number, invoice_data in records:
+                if isinstance(invoice_data, Exception):
+                    errors.append(f"{label} {number}: {str(invoice_data)}")
+                    continue
+                try:
+                    # Check if customer exists
+                    customer_id = invoice_data.get('customer_id')
+                    if customer_id not in customer_ids:
+                        errors.append(f"{label} {number}: Customer ID {customer_id} not found")
+                        continue
+                    
+                    if not conn.in_transaction:
+                        cursor.execute('BEGIN')  # Keep the savepoint nested so RELEASE doesn't commit
+                    cursor.execute('SAVEPOINT import_invoice')
+                    try:
+                        # Insert invoice
+                        cursor.execute('''
+                            INSERT INTO invoices (
+                                invoice_no, customer_id, date, subtotal, cgst_percent, sgst_percent,
+                                cgst_amount, sgst_amount, discount_percent, discount_amount, total
+                            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        ''', (
+                            invoice_data['invoice_no'], customer_id, invoice_data['date'],
+                            invoice_data['subtotal'], invoice_data['cgst_percent'], 
+                            invoice_data['sgst_percent'], invoice_data['cgst_amount'], 
+                            invoice_data['sgst_amount'], invoice_data.get('discount_percent', 0),
+                            invoice_data.get('discount_amount', 0), invoice_data['total']
+                        ))
+                        
+                        invoice_id = cursor.lastrowid
+                        
+                        # Insert items
+                        cursor.executemany('''
+                            INSERT INTO invoice_items (
+                                invoice_id, item_no, metal, weight, rate, wastage_percent,
+                                making_percent, item_value, wastage_amount, making_amount, line_total
+                            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        ''', [(
+                            invoice_id, item['item_no'], item['metal'], item['weight'],
+                            item['rate'], item['wastage_percent'], item['making_percent'],
+                            item['item_value'], item['wastage_amount'], item['making_amount'],
+                            item['line_total']
+                        ) for item in _price_missing_amounts(invoice_data.get('items', []))])
+                    except Exception:
+                        cursor.execute('ROLLBACK TO import_invoice')
+                        cursor.execute('RELEASE import_invoice')
+                        raise
+                    cursor.execute('RELEASE import_invoice')
+                    
+                    imported += 1
+                    # Bucket by the stored date_ts, like the per-file daily_sales_paise
+                    pending.extend(self._invoice_day_totals(cursor, 'id = ?', (invoice_id,)))
+                    if len(pending) >= batch_size:
+                        conn.commit()
+                        rollups.record_invoices(self.db_path, pending)
+                        pending = []
+                except Exception as e:
+                    errors.append(f"{label} {number}: {str(e)}")
+            
+            conn.commit()
+            rollups.record_invoices(self.db_path, pending)
+            return imported, errors
+    
+    def import_invoices_json(self, json_content, batch_size=1000):
+        """Import invoices from JSON content"""
+        data = json.loads(json_content)
+        return self._import_invoice_records(enumerate(data, start=1), batch_size, 'Invoice')
+    
+    def import_invoices_ndjson(self, lines, batch_size=1000):
+        """Import invoices from newline-delimited JSON.
+        lines can be any iterable of str/bytes lines (e.g. an open file or upload); it is read one line at a time."""
+        def records():
+            for line_no, line in enumerate(lines, start=1):
+                if isinstance(line, bytes):
+                    line = line.decode('utf-8')
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    if not isinstance(record, dict):
+                        raise ValueError("expected a JSON object")
+                except ValueError as e:
+                    record = ValueError(f"Invalid JSON: {e}")
+                yield line_no, record
+        
+        return self._import_invoice_records(records(), batch_size, 'Line')
     
     def export_database(self, target_path):
         """Export entire database to another file"""
@@ -717,339 +1058,508 @@ class Database:
     def import_database(self, source_path):
         """Import database from another file"""
         import shutil
+        # Drop pooled connections to the old file before overwriting it
+        close_pool(self.db_path)
         shutil.copy2(source_path, self.db_path)
-        self._init_database()  # Ensure tables exist
+        ensure_schema(self.db_path, force=True)  # Restored file may be on an older schema
+        self._forget_settings()
+        rollups.rebuild_tenant(self.db_path)
         return True
     
     # Settings operations for persistent storage
+    def _settings_snapshot(self):
+        """The cached {key: value} settings of this file, reloaded only when the version moved"""
+        path = os.path.abspath(self.db_path)
+        file_id = file_identity(self.db_path)
+        with self.connection() as conn:
+            # Read the version first: a write landing in between only costs an extra reload later
+            version = conn.execute('SELECT version FROM settings_version WHERE id = 1').fetchone()[0]
+            cached = _settings_cache.get(path)
+            if cached and cached[:2] == (file_id, version):
+                return cached[2]
+            settings = {key: json.loads(value) for key, value in conn.execute('SELECT key, value FROM settings')}
+        with _settings_lock:
+            _settings_cache[path] = (file_id, version, settings)
+        return settings
+    
+    def _forget_settings(self):
+        """Drop the cached settings (the file was replaced in place)"""
+        with _settings_lock:
+            _settings_cache.pop(os.path.abspath(self.db_path), None)
+    
+    def get_settings(self):
+        """Get every setting as a {key: value} dict"""
+        return copy.deepcopy(self._settings_snapshot())
+    
+    def save_settings(self, settings):
+        """Save several settings in one transaction"""
+        with self.connection() as conn:
+            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            # Values are stored as JSON strings
+            conn.executemany(
+                'INSERT OR REPLACE INTO settings (key, value, updated_at) VALUES (?, ?, ?)',
+                [(key, json.dumps(value), now) for key, value in settings.items()]
+            )
+            conn.commit()
+    
     def save_setting(self, key, value):
         """Save a setting to the database"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        # Convert value to JSON string for storage
-        value_json = json.dumps(value)
-        cursor.execute(
-            'INSERT OR REPLACE INTO settings (key, value, updated_at) VALUES (?, ?, ?)',
-            (key, value_json, now)
-        )
-        conn.commit()
-        conn.close()
+        self.save_settings({key: value})
     
     def get_setting(self, key, default=None):
         """Get a setting from the database"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT value FROM settings WHERE key = ?', (key,))
-        result = cursor.fetchone()
-        conn.close()
-        if result:
-            # Parse JSON string back to original type
-            return json.loads(result[0])
-        return default
+        settings = self._settings_snapshot()
+        return copy.deepcopy(settings[key]) if key in settings else default
     
     def delete_setting(self, key):
         """Delete a setting from the database"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM settings WHERE key = ?', (key,))
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM settings WHERE key = ?', (key,))
+            conn.commit()
     
     # Reporting functions
     def get_sales_report(self, start_date=None, end_date=None):
         """Get sales report for a date range"""
-        conn = self.get_connection()
+        with self.connection() as conn:
+            query = '''
+                SELECT 
+                    i.date,
+                    i.invoice_no,
+                    c.name as customer_name,
+                    c.account_no,
+                    i.subtotal,
+                    i.discount_amount,
+                    i.cgst_amount,
+                    i.sgst_amount,
+                    i.total
+                FROM invoices i
+                JOIN customers c ON i.customer_id = c.id
+            '''
+            params = []
+            if start_date and end_date:
+                query += f' WHERE i.date_ts >= {EPOCH_PARAM} AND i.date_ts < {EPOCH_PARAM}'
+                params = [start_date, end_date]
+            elif start_date:
+                query += f' WHERE i.date_ts >= {EPOCH_PARAM}'
+                params = [start_date]
+            elif end_date:
+                query += f' WHERE i.date_ts < {EPOCH_PARAM}'
+                params = [end_date]
+            
+            query += ' ORDER BY i.date_ts DESC'
+            
+            df = pd.read_sql_query(query, conn, params=params if params else None)
+            return df
+    
+    def get_sales_summary(self, start_date=None, end_date=None):
+        """Get per-day sales totals for a date range from the daily_sales_paise summary.
+        Same range semantics as get_sales_report (start inclusive, end exclusive)."""
         query = '''
-            SELECT 
-                i.date,
-                i.invoice_no,
-                c.name as customer_name,
-                c.account_no,
-                i.subtotal,
-                i.discount_amount,
-                i.cgst_amount,
-                i.sgst_amount,
-                i.total
-            FROM invoices i
-            JOIN customers c ON i.customer_id = c.id
+            SELECT day, invoice_count, subtotal_paise / 100.0 as subtotal, discount_paise / 100.0 as discount_amount,
+                   cgst_paise / 100.0 as cgst_amount, sgst_paise / 100.0 as sgst_amount, total_paise / 100.0 as total
+            FROM daily_sales_paise
         '''
+        conditions = []
         params = []
-        if start_date and end_date:
-            query += ' WHERE i.date >= ? AND i.date < ?'
-            params = [start_date, end_date]
-        elif start_date:
-            query += ' WHERE i.date >= ?'
-            params = [start_date]
-        elif end_date:
-            query += ' WHERE i.date < ?'
-            params = [end_date]
-        
-        query += ' ORDER BY i.date DESC'
-        
-        df = pd.read_sql_query(query, conn, params=params if params else None)
-        conn.close()
-        return df
+        if start_date:
+            conditions.append('day >= ?')
+            params.append(start_date[:10])
+        if end_date:
+            conditions.append('day < ?')
+            params.append(end_date[:10])
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY day'
+        
+        with self.connection() as conn:
+            return pd.read_sql_query(query, conn, params=params if params else None)
+    
+    def get_sales_by_period(self, period='day', start_date=None, end_date=None):
+        """Get sales totals per day, week (Monday to Sunday) or month from invoices.date_ts.
+        period_start is each bucket's first day; same range semantics as get_sales_report."""
+        bucket = SALES_PERIOD_BUCKETS[period]
+        conditions = ['date_ts IS NOT NULL']
+        params = []
+        if start_date:
+            conditions.append(f'date_ts >= {EPOCH_PARAM}')
+            params.append(start_date)
+        if end_date:
+            conditions.append(f'date_ts < {EPOCH_PARAM}')
+            params.append(end_date)
+        query = f'''
+            SELECT
+                date(({bucket}) * 86400, 'unixepoch') as period_start,
+                COUNT(*) as invoice_count,
+                SUM(subtotal_paise) / 100.0 as subtotal,
+                SUM(discount_paise) / 100.0 as discount_amount,
+                SUM(cgst_paise) / 100.0 as cgst_amount,
+                SUM(sgst_paise) / 100.0 as sgst_amount,
+                SUM(total_paise) / 100.0 as total
+            FROM invoices
+            WHERE {' AND '.join(conditions)}
+            GROUP BY {bucket}
+            ORDER BY {bucket}
+        '''
+        with self.connection() as conn:
+            return pd.read_sql_query(query, conn, params=params if params else None)
     
     def get_customer_purchase_analysis(self, customer_id=None):
-        """Get customer-wise purchase analysis"""
-        conn = self.get_connection()
-        
-        if customer_id:
-            query = '''
+        """Get customer-wise purchase analysis from the trigger-maintained customer_stats.
+        Customers without invoices have zero totals and no purchase dates."""
+        if not customer_id:
+            return self.get_top_customers()
+        with self.connection() as conn:
+            return pd.read_sql_query('''
                 SELECT 
                     c.account_no,
                     c.name,
                     c.phone,
-                    COUNT(i.id) as invoice_count,
-                    SUM(i.subtotal) as total_subtotal,
-                    SUM(i.discount_amount) as total_discount,
-                    SUM(i.total) as total_amount,
-                    MIN(i.date) as first_purchase,
-                    MAX(i.date) as last_purchase
+                    s.invoice_count,
+                    s.subtotal as total_subtotal,
+                    s.discount_amount as total_discount,
+                    s.total as total_amount,
+                    s.first_purchase,
+                    s.last_purchase
                 FROM customers c
-                LEFT JOIN invoices i ON c.id = i.customer_id
+                JOIN customer_stats s ON s.customer_id = c.id
                 WHERE c.id = ?
-                GROUP BY c.id, c.account_no, c.name, c.phone
+            ''', conn, params=(customer_id,))
+    
+    def get_top_customers(self, limit=None):
+        """Customers by lifetime spend, highest first; limit=None returns all of them"""
+        query = '''
+            SELECT 
+                c.account_no,
+                c.name,
+                c.phone,
+                s.invoice_count,
+                s.subtotal as total_subtotal,
+                s.discount_amount as total_discount,
+                s.total as total_amount,
+                s.first_purchase,
+                s.last_purchase
+            FROM customer_stats s
+            JOIN customers c ON c.id = s.customer_id
+            ORDER BY s.total DESC
+        '''
+        params = None
+        if limit is not None:
+            query += ' LIMIT ?'
+            params = (limit,)
+        with self.connection() as conn:
+            return pd.read_sql_query(query, conn, params=params)
+    
+    def get_category_report(self, start_month=None, end_month=None, exact=False):
+        """Get category (metal type) wise report.
+        Reads the trigger-maintained metal_monthly_sales rollup; start_month/end_month
+        ('YYYY-MM', inclusive) narrow it to a range of months. exact=True recomputes
+        the same figures from invoice_items instead, e.g. to verify the rollup."""
+        conditions = []
+        params = []
+        if exact:
+            conditions, params = _month_range(start_month, end_month)
+            query = '''
+                SELECT 
+                    ii.metal,
+                    COUNT(DISTINCT ii.invoice_id) as invoice_count,
+                    SUM(ii.weight) as total_weight,
+                    AVG(ii.rate) as avg_rate,
+                    SUM(ii.item_value) as total_item_value,
+                    SUM(ii.wastage_amount) as total_wastage,
+                    SUM(ii.making_amount) as total_making,
+                    SUM(ii.line_total) as total_amount
+                FROM invoice_items ii
             '''
-            params = (customer_id,)
+            if conditions:
+                query += ' LEFT JOIN invoices i ON i.id = ii.invoice_id WHERE ' + ' AND '.join(conditions)
         else:
+            if start_month:
+                conditions.append('month >= ?')
+                params.append(start_month)
+            if end_month:
+                conditions.append('month <= ?')
+                params.append(end_month)
             query = '''
                 SELECT 
-                    c.account_no,
-                    c.name,
-                    c.phone,
-                    COUNT(i.id) as invoice_count,
-                    SUM(i.subtotal) as total_subtotal,
-                    SUM(i.discount_amount) as total_discount,
-                    SUM(i.total) as total_amount,
-                    MIN(i.date) as first_purchase,
-                    MAX(i.date) as last_purchase
-                FROM customers c
-                LEFT JOIN invoices i ON c.id = i.customer_id
-                GROUP BY c.id, c.account_no, c.name, c.phone
-                ORDER BY total_amount DESC
+                    metal,
+                    SUM(invoice_count) as invoice_count,
+                    SUM(weight) as total_weight,
+                    SUM(rate_sum) / SUM(item_count) as avg_rate,
+                    SUM(item_value) as total_item_value,
+                    SUM(wastage_amount) as total_wastage,
+                    SUM(making_amount) as total_making,
+                    SUM(line_total) as total_amount
+                FROM metal_monthly_sales
             '''
-            params = None
-        
-        df = pd.read_sql_query(query, conn, params=params)
-        conn.close()
-        return df
+            if conditions:
+                query += ' WHERE ' + ' AND '.join(conditions)
+        query += '''
+            GROUP BY metal
+            ORDER BY total_amount DESC
+        '''
+        with self.connection() as conn:
+            df = pd.read_sql_query(query, conn, params=params if params else None)
+            return df
+    
+    def get_category_months(self):
+        """Months ('YYYY-MM') that have category sales, newest first"""
+        with self.connection() as conn:
+            return [row[0] for row in conn.execute(
+                "SELECT DISTINCT month FROM metal_monthly_sales WHERE month != '' ORDER BY month DESC"
+            )]
     
-    def get_category_report(self):
-        """Get category (metal type) wise report"""
-        conn = self.get_connection()
+    def get_board_rate_comparison(self, start_month=None, end_month=None):
+        """Invoiced rates against the board rate in effect on each invoice's date, per month and metal.
+        Both are weight-averaged; items sold before their metal had a board rate are left out
+        of the board average."""
+        conditions, params = _month_range(start_month, end_month)
         query = '''
-            SELECT 
-                ii.metal,
-                COUNT(DISTINCT ii.invoice_id) as invoice_count,
-                SUM(ii.weight) as total_weight,
-                AVG(ii.rate) as avg_rate,
-                SUM(ii.item_value) as total_item_value,
-                SUM(ii.wastage_amount) as total_wastage,
-                SUM(ii.making_amount) as total_making,
-                SUM(ii.line_total) as total_amount
+            SELECT ii.metal, i.date_ts, COALESCE(ii.weight, 0) AS weight, COALESCE(ii.rate, 0) AS rate
             FROM invoice_items ii
-            GROUP BY ii.metal
-            ORDER BY total_amount DESC
+            JOIN invoices i ON i.id = ii.invoice_id
+            WHERE i.date_ts IS NOT NULL
         '''
-        df = pd.read_sql_query(query, conn)
-        conn.close()
-        return df
+        if conditions:
+            query += ' AND ' + ' AND '.join(conditions)
+        with self.connection() as conn:
+            items = pd.read_sql_query(query, conn, params=params if params else None)
+        
+        board = rate_history.board_rates_asof(items['metal'], items['date_ts'], os.path.dirname(self.db_path) or '.')
+        has_board = board['board_rate'].notna()
+        items['month'] = pd.to_datetime(items['date_ts'], unit='s').dt.strftime('%Y-%m')
+        items['invoiced_value'] = items['rate'] * items['weight']
+        items['board_value'] = (board['board_rate'] * items['weight']).where(has_board, 0.0)
+        items['board_weight'] = items['weight'].where(has_board, 0.0)
+        report = items.groupby(['month', 'metal'], as_index=False).agg(
+            item_count=('rate', 'size'), total_weight=('weight', 'sum'), invoiced_value=('invoiced_value', 'sum'),
+            board_value=('board_value', 'sum'), board_weight=('board_weight', 'sum')
+        )
+        report['invoiced_rate'] = report['invoiced_value'] / report['total_weight'].where(report['total_weight'] > 0)
+        report['board_rate'] = report['board_value'] / report['board_weight'].where(report['board_weight'] > 0)
+        report['difference'] = report['invoiced_rate'] - report['board_rate']
+        report['difference_pct'] = report['difference'] / report['board_rate'] * 100
+        return report[['month', 'metal', 'item_count', 'total_weight', 'invoiced_rate', 'board_rate',
+                       'difference', 'difference_pct']]
+    
+    def reprice_invoices(self, metal_settings, start_date=None, end_date=None, metals=None, customer_id=None):
+        """What-if: the invoices matching the filters repriced at new metal_settings rates.
+        Items of the metals in metal_settings (and in metals, if given) take the new rate,
+        wastage and making; fields left out keep the item's own. Other items keep their line
+        totals, and each invoice keeps its discount and GST percents. Current and new totals
+        both go through the paise engine, so unchanged rates give a zero delta.
+        Returns (per-invoice DataFrame, summary dict), amounts in rupees."""
+        conditions = []
+        params = []
+        if start_date:
+            conditions.append(f'i.date_ts >= {EPOCH_PARAM}')
+            params.append(start_date)
+        if end_date:
+            conditions.append(f'i.date_ts < {EPOCH_PARAM}')
+            params.append(end_date)
+        if customer_id is not None:
+            conditions.append('i.customer_id = ?')
+            params.append(int(customer_id))
+        if metals:
+            conditions.append('i.id IN (SELECT invoice_id FROM invoice_items WHERE metal IN ({}))'.format(
+                ', '.join('?' * len(metals))))
+            params.extend(metals)
+        query = '''
+            SELECT
+                i.id AS invoice_id, i.invoice_no, i.date, c.name AS customer_name,
+                COALESCE(i.discount_percent, 0) AS discount_percent, i.cgst_percent, i.sgst_percent,
+                ii.metal, ii.weight, ii.rate, ii.wastage_percent, ii.making_percent,
+                ii.item_value, ii.wastage_amount, ii.making_amount, ii.line_total
+            FROM invoices i
+            JOIN invoice_items ii ON ii.invoice_id = i.id
+            LEFT JOIN customers c ON c.id = i.customer_id
+        '''
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY i.date_ts DESC, i.id, ii.item_no'
+        with self.connection() as conn:
+            items = pd.read_sql_query(query, conn, params=params if params else None)
+        
+        repriced = items['metal'].isin(list(metal_settings))
+        if metals:
+            repriced &= items['metal'].isin(list(metals))
+        new_values = {}
+        for field, column in REPRICE_FIELDS.items():
+            by_metal = pd.Series({metal: values.get(field) for metal, values in metal_settings.items()}, dtype=float)
+            new_values[column] = items['metal'].map(by_metal).where(repriced).fillna(items[column])
+        priced = calculate_item_totals_batch(
+            items['weight'], new_values['rate'], new_values['wastage_percent'], new_values['making_percent']
+        )
+        new_amounts = {field: np.where(repriced, priced[field], items[field].fillna(0)) for field in ITEM_AMOUNT_FIELDS}
+        
+        line_invoice, _ = pd.factorize(items['invoice_id'])
+        invoices = items.drop_duplicates('invoice_id')
+        percents = [invoices[column] for column in ('discount_percent', 'cgst_percent', 'sgst_percent')]
+        current = calculate_invoice_totals_batch(line_invoice, items['line_total'], *percents)
+        new = calculate_invoice_totals_batch(line_invoice, new_amounts['line_total'], *percents)
+        
+        report = invoices[['invoice_id', 'invoice_no', 'date', 'customer_name']].reset_index(drop=True)
+        report['items'] = np.bincount(line_invoice, minlength=len(report))
+        report['repriced_items'] = np.bincount(line_invoice, weights=repriced.to_numpy(), minlength=len(report)).astype(int)
+        for name, totals in (('current', current), ('new', new)):
+            report[f'{name}_subtotal'] = totals['subtotal'] / 100
+            report[f'{name}_tax'] = (totals['cgst_amount'] + totals['sgst_amount']) / 100
+            report[f'{name}_total'] = totals['total'] / 100
+        report['delta'] = (new['total'] - current['total']) / 100
+        report['delta_pct'] = report['delta'] / report['current_total'].where(report['current_total'] != 0) * 100
+        
+        summary = {
+            'invoice_count': len(report),
+            'item_count': len(items),
+            'repriced_items': int(repriced.sum()),
+        }
+        for field in ITEM_AMOUNT_FIELDS[:3]:
+            summary[f'current_{field}'] = round(float(items.loc[repriced, field].sum()), 2)
+            summary[f'new_{field}'] = round(float(new_amounts[field][repriced.to_numpy()].sum()), 2)
+        for key in ('subtotal', 'discount_amount', 'cgst_amount', 'sgst_amount', 'total'):
+            summary[f'current_{key}'] = from_paise(int(current[key].sum()))
+            summary[f'new_{key}'] = from_paise(int(new[key].sum()))
+        summary['delta'] = from_paise(int(new['total'].sum() - current['total'].sum()))
+        return report, summary
     
     def duplicate_invoice(self, invoice_id, new_invoice_no):
         """Duplicate an existing invoice with a new invoice number"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        try:
-            # Get original invoice
-            cursor.execute('SELECT * FROM invoices WHERE id = ?', (invoice_id,))
-            invoice = cursor.fetchone()
+        with self.connection() as conn:
+            cursor = conn.cursor()
             
-            if not invoice:
-                conn.close()
-                return None
-            
-            # Get invoice items
-            cursor.execute('SELECT * FROM invoice_items WHERE invoice_id = ?', (invoice_id,))
-            items = cursor.fetchall()
-            
-            # Insert new invoice with today's date
-            today = datetime.now().strftime("%Y-%m-%d")
-            cursor.execute('''
-                INSERT INTO invoices 
-                (invoice_no, customer_id, date, subtotal, cgst_percent, sgst_percent, 
-                 cgst_amount, sgst_amount, discount_percent, discount_amount, total)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                new_invoice_no,
-                invoice[2],  # customer_id (index 2)
-                today,       # new date
-                invoice[4],  # subtotal (index 4)
-                invoice[5],  # cgst_percent (index 5)
-                invoice[6],  # sgst_percent (index 6)
-                invoice[7],  # cgst_amount (index 7)
-                invoice[8],  # sgst_amount (index 8)
-                invoice[9],  # discount_percent (index 9)
-                invoice[10], # discount_amount (index 10)
-                invoice[11]  # total (index 11)
-            ))
-            
-            new_invoice_id = cursor.lastrowid
-            
-            # Copy all items to new invoice
-            # invoice_items schema: id, invoice_id, item_no, metal, weight, rate, 
-            #                       wastage_percent, making_percent, item_value, 
-            #                       wastage_amount, making_amount, line_total
-            for item in items:
+            try:
+                # Get original invoice
+                cursor.execute('SELECT * FROM invoices WHERE id = ?', (invoice_id,))
+                invoice = cursor.fetchone()
+                
+                if not invoice:
+                    return None
+                
+                # Get invoice items
+                cursor.execute('SELECT * FROM invoice_items WHERE invoice_id = ?', (invoice_id,))
+                items = cursor.fetchall()
+                
+                # Insert new invoice with today's date
+                today = datetime.now().strftime("%Y-%m-%d")
                 cursor.execute('''
-                    INSERT INTO invoice_items 
-                    (invoice_id, item_no, metal, weight, rate, wastage_percent, 
-                     making_percent, item_value, wastage_amount, making_amount, line_total)
+                    INSERT INTO invoices 
+                    (invoice_no, customer_id, date, subtotal, cgst_percent, sgst_percent, 
+                     cgst_amount, sgst_amount, discount_percent, discount_amount, total)
                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                 ''', (
-                    new_invoice_id,
-                    item[2],   # item_no (index 2)
-                    item[3],   # metal (index 3)
-                    item[4],   # weight (index 4)
-                    item[5],   # rate (index 5)
-                    item[6],   # wastage_percent (index 6)
-                    item[7],   # making_percent (index 7)
-                    item[8],   # item_value (index 8)
-                    item[9],   # wastage_amount (index 9)
-                    item[10],  # making_amount (index 10)
-                    item[11]   # line_total (index 11)
+                    new_invoice_no,
+                    invoice[2],  # customer_id (index 2)
+                    today,       # new date
+                    invoice[4],  # subtotal (index 4)
+                    invoice[5],  # cgst_percent (index 5)
+                    invoice[6],  # sgst_percent (index 6)
+                    invoice[7],  # cgst_amount (index 7)
+                    invoice[8],  # sgst_amount (index 8)
+                    invoice[9],  # discount_percent (index 9)
+                    invoice[10], # discount_amount (index 10)
+                    invoice[11]  # total (index 11)
                 ))
-            
-            conn.commit()
-            conn.close()
-            return new_invoice_id
-            
-        except Exception as e:
-            conn.rollback()
-            conn.close()
-            raise e
+                
+                new_invoice_id = cursor.lastrowid
+                
+                # Copy all items to new invoice
+                # invoice_items schema: id, invoice_id, item_no, metal, weight, rate, 
+                #                       wastage_percent, making_percent, item_value, 
+                #                       wastage_amount, making_amount, line_total
+                for item in items:
+                    cursor.execute('''
+                        INSERT INTO invoice_items 
+                        (invoice_id, item_no, metal, weight, rate, wastage_percent, 
+                         making_percent, item_value, wastage_amount, making_amount, line_total)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ''', (
+                        new_invoice_id,
+                        item[2],   # item_no (index 2)
+                        item[3],   # metal (index 3)
+                        item[4],   # weight (index 4)
+                        item[5],   # rate (index 5)
+                        item[6],   # wastage_percent (index 6)
+                        item[7],   # making_percent (index 7)
+                        item[8],   # item_value (index 8)
+                        item[9],   # wastage_amount (index 9)
+                        item[10],  # making_amount (index 10)
+                        item[11]   # line_total (index 11)
+                    ))
+                
+                added_totals = self._invoice_day_totals(cursor, 'id = ?', (new_invoice_id,))
+                conn.commit()
+                rollups.record_invoices(self.db_path, added_totals)
+                return new_invoice_id
+                
+            except Exception as e:
+                conn.rollback()
+                raise e
     
     def get_all_customers_admin(self):
         """Get all customers from all user databases (admin only).
         Returns DataFrame with an additional 'database' column indicating source.
         User data takes priority over duplicates."""
-        import glob
-        import os
-        
-        all_customers = []
-        seen_phones = set()  # Track unique customers by phone (user data takes priority)
-        
-        # First, get customers from user databases (these take priority)
-        user_dbs = glob.glob('jewelcalc_user_*.db')
-        for db_file in user_dbs:
-            try:
-                user_id = db_file.replace('jewelcalc_user_', '').replace('.db', '')
-                conn = sqlite3.connect(db_file, check_same_thread=False)
-                df = pd.read_sql_query(
-                    'SELECT id, account_no, name, phone, address FROM customers ORDER BY id DESC',
-                    conn
-                )
-                conn.close()
-                
-                if not df.empty:
-                    df['database'] = f'User {user_id}'
-                    df['db_path'] = db_file
-                    # Mark phones from user databases
-                    for phone in df['phone'].tolist():
-                        seen_phones.add(phone)
-                    all_customers.append(df)
-            except Exception:
-                pass  # Skip if database doesn't exist or has errors
-        
-        # Then, get customers from admin database (skip duplicates based on phone)
-        admin_db_path = 'jewelcalc_admin.db'
-        if os.path.exists(admin_db_path):
-            try:
-                conn = sqlite3.connect(admin_db_path, check_same_thread=False)
-                df = pd.read_sql_query(
-                    'SELECT id, account_no, name, phone, address FROM customers ORDER BY id DESC',
-                    conn
+        return federated_query(
+            'SELECT id, account_no, name, phone, address FROM {db}.customers',
+            '''
+                SELECT r.id, r.account_no, r.name, r.phone, r.address, t.database, t.db_path
+                FROM results r
+                JOIN tenants t ON t.tenant_order = r.tenant_order
+                -- Admin rows are hidden when a user database has the same phone
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM results o
+                    JOIN tenants ot ON ot.tenant_order = o.tenant_order
+                    WHERE o.phone = r.phone AND ot.priority < t.priority
                 )
-                conn.close()
-                
-                if not df.empty:
-                    # Filter out duplicates (user data takes priority)
-                    df = df[~df['phone'].isin(seen_phones)]
-                    if not df.empty:
-                        df['database'] = 'Admin'
-                        df['db_path'] = admin_db_path
-                        all_customers.append(df)
-            except Exception:
-                pass
-        
-        # Combine all customer data
-        if all_customers:
-            combined_df = pd.concat(all_customers, ignore_index=True)
-            # Sort by most recent (assuming higher IDs are more recent within each database)
-            return combined_df
-        else:
-            return pd.DataFrame(columns=['id', 'account_no', 'name', 'phone', 'address', 'database', 'db_path'])
+                ORDER BY r.tenant_order, r.id DESC
+            ''',
+            columns=['id', 'account_no', 'name', 'phone', 'address', 'database', 'db_path'],
+            index_on='phone'
+        )
     
     def get_all_invoices_admin(self):
         """Get all invoices from all user databases (admin only).
         Returns DataFrame with an additional 'database' column indicating source."""
-        import glob
-        import os
-        
-        all_invoices = []
-        
-        # Get invoices from user databases
-        user_dbs = glob.glob('jewelcalc_user_*.db')
-        for db_file in user_dbs:
-            try:
-                user_id = db_file.replace('jewelcalc_user_', '').replace('.db', '')
-                conn = sqlite3.connect(db_file, check_same_thread=False)
-                df = pd.read_sql_query('''
-                    SELECT 
-                        i.id, i.invoice_no, i.date, i.total,
-                        c.name as customer_name, c.phone as customer_phone, c.account_no
-                    FROM invoices i
-                    LEFT JOIN customers c ON i.customer_id = c.id
-                    ORDER BY i.date DESC
-                ''', conn)
-                conn.close()
-                
-                if not df.empty:
-                    df['database'] = f'User {user_id}'
-                    df['db_path'] = db_file
-                    all_invoices.append(df)
-            except Exception:
-                pass  # Skip if database doesn't exist or has errors
-        
-        # Get invoices from admin database
-        admin_db_path = 'jewelcalc_admin.db'
-        if os.path.exists(admin_db_path):
-            try:
-                conn = sqlite3.connect(admin_db_path, check_same_thread=False)
-                df = pd.read_sql_query('''
-                    SELECT 
-                        i.id, i.invoice_no, i.date, i.total,
-                        c.name as customer_name, c.phone as customer_phone, c.account_no
-                    FROM invoices i
-                    LEFT JOIN customers c ON i.customer_id = c.id
-                    ORDER BY i.date DESC
-                ''', conn)
-                conn.close()
-                
-                if not df.empty:
-                    df['database'] = 'Admin'
-                    df['db_path'] = admin_db_path
-                    all_invoices.append(df)
-            except Exception:
-                pass
-        
-        # Combine all invoice data
-        if all_invoices:
-            combined_df = pd.concat(all_invoices, ignore_index=True)
-            # Sort by date (most recent first)
-            combined_df = combined_df.sort_values('date', ascending=False)
-            return combined_df
-        else:
-            return pd.DataFrame(columns=['id', 'invoice_no', 'date', 'total', 'customer_name', 'customer_phone', 'account_no', 'database', 'db_path'])
+        return federated_query(
+            f'''
+                SELECT 
+                    i.id, i.invoice_no, i.date, {INVOICE_ORDER_SQL} AS sort_ts, i.total,
+                    c.name as customer_name, c.phone as customer_phone, c.account_no
+                FROM {{db}}.invoices i
+                LEFT JOIN {{db}}.customers c ON i.customer_id = c.id
+            ''',
+            '''
+                SELECT r.id, r.invoice_no, r.date, r.sort_ts, r.total, r.customer_name, r.customer_phone, r.account_no,
+                       t.database, t.db_path
+                FROM results r
+                JOIN tenants t ON t.tenant_order = r.tenant_order
+                ORDER BY r.sort_ts DESC, r.tenant_order, r.id DESC
+            ''',
+            columns=['id', 'invoice_no', 'date', 'sort_ts', 'total', 'customer_name', 'customer_phone', 'account_no',
+                     'database', 'db_path']
+        )
+    
+    def get_recent_invoices_admin(self, limit, before=None, search=None, start_date=None, end_date=None):
+        """Get one page of the newest invoices across all databases (admin only).
+        Each database is read through a lazy date-ordered cursor and the cursors are
+        merged with a heap, stopping once the page is full. Rows are ordered by
+        (sort_ts, db_path, id) descending; for the next page pass that triple from the
+        last row as before. search and start_date/end_date filter as in get_invoices,
+        through each database's own indexes. Unreadable databases are listed in
+        df.attrs['failures']."""
+        failures = []
+        streams = [
+            _tenant_invoice_stream(label, path, limit, before, search, failures, start_date, end_date)
+            for label, path, _ in tenant_databases()
+        ]
+        try:
+            merged = heapq.merge(*streams, key=lambda row: (row['sort_ts'], row['db_path'], row['id']), reverse=True)
+            rows = list(itertools.islice(merged, limit))
+        finally:
+            for stream in streams:
+                stream.close()  # Hand unfinished cursors' connections back to their pools
+        
+        df = pd.DataFrame(rows, columns=['id', 'invoice_no', 'date', 'sort_ts', 'total', 'customer_name', 'customer_phone',
+                                         'account_no', 'database', 'db_path'])
+        df.attrs['failures'] = failures
+        return df
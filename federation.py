@@ -0,0 +1,128 @@
+"""Federated read-only queries across tenant databases.
+
+Admin views need data from every ``jewelcalc_user_*.db`` plus the admin
+database. Each tenant is queried as its own task on a bounded thread pool,
+on a pooled connection to that file and with its own timeout, so a view takes
+about as long as its slowest tenant. The rows land in an in-memory
+``results`` table, and a final SQL query over it de-duplicates and sorts them.
+"""
+import glob
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from connection_pool import get_pool
+from migrations import ensure_schema
+
+
+USER_DB_PATTERN = 'jewelcalc_user_*.db'
+ADMIN_DB_PATH = 'jewelcalc_admin.db'
+
+# Tenants are read concurrently on a bounded thread pool
+MAX_WORKERS = 8
+TENANT_TIMEOUT = 10  # seconds allowed per tenant before its query is interrupted
+
+
+def tenant_databases(directory='.'):
+    """Return (label, path, priority) for every tenant database in a directory.
+    User databases come first (priority 0) and the admin database last (priority 1)."""
+    def in_directory(name):
+        return name if directory == '.' else os.path.join(directory, name)
+
+    tenants = []
+    for db_file in sorted(glob.glob(in_directory(USER_DB_PATTERN))):
+        user_id = os.path.basename(db_file).replace('jewelcalc_user_', '').replace('.db', '')
+        tenants.append((f'User {user_id}', db_file, 0))
+    if os.path.exists(in_directory(ADMIN_DB_PATH)):
+        tenants.append(('Admin', in_directory(ADMIN_DB_PATH), 1))
+    return tenants
+
+
+def _fetch_with_timeout(conn, sql, timeout):
+    """Run a query, interrupting it if it takes longer than timeout seconds.
+    Returns (column names, rows)."""
+    timer = threading.Timer(timeout, conn.interrupt)
+    timer.start()
+    try:
+        cursor = conn.execute(sql)
+        rows = cursor.fetchall()
+    finally:
+        timer.cancel()
+    return [d[0] for d in cursor.description], rows
+
+
+def _describe_error(error, timeout):
+    if isinstance(error, sqlite3.OperationalError) and 'interrupted' in str(error):
+        return f'timed out after {timeout}s'
+    return str(error)
+
+
+def _query_tenant(tenant_sql, path, timeout):
+    """Worker: run tenant_sql against one tenant file on a pooled connection.
+    Returns (columns, rows, error message or None)."""
+    try:
+        ensure_schema(path)  # Older files may be missing tables the query needs
+        with get_pool(path).connection() as conn:
+            columns, rows = _fetch_with_timeout(conn, tenant_sql.format(db='main'), timeout)
+        return columns, rows, None
+    except sqlite3.Error as e:
+        return None, [], _describe_error(e, timeout)
+
+
+def fan_out(fn, items, max_workers=MAX_WORKERS):
+    """Call fn(item) for every item on a bounded thread pool.
+    Results come back in the order of items, however the calls finish."""
+    if len(items) <= 1:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(fn, items))
+
+
+def federated_query(tenant_sql, final_sql, columns, tenants=None, index_on=None,
+                    timeout=TENANT_TIMEOUT, max_workers=MAX_WORKERS):
+    """Run tenant_sql against every tenant database and combine the rows with final_sql.
+
+    tenant_sql refers to tables as ``{db}.table``. Every tenant is read as its own
+    task, in parallel, with its own timeout; the rows land in a ``results`` table
+    (in tenant order) with an extra ``tenant_order`` column, and final_sql can join
+    ``tenants`` (tenant_order, database, db_path, priority) to label, de-duplicate
+    and sort them. index_on optionally names a results column to index before
+    final_sql runs.
+
+    Returns a DataFrame (an empty one with the given columns if nothing was read).
+    Tenants that failed or took longer than timeout seconds are listed in
+    ``df.attrs['failures']`` as dicts with database, db_path and error keys.
+    """
+    if tenants is None:
+        tenants = tenant_databases()
+
+    tenant_results = fan_out(lambda tenant: _query_tenant(tenant_sql, tenant[1], timeout), tenants, max_workers)
+
+    failures = [
+        {'database': label, 'db_path': path, 'error': error}
+        for (label, path, _), (_, _, error) in zip(tenants, tenant_results) if error is not None
+    ]
+
+    result_columns = next((cols for cols, _, _ in tenant_results if cols), None)
+    if result_columns is None:
+        df = pd.DataFrame(columns=columns)
+        df.attrs['failures'] = failures
+        return df
+
+    conn = sqlite3.connect(':memory:')
+    try:
+        conn.execute('CREATE TABLE tenants (tenant_order INTEGER PRIMARY KEY, database TEXT, db_path TEXT, priority INTEGER)')
+        conn.executemany('INSERT INTO tenants VALUES (?, ?, ?, ?)',
+                         [(n, label, path, priority) for n, (label, path, priority) in enumerate(tenants)])
+        conn.execute('CREATE TABLE results (tenant_order, {})'.format(', '.join(f'"{c}"' for c in result_columns)))
+        insert_sql = 'INSERT INTO results VALUES ({})'.format(', '.join('?' * (len(result_columns) + 1)))
+        for tenant_order, (_, rows, _) in enumerate(tenant_results):
+            conn.executemany(insert_sql, [(tenant_order,) + tuple(row) for row in rows])
+        if index_on:
+            conn.execute(f'CREATE INDEX results_{index_on} ON results({index_on})')
+        df = pd.read_sql_query(final_sql, conn)
+    finally:
+        conn.close()
+    df.attrs['failures'] = failures
+    return df
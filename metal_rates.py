@@ -0,0 +1,145 @@
+"""Shop-wide metal rates with optional per-tenant overrides.
+
+The admin sets the day's rates once in the auth database instead of every
+tenant keeping its own ``metal_settings`` blob. Tenants may override single
+fields (e.g. their own making charge) for a metal. Reads go through a
+process-wide cache shared by every session; any write bumps
+``metal_rates_version`` (by trigger), so a stale cache is detected with one
+primary-key read and reloaded in one pass.
+"""
+import copy
+import os
+import threading
+from datetime import datetime
+from connection_pool import get_pool, file_identity
+from migrations import ensure_schema
+
+
+RATES_DB_NAME = 'jewelcalc_auth.db'
+
+RATE_FIELDS = ('rate', 'wastage', 'making')
+
+# rates path -> (file identity, version, shop rates, {tenant: overrides})
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _rates_path(db_path):
+    """The rate table sits in the auth database next to the tenant files"""
+    return os.path.join(os.path.dirname(db_path), RATES_DB_NAME)
+
+
+def _tenant_key(db_path):
+    return os.path.basename(db_path)
+
+
+def _snapshot(rates_path):
+    """(shop rates, overrides by tenant) from the cache, reloaded only when the version moved"""
+    ensure_schema(rates_path)
+    path = os.path.abspath(rates_path)
+    file_id = file_identity(rates_path)
+    with get_pool(rates_path).connection() as conn:
+        # Read the version first: a write landing in between only costs an extra reload later
+        version = conn.execute('SELECT version FROM metal_rates_version WHERE id = 1').fetchone()[0]
+        cached = _cache.get(path)
+        if cached and cached[:2] == (file_id, version):
+            return cached[2], cached[3]
+        # rowid order keeps the metals in the order they were saved
+        shop = {
+            metal: dict(zip(RATE_FIELDS, values))
+            for metal, *values in conn.execute('SELECT metal, rate, wastage, making FROM metal_rates ORDER BY rowid')
+        }
+        overrides = {}
+        for tenant, metal, *values in conn.execute(
+                'SELECT db_path, metal, rate, wastage, making FROM metal_rate_overrides ORDER BY rowid'):
+            overrides.setdefault(tenant, {})[metal] = {
+                field: value for field, value in zip(RATE_FIELDS, values) if value is not None
+            }
+    with _cache_lock:
+        _cache[path] = (file_id, version, shop, overrides)
+    return shop, overrides
+
+
+def _write(rates_path, statements):
+    """Run (sql, params) statements against the rate table in one transaction"""
+    ensure_schema(rates_path)
+    with get_pool(rates_path).connection() as conn:
+        for sql, params in statements:
+            if isinstance(params, list):
+                conn.executemany(sql, params)
+            else:
+                conn.execute(sql, params)
+        conn.commit()
+
+
+def get_shop_rates(directory='.'):
+    """Shop-wide {metal: {'rate', 'wastage', 'making'}} rates"""
+    shop, _ = _snapshot(os.path.join(directory, RATES_DB_NAME))
+    return copy.deepcopy(shop)
+
+
+def set_shop_rates(rates, directory='.'):
+    """Replace the shop-wide rates with a {metal: {'rate', 'wastage', 'making'}} map"""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    _write(os.path.join(directory, RATES_DB_NAME), [
+        ('DELETE FROM metal_rates', ()),
+        ('INSERT INTO metal_rates (metal, rate, wastage, making, updated_at) VALUES (?, ?, ?, ?, ?)',
+         [(metal,) + tuple(float(values[field]) for field in RATE_FIELDS) + (now,) for metal, values in rates.items()]),
+    ])
+
+
+def get_tenant_overrides(db_path):
+    """A tenant's {metal: {field: value}} overrides (only the overridden fields)"""
+    _, overrides = _snapshot(_rates_path(db_path))
+    return copy.deepcopy(overrides.get(_tenant_key(db_path), {}))
+
+
+def set_tenant_overrides(db_path, overrides):
+    """Replace a tenant's overrides. Fields left out (or None) follow the shop-wide rate."""
+    tenant = _tenant_key(db_path)
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    rows = [
+        (tenant, metal) + tuple(None if values.get(field) is None else float(values[field]) for field in RATE_FIELDS) + (now,)
+        for metal, values in overrides.items()
+    ]
+    _write(_rates_path(db_path), [
+        ('DELETE FROM metal_rate_overrides WHERE db_path = ?', (tenant,)),
+        ('INSERT INTO metal_rate_overrides (db_path, metal, rate, wastage, making, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+         rows),
+    ])
+
+
+def forget_tenant_rates(db_path):
+    """Drop a tenant's overrides (e.g. after its database file is deleted)"""
+    _write(_rates_path(db_path), [
+        ('DELETE FROM metal_rate_overrides WHERE db_path = ?', (_tenant_key(db_path),)),
+    ])
+
+
+def get_metal_settings(db_path):
+    """The effective {metal: {'rate', 'wastage', 'making'}} rates for a tenant.
+    Shop-wide rates with the tenant's overrides applied, plus metals only the tenant
+    defines. Empty when no shop-wide rates or overrides have been set."""
+    shop, overrides = _snapshot(_rates_path(db_path))
+    tenant_overrides = overrides.get(_tenant_key(db_path), {})
+    settings = {metal: {**values, **tenant_overrides.get(metal, {})} for metal, values in shop.items()}
+    for metal, values in tenant_overrides.items():
+        if metal not in settings and all(field in values for field in RATE_FIELDS):
+            settings[metal] = dict(values)
+    return settings
+
+
+def tenant_overrides_from(db_path, metal_settings):
+    """The overrides a tenant needs so get_metal_settings returns metal_settings:
+    only the fields that differ from the shop-wide rates, and whole metals the shop lacks."""
+    shop, _ = _snapshot(_rates_path(db_path))
+    overrides = {}
+    for metal, values in metal_settings.items():
+        shop_values = shop.get(metal)
+        if shop_values is None:
+            overrides[metal] = {field: float(values[field]) for field in RATE_FIELDS}
+            continue
+        changed = {field: float(values[field]) for field in RATE_FIELDS if float(values[field]) != shop_values[field]}
+        if changed:
+            overrides[metal] = changed
+    return overrides
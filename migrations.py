@@ -0,0 +1,823 @@
+"""Versioned schema migrations for JewelCalc databases.
+
+Every database file records its schema version in ``PRAGMA user_version``.
+``ensure_schema()`` applies any pending migrations once per file per process;
+afterwards opening a ``Database`` costs a single ``os.stat`` and no DDL.
+
+To change the schema, append a new function to ``MIGRATIONS``. Never edit or
+reorder a migration that has already shipped.
+"""
+import os
+import threading
+from connection_pool import get_pool, file_identity
+
+
+def add_column_if_missing(cursor, table, column, definition):
+    """Add a column to a table unless it already exists"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
+def _v1_initial_schema(cursor):
+    """Base tables (files created before versioning already have these)"""
+    # Users table for authentication
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            full_name TEXT NOT NULL,
+            email TEXT,
+            phone TEXT,
+            role TEXT DEFAULT 'user',
+            status TEXT DEFAULT 'pending',
+            created_at TEXT NOT NULL,
+            approved_at TEXT,
+            approved_by INTEGER,
+            FOREIGN KEY(approved_by) REFERENCES users(id)
+        )
+    ''')
+
+    # Password reset requests table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS password_reset_requests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            email TEXT,
+            phone TEXT,
+            request_type TEXT NOT NULL,
+            status TEXT DEFAULT 'pending',
+            requested_at TEXT NOT NULL,
+            resolved_at TEXT,
+            resolved_by INTEGER,
+            FOREIGN KEY(user_id) REFERENCES users(id),
+            FOREIGN KEY(resolved_by) REFERENCES users(id)
+        )
+    ''')
+
+    # Customers table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS customers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            account_no TEXT UNIQUE,
+            name TEXT NOT NULL,
+            phone TEXT UNIQUE NOT NULL,
+            address TEXT
+        )
+    ''')
+
+    # Invoices table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS invoices (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            invoice_no TEXT UNIQUE NOT NULL,
+            customer_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            subtotal REAL NOT NULL,
+            cgst_percent REAL NOT NULL,
+            sgst_percent REAL NOT NULL,
+            cgst_amount REAL NOT NULL,
+            sgst_amount REAL NOT NULL,
+            discount_percent REAL DEFAULT 0,
+            discount_amount REAL DEFAULT 0,
+            total REAL NOT NULL,
+            FOREIGN KEY(customer_id) REFERENCES customers(id)
+        )
+    ''')
+
+    # Settings table for persistent user settings
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS settings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT UNIQUE NOT NULL,
+            value TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    ''')
+
+    # Invoice items table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS invoice_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            invoice_id INTEGER NOT NULL,
+            item_no INTEGER NOT NULL,
+            metal TEXT NOT NULL,
+            weight REAL NOT NULL,
+            rate REAL NOT NULL,
+            wastage_percent REAL NOT NULL,
+            making_percent REAL NOT NULL,
+            item_value REAL NOT NULL,
+            wastage_amount REAL NOT NULL,
+            making_amount REAL NOT NULL,
+            line_total REAL NOT NULL,
+            FOREIGN KEY(invoice_id) REFERENCES invoices(id)
+        )
+    ''')
+
+
+def _v2_secondary_indexes(cursor):
+    """Indexes for the list, report and cascade-delete queries"""
+    # Invoice list (ORDER BY date) and sales report (date range); covers the list columns
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_invoices_date ON invoices(date, customer_id, invoice_no, total)')
+    # delete_customer and customer analysis; covers the aggregated columns
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_invoices_customer '
+                   'ON invoices(customer_id, date, subtotal, discount_amount, total)')
+    # Item fetch / delete by invoice, already in item_no order
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_invoice_items_invoice ON invoice_items(invoice_id, item_no)')
+    # Category report GROUP BY metal
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_invoice_items_metal ON invoice_items(metal, invoice_id)')
+    # Auth lookups (pending lists, reset-request lookup by email/phone)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_status ON users(status, created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_role ON users(role)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_created ON users(created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_email ON users(email)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_phone ON users(phone)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_password_reset_status '
+                   'ON password_reset_requests(status, requested_at)')
+
+
+def _v3_invoice_keyset_index(cursor):
+    """Index invoices on (date, id) so keyset pages need no sort"""
+    # Every index implicitly ends in the rowid, so a plain date index orders by (date, id)
+    cursor.execute('DROP INDEX IF EXISTS idx_invoices_date')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_invoices_date ON invoices(date)')
+
+
+def _v4_admin_rollups(cursor):
+    """Per-tenant rollups kept in the auth database for the admin overview"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tenant_totals (
+            db_path TEXT PRIMARY KEY,
+            customers INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tenant_daily_totals (
+            db_path TEXT NOT NULL,
+            day TEXT NOT NULL,
+            invoice_count INTEGER NOT NULL DEFAULT 0,
+            subtotal REAL NOT NULL DEFAULT 0,
+            discount_amount REAL NOT NULL DEFAULT 0,
+            cgst_amount REAL NOT NULL DEFAULT 0,
+            sgst_amount REAL NOT NULL DEFAULT 0,
+            total REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (db_path, day)
+        )
+    ''')
+
+
+def _v5_daily_sales(cursor):
+    """Per-day sales summary kept in sync with invoices by triggers"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_sales (
+            day TEXT PRIMARY KEY,
+            invoice_count INTEGER NOT NULL DEFAULT 0,
+            subtotal REAL NOT NULL DEFAULT 0,
+            discount_amount REAL NOT NULL DEFAULT 0,
+            cgst_amount REAL NOT NULL DEFAULT 0,
+            sgst_amount REAL NOT NULL DEFAULT 0,
+            total REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    # Backfill from existing invoices
+    cursor.execute('DELETE FROM daily_sales')
+    cursor.execute('''
+        INSERT INTO daily_sales (day, invoice_count, subtotal, discount_amount, cgst_amount, sgst_amount, total)
+        SELECT substr(date, 1, 10), COUNT(*), SUM(subtotal), SUM(COALESCE(discount_amount, 0)),
+               SUM(cgst_amount), SUM(sgst_amount), SUM(total)
+        FROM invoices
+        GROUP BY substr(date, 1, 10)
+    ''')
+
+    add_sale = '''
+        INSERT INTO daily_sales (day, invoice_count, subtotal, discount_amount, cgst_amount, sgst_amount, total)
+        VALUES (substr(NEW.date, 1, 10), 1, NEW.subtotal, COALESCE(NEW.discount_amount, 0),
+                NEW.cgst_amount, NEW.sgst_amount, NEW.total)
+        ON CONFLICT(day) DO UPDATE SET
+            invoice_count = invoice_count + 1,
+            subtotal = subtotal + excluded.subtotal,
+            discount_amount = discount_amount + excluded.discount_amount,
+            cgst_amount = cgst_amount + excluded.cgst_amount,
+            sgst_amount = sgst_amount + excluded.sgst_amount,
+            total = total + excluded.total;
+    '''
+    remove_sale = '''
+        UPDATE daily_sales SET
+            invoice_count = invoice_count - 1,
+            subtotal = subtotal - OLD.subtotal,
+            discount_amount = discount_amount - COALESCE(OLD.discount_amount, 0),
+            cgst_amount = cgst_amount - OLD.cgst_amount,
+            sgst_amount = sgst_amount - OLD.sgst_amount,
+            total = total - OLD.total
+        WHERE day = substr(OLD.date, 1, 10);
+        DELETE FROM daily_sales WHERE day = substr(OLD.date, 1, 10) AND invoice_count <= 0;
+    '''
+    cursor.execute(f'CREATE TRIGGER IF NOT EXISTS daily_sales_insert AFTER INSERT ON invoices BEGIN {add_sale} END')
+    cursor.execute(f'CREATE TRIGGER IF NOT EXISTS daily_sales_delete AFTER DELETE ON invoices BEGIN {remove_sale} END')
+    cursor.execute(
+        'CREATE TRIGGER IF NOT EXISTS daily_sales_update '
+        'AFTER UPDATE OF date, subtotal, discount_amount, cgst_amount, sgst_amount, total ON invoices '
+        f'BEGIN {remove_sale} {add_sale} END'
+    )
+
+
+def _v6_metal_monthly_sales(cursor):
+    """Per-metal, per-month item totals kept in sync with invoice_items by triggers"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS metal_monthly_sales (
+            metal TEXT NOT NULL,
+            month TEXT NOT NULL,
+            item_count INTEGER NOT NULL DEFAULT 0,
+            invoice_count INTEGER NOT NULL DEFAULT 0,
+            weight REAL NOT NULL DEFAULT 0,
+            rate_sum REAL NOT NULL DEFAULT 0,
+            item_value REAL NOT NULL DEFAULT 0,
+            wastage_amount REAL NOT NULL DEFAULT 0,
+            making_amount REAL NOT NULL DEFAULT 0,
+            line_total REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (metal, month)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_metal_monthly_sales_month ON metal_monthly_sales(month)')
+    # Items are bucketed by their invoice's month ('' for items without an invoice)
+    cursor.execute('DELETE FROM metal_monthly_sales')
+    cursor.execute('''
+        INSERT INTO metal_monthly_sales (metal, month, item_count, invoice_count, weight, rate_sum,
+                                         item_value, wastage_amount, making_amount, line_total)
+        SELECT ii.metal, COALESCE(substr(i.date, 1, 7), ''), COUNT(*), COUNT(DISTINCT ii.invoice_id),
+               SUM(ii.weight), SUM(ii.rate), SUM(ii.item_value), SUM(ii.wastage_amount),
+               SUM(ii.making_amount), SUM(ii.line_total)
+        FROM invoice_items ii
+        LEFT JOIN invoices i ON i.id = ii.invoice_id
+        GROUP BY ii.metal, COALESCE(substr(i.date, 1, 7), '')
+    ''')
+
+    # Items are written after their invoice and deleted before it, so the invoice date is there
+    _create_metal_monthly_sales_triggers(
+        cursor, "COALESCE((SELECT substr(date, 1, 7) FROM invoices WHERE id = {row}.invoice_id), '')"
+    )
+
+
+def _create_metal_monthly_sales_triggers(cursor, month_of):
+    """metal_monthly_sales insert/delete triggers; month_of is the item's month bucket, formatted with row"""
+    # An invoice counts once per metal: when its first item of that metal arrives / its last one goes
+    metal_items_of = 'SELECT COUNT(*) FROM invoice_items WHERE invoice_id = {row}.invoice_id AND metal = {row}.metal'
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS metal_monthly_sales_insert AFTER INSERT ON invoice_items BEGIN
+            INSERT INTO metal_monthly_sales (metal, month, item_count, invoice_count, weight, rate_sum,
+                                             item_value, wastage_amount, making_amount, line_total)
+            VALUES (NEW.metal, {month_of.format(row='NEW')}, 1, ({metal_items_of.format(row='NEW')}) = 1,
+                    NEW.weight, NEW.rate, NEW.item_value, NEW.wastage_amount, NEW.making_amount, NEW.line_total)
+            ON CONFLICT(metal, month) DO UPDATE SET
+                item_count = item_count + 1,
+                invoice_count = invoice_count + excluded.invoice_count,
+                weight = weight + excluded.weight,
+                rate_sum = rate_sum + excluded.rate_sum,
+                item_value = item_value + excluded.item_value,
+                wastage_amount = wastage_amount + excluded.wastage_amount,
+                making_amount = making_amount + excluded.making_amount,
+                line_total = line_total + excluded.line_total;
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS metal_monthly_sales_delete AFTER DELETE ON invoice_items BEGIN
+            UPDATE metal_monthly_sales SET
+                item_count = item_count - 1,
+                invoice_count = invoice_count - (({metal_items_of.format(row='OLD')}) = 0),
+                weight = weight - OLD.weight,
+                rate_sum = rate_sum - OLD.rate,
+                item_value = item_value - OLD.item_value,
+                wastage_amount = wastage_amount - OLD.wastage_amount,
+                making_amount = making_amount - OLD.making_amount,
+                line_total = line_total - OLD.line_total
+            WHERE metal = OLD.metal AND month = {month_of.format(row='OLD')};
+            DELETE FROM metal_monthly_sales WHERE metal = OLD.metal AND item_count <= 0;
+        END
+    ''')
+
+
+def _v7_customer_stats(cursor):
+    """Per-customer lifetime purchase stats kept in sync with customers and invoices by triggers"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS customer_stats (
+            customer_id INTEGER PRIMARY KEY,
+            invoice_count INTEGER NOT NULL DEFAULT 0,
+            subtotal REAL NOT NULL DEFAULT 0,
+            discount_amount REAL NOT NULL DEFAULT 0,
+            total REAL NOT NULL DEFAULT 0,
+            first_purchase TEXT,
+            last_purchase TEXT
+        )
+    ''')
+    # Top customers by spend
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_customer_stats_total ON customer_stats(total)')
+    # Backfill: every customer gets a row, including those without invoices
+    cursor.execute('DELETE FROM customer_stats')
+    cursor.execute('''
+        INSERT INTO customer_stats (customer_id, invoice_count, subtotal, discount_amount, total,
+                                    first_purchase, last_purchase)
+        SELECT c.id, COUNT(i.id), COALESCE(SUM(i.subtotal), 0), COALESCE(SUM(i.discount_amount), 0),
+               COALESCE(SUM(i.total), 0), MIN(i.date), MAX(i.date)
+        FROM customers c
+        LEFT JOIN invoices i ON i.customer_id = c.id
+        GROUP BY c.id
+    ''')
+
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS customer_stats_customer_insert AFTER INSERT ON customers BEGIN
+            INSERT OR IGNORE INTO customer_stats (customer_id) VALUES (NEW.id);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS customer_stats_customer_delete AFTER DELETE ON customers BEGIN
+            DELETE FROM customer_stats WHERE customer_id = OLD.id;
+        END
+    ''')
+
+    add_purchase = '''
+        INSERT INTO customer_stats (customer_id, invoice_count, subtotal, discount_amount, total,
+                                    first_purchase, last_purchase)
+        VALUES (NEW.customer_id, 1, NEW.subtotal, COALESCE(NEW.discount_amount, 0), NEW.total, NEW.date, NEW.date)
+        ON CONFLICT(customer_id) DO UPDATE SET
+            invoice_count = invoice_count + 1,
+            subtotal = subtotal + excluded.subtotal,
+            discount_amount = discount_amount + excluded.discount_amount,
+            total = total + excluded.total,
+            first_purchase = COALESCE(MIN(first_purchase, excluded.first_purchase), excluded.first_purchase),
+            last_purchase = COALESCE(MAX(last_purchase, excluded.last_purchase), excluded.last_purchase);
+    '''
+    # First/last purchase are re-read from idx_invoices_customer, which is ordered by (customer_id, date)
+    remove_purchase = '''
+        UPDATE customer_stats SET
+            invoice_count = invoice_count - 1,
+            subtotal = subtotal - OLD.subtotal,
+            discount_amount = discount_amount - COALESCE(OLD.discount_amount, 0),
+            total = total - OLD.total,
+            first_purchase = (SELECT MIN(date) FROM invoices WHERE customer_id = OLD.customer_id),
+            last_purchase = (SELECT MAX(date) FROM invoices WHERE customer_id = OLD.customer_id)
+        WHERE customer_id = OLD.customer_id;
+    '''
+    cursor.execute(f'CREATE TRIGGER IF NOT EXISTS customer_stats_insert AFTER INSERT ON invoices BEGIN {add_purchase} END')
+    cursor.execute(f'CREATE TRIGGER IF NOT EXISTS customer_stats_delete AFTER DELETE ON invoices BEGIN {remove_purchase} END')
+    cursor.execute(
+        'CREATE TRIGGER IF NOT EXISTS customer_stats_update '
+        'AFTER UPDATE OF customer_id, date, subtotal, discount_amount, total ON invoices '
+        f'BEGIN {remove_purchase} {add_purchase} END'
+    )
+
+
+def _v8_customer_search(cursor):
+    """Trigram full-text index over customer name, phone, account number and address"""
+    # External-content table: the text lives in customers, the FTS table only holds the index
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS customers_fts USING fts5(
+            name, phone, account_no, address,
+            content='customers', content_rowid='id', tokenize='trigram'
+        )
+    ''')
+    cursor.execute("INSERT INTO customers_fts(customers_fts) VALUES ('rebuild')")
+
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS customers_fts_insert AFTER INSERT ON customers BEGIN
+            INSERT INTO customers_fts (rowid, name, phone, account_no, address)
+            VALUES (NEW.id, NEW.name, NEW.phone, NEW.account_no, NEW.address);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS customers_fts_delete AFTER DELETE ON customers BEGIN
+            INSERT INTO customers_fts (customers_fts, rowid, name, phone, account_no, address)
+            VALUES ('delete', OLD.id, OLD.name, OLD.phone, OLD.account_no, OLD.address);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS customers_fts_update AFTER UPDATE ON customers BEGIN
+            INSERT INTO customers_fts (customers_fts, rowid, name, phone, account_no, address)
+            VALUES ('delete', OLD.id, OLD.name, OLD.phone, OLD.account_no, OLD.address);
+            INSERT INTO customers_fts (rowid, name, phone, account_no, address)
+            VALUES (NEW.id, NEW.name, NEW.phone, NEW.account_no, NEW.address);
+        END
+    ''')
+
+
+def _v9_invoice_search(cursor):
+    """Trigram full-text index over invoice numbers"""
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS invoices_fts USING fts5(
+            invoice_no, content='invoices', content_rowid='id', tokenize='trigram'
+        )
+    ''')
+    cursor.execute("INSERT INTO invoices_fts(invoices_fts) VALUES ('rebuild')")
+
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS invoices_fts_insert AFTER INSERT ON invoices BEGIN
+            INSERT INTO invoices_fts (rowid, invoice_no) VALUES (NEW.id, NEW.invoice_no);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS invoices_fts_delete AFTER DELETE ON invoices BEGIN
+            INSERT INTO invoices_fts (invoices_fts, rowid, invoice_no) VALUES ('delete', OLD.id, OLD.invoice_no);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS invoices_fts_update AFTER UPDATE OF invoice_no ON invoices BEGIN
+            INSERT INTO invoices_fts (invoices_fts, rowid, invoice_no) VALUES ('delete', OLD.id, OLD.invoice_no);
+            INSERT INTO invoices_fts (rowid, invoice_no) VALUES (NEW.id, NEW.invoice_no);
+        END
+    ''')
+
+
+# Epoch seconds of an invoice date. Dates were written as '%Y-%m-%d %H:%M:%S', '%Y-%m-%d'
+# or whatever an import carried; anything SQLite can't parse whole falls back to its
+# leading YYYY-MM-DD.
+_EPOCH_SQL = "CAST(COALESCE(strftime('%s', {date}), strftime('%s', substr({date}, 1, 10))) AS INTEGER)"
+
+
+def _v10_invoice_timestamps(cursor):
+    """Normalized epoch-seconds column for invoice dates, so date ranges compare integers"""
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(invoices)')]
+    if 'date_ts' not in columns:
+        cursor.execute('ALTER TABLE invoices ADD COLUMN date_ts INTEGER')
+    epoch = _EPOCH_SQL
+    cursor.execute(f'UPDATE invoices SET date_ts = {epoch.format(date="date")}')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_invoices_date_ts ON invoices(date_ts)')
+
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS invoices_date_ts_insert AFTER INSERT ON invoices BEGIN
+            UPDATE invoices SET date_ts = {epoch.format(date="NEW.date")} WHERE id = NEW.id;
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS invoices_date_ts_update AFTER UPDATE OF date ON invoices BEGIN
+            UPDATE invoices SET date_ts = {epoch.format(date="NEW.date")} WHERE id = NEW.id;
+        END
+    ''')
+
+
+# Invoice REAL amount columns and their integer paise counterparts
+_MONEY_COLUMNS = [
+    ('subtotal', 'subtotal_paise'),
+    ('discount_amount', 'discount_paise'),
+    ('cgst_amount', 'cgst_paise'),
+    ('sgst_amount', 'sgst_paise'),
+    ('total', 'total_paise'),
+]
+
+
+def _paise_sql(amount):
+    """SQL for a REAL rupee amount as integer paise"""
+    return f'CAST(ROUND(COALESCE({amount}, 0) * 100) AS INTEGER)'
+
+
+def _v11_integer_money(cursor):
+    """Integer paise copies of the invoice amounts, and a per-day sales summary kept in paise"""
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(invoices)')]
+    for _, paise in _MONEY_COLUMNS:
+        if paise not in columns:
+            cursor.execute(f'ALTER TABLE invoices ADD COLUMN {paise} INTEGER')
+    cursor.execute('UPDATE invoices SET ' + ', '.join(
+        f'{paise} = {_paise_sql(amount)}' for amount, paise in _MONEY_COLUMNS
+    ))
+
+    # One trigger now derives both date_ts and the paise columns from what was written
+    derived = ', '.join(
+        [f'date_ts = {_EPOCH_SQL.format(date="NEW.date")}']
+        + [f'{paise} = {_paise_sql("NEW." + amount)}' for amount, paise in _MONEY_COLUMNS]
+    )
+    cursor.execute('DROP TRIGGER IF EXISTS invoices_date_ts_insert')
+    cursor.execute('DROP TRIGGER IF EXISTS invoices_date_ts_update')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS invoices_derived_insert AFTER INSERT ON invoices BEGIN
+            UPDATE invoices SET {derived} WHERE id = NEW.id;
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS invoices_derived_update
+        AFTER UPDATE OF date, {', '.join(amount for amount, _ in _MONEY_COLUMNS)} ON invoices BEGIN
+            UPDATE invoices SET {derived} WHERE id = NEW.id;
+        END
+    ''')
+
+    # daily_sales (v5) summed REAL amounts; daily_sales_paise replaces it with exact integer sums.
+    # It gets a new name so replaying v5 from scratch can't collide with it.
+    for trigger in ('daily_sales_insert', 'daily_sales_delete', 'daily_sales_update'):
+        cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    cursor.execute('DROP TABLE IF EXISTS daily_sales')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_sales_paise (
+            day TEXT PRIMARY KEY,
+            invoice_count INTEGER NOT NULL DEFAULT 0,
+            subtotal_paise INTEGER NOT NULL DEFAULT 0,
+            discount_paise INTEGER NOT NULL DEFAULT 0,
+            cgst_paise INTEGER NOT NULL DEFAULT 0,
+            sgst_paise INTEGER NOT NULL DEFAULT 0,
+            total_paise INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    paise_columns = ', '.join(paise for _, paise in _MONEY_COLUMNS)
+    cursor.execute('DELETE FROM daily_sales_paise')
+    cursor.execute(f'''
+        INSERT INTO daily_sales_paise (day, invoice_count, {paise_columns})
+        SELECT substr(date, 1, 10), COUNT(*), {', '.join(f'SUM({paise})' for _, paise in _MONEY_COLUMNS)}
+        FROM invoices
+        GROUP BY substr(date, 1, 10)
+    ''')
+
+    _create_daily_sales_paise_triggers(cursor, 'substr({row}.date, 1, 10)')
+
+
+def _create_daily_sales_paise_triggers(cursor, day_of):
+    """daily_sales_paise insert/delete/update triggers; day_of is an invoice's day bucket, formatted with row"""
+    paise_columns = ', '.join(paise for _, paise in _MONEY_COLUMNS)
+    # NEW/OLD hold the row as written, before invoices_derived_* fills in the paise columns
+    add_sale = f'''
+        INSERT INTO daily_sales_paise (day, invoice_count, {paise_columns})
+        VALUES ({day_of.format(row='NEW')}, 1, {', '.join(_paise_sql('NEW.' + amount) for amount, _ in _MONEY_COLUMNS)})
+        ON CONFLICT(day) DO UPDATE SET
+            invoice_count = invoice_count + 1,
+            {', '.join(f'{paise} = {paise} + excluded.{paise}' for _, paise in _MONEY_COLUMNS)};
+    '''
+    remove_sale = f'''
+        UPDATE daily_sales_paise SET
+            invoice_count = invoice_count - 1,
+            {', '.join(f'{paise} = {paise} - {_paise_sql("OLD." + amount)}' for amount, paise in _MONEY_COLUMNS)}
+        WHERE day = {day_of.format(row='OLD')};
+        DELETE FROM daily_sales_paise WHERE day = {day_of.format(row='OLD')} AND invoice_count <= 0;
+    '''
+    cursor.execute(f'CREATE TRIGGER IF NOT EXISTS daily_sales_paise_insert AFTER INSERT ON invoices BEGIN {add_sale} END')
+    cursor.execute(f'CREATE TRIGGER IF NOT EXISTS daily_sales_paise_delete AFTER DELETE ON invoices BEGIN {remove_sale} END')
+    cursor.execute(
+        'CREATE TRIGGER IF NOT EXISTS daily_sales_paise_update '
+        'AFTER UPDATE OF date, subtotal, discount_amount, cgst_amount, sgst_amount, total ON invoices '
+        f'BEGIN {remove_sale} {add_sale} END'
+    )
+
+
+def _v12_settings_version(cursor):
+    """Single-row settings version, bumped by triggers on every settings write"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS settings_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO settings_version (id, version) VALUES (1, 0)')
+    bump = 'UPDATE settings_version SET version = version + 1 WHERE id = 1;'
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        cursor.execute(
+            f'CREATE TRIGGER IF NOT EXISTS settings_version_{event.lower()} AFTER {event} ON settings BEGIN {bump} END'
+        )
+
+
+def _v13_metal_rates(cursor):
+    """Shop-wide metal rates and per-tenant overrides, kept in the auth database"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS metal_rates (
+            metal TEXT PRIMARY KEY,
+            rate REAL NOT NULL,
+            wastage REAL NOT NULL,
+            making REAL NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    ''')
+    # NULL fields fall back to the shop-wide value
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS metal_rate_overrides (
+            db_path TEXT NOT NULL,
+            metal TEXT NOT NULL,
+            rate REAL,
+            wastage REAL,
+            making REAL,
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (db_path, metal)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS metal_rates_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO metal_rates_version (id, version) VALUES (1, 0)')
+    bump = 'UPDATE metal_rates_version SET version = version + 1 WHERE id = 1;'
+    for table in ('metal_rates', 'metal_rate_overrides'):
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            cursor.execute(
+                f'CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()} AFTER {event} ON {table} BEGIN {bump} END'
+            )
+
+
+def _v14_metal_rate_history(cursor):
+    """Append-only history of the shop-wide metal rates, by metal and effective time"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS metal_rate_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            metal TEXT NOT NULL,
+            rate REAL NOT NULL,
+            wastage REAL NOT NULL,
+            making REAL NOT NULL,
+            effective_ts INTEGER NOT NULL,
+            recorded_at TEXT NOT NULL
+        )
+    ''')
+    cursor.execute(
+        'CREATE INDEX IF NOT EXISTS idx_metal_rate_history_metal_ts ON metal_rate_history(metal, effective_ts)'
+    )
+    for event in ('UPDATE', 'DELETE'):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS metal_rate_history_no_{event.lower()} BEFORE {event} ON metal_rate_history BEGIN
+                SELECT RAISE(ABORT, 'metal_rate_history is append-only');
+            END
+        ''')
+
+    # Seed each metal's current rate, effective from when it was last saved
+    cursor.execute(f'''
+        INSERT INTO metal_rate_history (metal, rate, wastage, making, effective_ts, recorded_at)
+        SELECT metal, rate, wastage, making, {_EPOCH_SQL.format(date='updated_at')}, updated_at
+        FROM metal_rates m
+        WHERE NOT EXISTS (SELECT 1 FROM metal_rate_history h WHERE h.metal = m.metal)
+    ''')
+
+    # Every saved rate that differs from the metal's latest entry becomes a new entry
+    record = f'''
+        INSERT INTO metal_rate_history (metal, rate, wastage, making, effective_ts, recorded_at)
+        VALUES (NEW.metal, NEW.rate, NEW.wastage, NEW.making, {_EPOCH_SQL.format(date='NEW.updated_at')}, NEW.updated_at);
+    '''
+    changed = '''
+        NOT EXISTS (
+            SELECT 1 FROM (
+                SELECT rate, wastage, making FROM metal_rate_history
+                WHERE metal = NEW.metal ORDER BY effective_ts DESC, id DESC LIMIT 1
+            )
+            WHERE rate = NEW.rate AND wastage = NEW.wastage AND making = NEW.making
+        )
+    '''
+    cursor.execute(f'CREATE TRIGGER IF NOT EXISTS metal_rate_history_insert AFTER INSERT ON metal_rates '
+                   f'WHEN {changed} BEGIN {record} END')
+    cursor.execute(f'CREATE TRIGGER IF NOT EXISTS metal_rate_history_update AFTER UPDATE OF rate, wastage, making '
+                   f'ON metal_rates WHEN {changed} BEGIN {record} END')
+
+
+def _v15_date_ts_order(cursor):
+    """Bucket the rollups and order first/last purchases by date_ts instead of the date text"""
+    # Keyset pages walk idx_invoices_date_ts, which orders by (date_ts, id); the text index is unused
+    cursor.execute('DROP INDEX IF EXISTS idx_invoices_date')
+
+    # These triggers are created after invoices_derived_* and so fire before it refreshes
+    # date_ts: they compute the same epoch from the date as written
+    for trigger in ('daily_sales_paise_insert', 'daily_sales_paise_delete', 'daily_sales_paise_update'):
+        cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    paise_columns = ', '.join(paise for _, paise in _MONEY_COLUMNS)
+    cursor.execute('DELETE FROM daily_sales_paise')
+    cursor.execute(f'''
+        INSERT INTO daily_sales_paise (day, invoice_count, {paise_columns})
+        SELECT COALESCE(date(date_ts, 'unixepoch'), ''), COUNT(*),
+               {', '.join(f'SUM({paise})' for _, paise in _MONEY_COLUMNS)}
+        FROM invoices
+        GROUP BY 1
+    ''')
+    _create_daily_sales_paise_triggers(
+        cursor, f"COALESCE(date({_EPOCH_SQL.format(date='{row}.date')}, 'unixepoch'), '')"
+    )
+
+    # Items are written after their invoice is complete, so its date_ts is current
+    for trigger in ('metal_monthly_sales_insert', 'metal_monthly_sales_delete'):
+        cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    cursor.execute('DELETE FROM metal_monthly_sales')
+    cursor.execute('''
+        INSERT INTO metal_monthly_sales (metal, month, item_count, invoice_count, weight, rate_sum,
+                                         item_value, wastage_amount, making_amount, line_total)
+        SELECT ii.metal, COALESCE(strftime('%Y-%m', i.date_ts, 'unixepoch'), ''), COUNT(*),
+               COUNT(DISTINCT ii.invoice_id), SUM(ii.weight), SUM(ii.rate), SUM(ii.item_value),
+               SUM(ii.wastage_amount), SUM(ii.making_amount), SUM(ii.line_total)
+        FROM invoice_items ii
+        LEFT JOIN invoices i ON i.id = ii.invoice_id
+        GROUP BY 1, 2
+    ''')
+    _create_metal_monthly_sales_triggers(
+        cursor,
+        "COALESCE((SELECT strftime('%Y-%m', date_ts, 'unixepoch') FROM invoices WHERE id = {row}.invoice_id), '')"
+    )
+
+    # A customer's first/last purchase is the date of their earliest/latest invoice by
+    # (epoch, id); unparseable dates sort after every real one
+    epoch = _EPOCH_SQL.format(date='date')
+    first_purchase = (f'(SELECT date FROM invoices WHERE customer_id = {{customer}} '
+                      f'ORDER BY {epoch} IS NULL, {epoch}, id LIMIT 1)')
+    last_purchase = (f'(SELECT date FROM invoices WHERE customer_id = {{customer}} '
+                     f'ORDER BY {epoch} DESC, id DESC LIMIT 1)')
+    for trigger in ('customer_stats_insert', 'customer_stats_delete', 'customer_stats_update'):
+        cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    cursor.execute(f'''
+        UPDATE customer_stats SET
+            first_purchase = {first_purchase.format(customer='customer_stats.customer_id')},
+            last_purchase = {last_purchase.format(customer='customer_stats.customer_id')}
+    ''')
+    add_purchase = f'''
+        INSERT INTO customer_stats (customer_id, invoice_count, subtotal, discount_amount, total,
+                                    first_purchase, last_purchase)
+        VALUES (NEW.customer_id, 1, NEW.subtotal, COALESCE(NEW.discount_amount, 0), NEW.total, NEW.date, NEW.date)
+        ON CONFLICT(customer_id) DO UPDATE SET
+            invoice_count = invoice_count + 1,
+            subtotal = subtotal + excluded.subtotal,
+            discount_amount = discount_amount + excluded.discount_amount,
+            total = total + excluded.total,
+            first_purchase = {first_purchase.format(customer='NEW.customer_id')},
+            last_purchase = {last_purchase.format(customer='NEW.customer_id')};
+    '''
+    remove_purchase = f'''
+        UPDATE customer_stats SET
+            invoice_count = invoice_count - 1,
+            subtotal = subtotal - OLD.subtotal,
+            discount_amount = discount_amount - COALESCE(OLD.discount_amount, 0),
+            total = total - OLD.total,
+            first_purchase = {first_purchase.format(customer='OLD.customer_id')},
+            last_purchase = {last_purchase.format(customer='OLD.customer_id')}
+        WHERE customer_id = OLD.customer_id;
+    '''
+    cursor.execute(f'CREATE TRIGGER IF NOT EXISTS customer_stats_insert AFTER INSERT ON invoices BEGIN {add_purchase} END')
+    cursor.execute(f'CREATE TRIGGER IF NOT EXISTS customer_stats_delete AFTER DELETE ON invoices BEGIN {remove_purchase} END')
+    cursor.execute(
+        'CREATE TRIGGER IF NOT EXISTS customer_stats_update '
+        'AFTER UPDATE OF customer_id, date, subtotal, discount_amount, total ON invoices '
+        f'BEGIN {remove_purchase} {add_purchase} END'
+    )
+
+
+def _v16_invoice_order_index(cursor):
+    """Index the invoice list order, which sorts unparseable dates (NULL date_ts) last as -1"""
+    # Must match database.INVOICE_ORDER_SQL; implicitly ends in the rowid, like every index
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_invoices_order ON invoices(COALESCE(date_ts, -1))')
+
+
+# Ordered list of migrations; migration N (1-based) brings a file to user_version N
+MIGRATIONS = [
+    _v1_initial_schema,
+    _v2_secondary_indexes,
+    _v3_invoice_keyset_index,
+    _v4_admin_rollups,
+    _v5_daily_sales,
+    _v6_metal_monthly_sales,
+    _v7_customer_stats,
+    _v8_customer_search,
+    _v9_invoice_search,
+    _v10_invoice_timestamps,
+    _v11_integer_money,
+    _v12_settings_version,
+    _v13_metal_rates,
+    _v14_metal_rate_history,
+    _v15_date_ts_order,
+    _v16_invoice_order_index,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_schema_version(conn):
+    """Read the schema version stored in the database file"""
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn):
+    """Apply pending migrations on a connection. Returns the resulting version."""
+    version = get_schema_version(conn)
+    if version >= SCHEMA_VERSION:
+        return version
+
+    # IMMEDIATE takes the write lock up front so concurrent processes serialize here
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        version = get_schema_version(conn)
+        cursor = conn.cursor()
+        for number, migration in enumerate(MIGRATIONS, start=1):
+            if number > version:
+                migration(cursor)
+                cursor.execute(f'PRAGMA user_version = {number}')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return get_schema_version(conn)
+
+
+_migrated = set()  # (absolute path, file identity) pairs already at SCHEMA_VERSION
+_migrated_lock = threading.Lock()
+
+
+def ensure_schema(db_path, force=False):
+    """Bring a database file up to date, at most once per file per process.
+
+    Pass force=True after the file's contents were replaced in place
+    (e.g. restoring a backup over it).
+    """
+    path = os.path.abspath(db_path)
+    if not force and (path, file_identity(db_path)) in _migrated:
+        return
+
+    with _migrated_lock:
+        if not force and (path, file_identity(db_path)) in _migrated:
+            return
+        with get_pool(db_path).connection() as conn:
+            migrate(conn)
+        _migrated.add((path, file_identity(db_path)))
@@ -0,0 +1,197 @@
+"""Content-addressed cache for rendered invoice PDFs"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from pdf_generator import create_invoice_pdf, create_thermal_invoice_pdf
+
+
+# Bump when the PDF layout changes so old cached files are not served
+PDF_LAYOUT_VERSION = 1
+
+# A full disk tier is trimmed to this share of max_disk_entries, so the directory
+# scan runs once per batch of new files instead of on every write
+DISK_TRIM_RATIO = 0.9
+
+RENDERERS = {
+    'a4': create_invoice_pdf,
+    'thermal': create_thermal_invoice_pdf,
+}
+
+
+def pdf_cache_key(kind, invoice, items_df, customer):
+    """Hash the invoice header, items and customer into a cache key.
+    Any edit (e.g. through update_invoice) changes the key, so stale PDFs are never served."""
+    payload = {
+        'layout': PDF_LAYOUT_VERSION,
+        'kind': kind,
+        'invoice': invoice,
+        'items': items_df.to_dict('records') if items_df is not None else [],
+        'customer': customer,
+    }
+    encoded = json.dumps(payload, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class PDFCache:
+    """Two-tier (memory LRU + on-disk) cache of rendered PDFs.
+    Entries are kept per tenant (one subdirectory each on disk) so a tenant's
+    PDFs can be purged together with its data."""
+
+    def __init__(self, max_entries=64, max_bytes=32 * 1024 * 1024, cache_dir='.pdf_cache', max_disk_entries=2000):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.max_disk_entries = max_disk_entries
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_count = None  # Files in the disk tier; None until the first scan
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'disk_evictions': 0}
+
+    def _disk_path(self, tenant, key):
+        return os.path.join(self.cache_dir, tenant, f"{key}.pdf")
+
+    def _remember(self, key, data):
+        """Add to the memory tier and evict least-recently-used entries (lock held)"""
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory and (len(self._memory) > self.max_entries or self._memory_bytes > self.max_bytes):
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+            self._stats['evictions'] += 1
+
+    def _read_disk(self, tenant, key):
+        if not self.cache_dir:
+            return None
+        path = self._disk_path(tenant, key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)  # Keep recently used files from being evicted
+            return data
+        except OSError:
+            return None
+
+    def _write_disk(self, tenant, key, data):
+        if not self.cache_dir:
+            return
+        try:
+            tenant_dir = os.path.join(self.cache_dir, tenant)
+            os.makedirs(tenant_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=tenant_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self._disk_path(tenant, key))
+        except OSError:
+            return  # The disk tier is best-effort
+        with self._lock:
+            if self._disk_count is not None:
+                self._disk_count += 1
+                if self._disk_count <= self.max_disk_entries:
+                    return
+        self._trim_disk()
+
+    def _trim_disk(self):
+        """Recount the files on disk; past max_disk_entries, delete the least recently used
+        down to the DISK_TRIM_RATIO mark"""
+        entries = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith('.pdf'):
+                    path = os.path.join(root, name)
+                    try:
+                        entries.append((os.path.getmtime(path), path))
+                    except OSError:
+                        pass
+        removed = 0
+        if len(entries) > self.max_disk_entries:
+            keep = int(self.max_disk_entries * DISK_TRIM_RATIO)
+            for _, path in sorted(entries)[:len(entries) - keep]:
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    pass
+        with self._lock:
+            self._disk_count = len(entries) - removed
+            self._stats['disk_evictions'] += removed
+
+    def get(self, kind, invoice, items_df, customer, tenant):
+        """Return PDF bytes for a tenant's invoice, rendering only on a cache miss"""
+        key = pdf_cache_key(kind, invoice, items_df, customer)
+        memory_key = f"{tenant}/{key}"
+
+        with self._lock:
+            if memory_key in self._memory:
+                self._memory.move_to_end(memory_key)
+                self._stats['hits'] += 1
+                return self._memory[memory_key]
+
+        data = self._read_disk(tenant, key)
+        if data is not None:
+            with self._lock:
+                self._stats['disk_hits'] += 1
+                self._remember(memory_key, data)
+            return data
+
+        data = RENDERERS[kind](invoice, items_df, customer).getvalue()
+        with self._lock:
+            self._stats['misses'] += 1
+            self._remember(memory_key, data)
+        self._write_disk(tenant, key, data)
+        return data
+
+    def purge(self, tenant):
+        """Drop every cached PDF of a tenant, in memory and on disk"""
+        prefix = f"{tenant}/"
+        with self._lock:
+            for memory_key in [k for k in self._memory if k.startswith(prefix)]:
+                self._memory_bytes -= len(self._memory.pop(memory_key))
+            self._disk_count = None  # Recounted on the next write
+        if self.cache_dir:
+            shutil.rmtree(os.path.join(self.cache_dir, tenant), ignore_errors=True)
+
+    def clear(self):
+        """Drop the memory tier (disk files are left in place)"""
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+
+    def stats(self):
+        """Return hit/miss/eviction counters and current memory usage"""
+        with self._lock:
+            return dict(self._stats, entries=len(self._memory), bytes=self._memory_bytes)
+
+
+_default_cache = PDFCache()
+
+
+def _tenant_key(db_path):
+    return os.path.basename(db_path)
+
+
+def get_invoice_pdf(invoice, items_df, customer, db_path):
+    """A4 invoice PDF bytes from the shared cache, for an invoice of the given database"""
+    return _default_cache.get('a4', invoice, items_df, customer, _tenant_key(db_path))
+
+
+def get_thermal_invoice_pdf(invoice, items_df, customer, db_path):
+    """Thermal (80mm) invoice PDF bytes from the shared cache, for an invoice of the given database"""
+    return _default_cache.get('thermal', invoice, items_df, customer, _tenant_key(db_path))
+
+
+def forget_tenant_pdfs(db_path):
+    """Delete a database's cached PDFs (they hold customer details), e.g. after its data is deleted"""
+    _default_cache.purge(_tenant_key(db_path))
+
+
+def get_pdf_cache_stats():
+    """Stats for the shared PDF cache"""
+    return _default_cache.stats()
@@ -0,0 +1,132 @@
+"""Point-in-time lookups over the metal rate history.
+
+Every change to the shop-wide rates is appended to ``metal_rate_history`` in
+the auth database (by trigger), and backdated board rates can be recorded
+directly. The history is loaded once per process into per-metal sorted arrays;
+a single lookup is a bisect and bulk as-of joins are one ``searchsorted`` per
+metal. The table is append-only, so its largest id tells whether the cached
+copy is current.
+"""
+import bisect
+import os
+import threading
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from connection_pool import get_pool, file_identity
+from migrations import ensure_schema
+from metal_rates import RATES_DB_NAME, RATE_FIELDS
+
+
+# history path -> (file identity, max id, {metal: (effective timestamps, [rate dicts])})
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def to_epoch(when):
+    """Epoch seconds for a date/datetime (or string/Timestamp) value, or the value itself if numeric.
+    Naive times are read as UTC, like invoices.date_ts."""
+    if isinstance(when, (int, float, np.integer, np.floating)):
+        return int(when)
+    timestamp = pd.Timestamp(when)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert('UTC').tz_localize(None)
+    return int(timestamp.value // 10 ** 9)
+
+
+def _history(directory):
+    """{metal: (timestamps, rates)} sorted by effective time, reloaded only after new entries"""
+    path = os.path.join(directory, RATES_DB_NAME)
+    ensure_schema(path)
+    key = os.path.abspath(path)
+    file_id = file_identity(path)
+    with get_pool(path).connection() as conn:
+        max_id = conn.execute('SELECT MAX(id) FROM metal_rate_history').fetchone()[0]
+        cached = _cache.get(key)
+        if cached and cached[:2] == (file_id, max_id):
+            return cached[2]
+        history = {}
+        for metal, effective_ts, *values in conn.execute('''
+            SELECT metal, effective_ts, rate, wastage, making FROM metal_rate_history
+            ORDER BY metal, effective_ts, id
+        '''):
+            timestamps, rates = history.setdefault(metal, ([], []))
+            timestamps.append(effective_ts)
+            rates.append(dict(zip(RATE_FIELDS, values)))
+    with _cache_lock:
+        _cache[key] = (file_id, max_id, history)
+    return history
+
+
+def record_rate(metal, rate, wastage, making, effective=None, directory='.'):
+    """Append a board rate for a metal, effective from a given time (default now)"""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    path = os.path.join(directory, RATES_DB_NAME)
+    ensure_schema(path)
+    with get_pool(path).connection() as conn:
+        conn.execute(
+            'INSERT INTO metal_rate_history (metal, rate, wastage, making, effective_ts, recorded_at) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (metal, float(rate), float(wastage), float(making), to_epoch(now if effective is None else effective), now)
+        )
+        conn.commit()
+
+
+def _rate_in(history, metal, timestamp):
+    """Bisect a metal's loaded history for the rate in effect at an epoch timestamp"""
+    timestamps, rates = history.get(metal, ([], []))
+    position = bisect.bisect_right(timestamps, timestamp) - 1
+    return dict(rates[position]) if position >= 0 else None
+
+
+def rate_at(metal, when, directory='.'):
+    """The {'rate', 'wastage', 'making'} board rate of a metal in effect at a time, or None"""
+    return _rate_in(_history(directory), metal, to_epoch(when))
+
+
+def rates_at(when, directory='.'):
+    """Board rates of every metal that had one at a time (one cache check for all metals)"""
+    history = _history(directory)
+    timestamp = to_epoch(when)
+    rates = {}
+    for metal in history:
+        rate = _rate_in(history, metal, timestamp)
+        if rate is not None:
+            rates[metal] = rate
+    return rates
+
+
+def get_rate_history(metal=None, directory='.'):
+    """The recorded rates (optionally of one metal) as a DataFrame, oldest first"""
+    path = os.path.join(directory, RATES_DB_NAME)
+    ensure_schema(path)
+    query = 'SELECT metal, rate, wastage, making, effective_ts, recorded_at FROM metal_rate_history'
+    params = []
+    if metal:
+        query += ' WHERE metal = ?'
+        params.append(metal)
+    query += ' ORDER BY metal, effective_ts, id'
+    with get_pool(path).connection() as conn:
+        df = pd.read_sql_query(query, conn, params=params)
+    df.insert(5, 'effective', pd.to_datetime(df['effective_ts'], unit='s').dt.strftime('%Y-%m-%d %H:%M:%S'))
+    return df
+
+
+def board_rates_asof(metals, timestamps, directory='.'):
+    """As-of join: the board rate in effect for each (metal, epoch timestamp) pair.
+    Returns a DataFrame aligned with the inputs with board_rate, board_wastage and
+    board_making columns (NaN where the metal had no rate yet)."""
+    metals = pd.Series(metals).reset_index(drop=True)
+    timestamps = pd.Series(timestamps, dtype='int64').to_numpy()
+    result = {field: np.full(len(metals), np.nan) for field in RATE_FIELDS}
+    history = _history(directory)
+    for metal, positions in metals.groupby(metals).indices.items():
+        if metal not in history:
+            continue
+        metal_timestamps, rates = history[metal]
+        found = np.searchsorted(np.asarray(metal_timestamps), timestamps[positions], side='right') - 1
+        hit = found >= 0
+        for field in RATE_FIELDS:
+            values = np.array([rate[field] for rate in rates])
+            result[field][positions[hit]] = values[found[hit]]
+    return pd.DataFrame({f'board_{field}': values for field, values in result.items()})
@@ -0,0 +1,208 @@
+"""Central per-tenant rollups for the admin overview.
+
+Per-tenant customer counts and per-tenant, per-day invoice totals live in the
+auth database next to the tenant files. Database write paths push deltas here
+after they commit, so the admin overview is one small query instead of a scan
+of every tenant. The rollups are derived data: ``rebuild_all()`` (or
+``python rollups.py rebuild``) recomputes them from the tenant files.
+"""
+import fnmatch
+import os
+import sqlite3
+import sys
+import threading
+import pandas as pd
+from connection_pool import get_pool
+from federation import USER_DB_PATTERN, ADMIN_DB_PATH, tenant_databases
+from migrations import ensure_schema
+
+
+ROLLUP_DB_NAME = 'jewelcalc_auth.db'
+
+# Tenants whose last rollup update failed; they are rebuilt on the next read
+_stale_tenants = set()
+_stale_lock = threading.Lock()
+
+
+def is_tenant_db(db_path):
+    """True for database files that belong in the admin rollups"""
+    name = os.path.basename(db_path)
+    return name == ADMIN_DB_PATH or fnmatch.fnmatch(name, USER_DB_PATTERN)
+
+
+def _rollup_path(db_path):
+    """The rollup store sits in the same directory as the tenant files"""
+    return os.path.join(os.path.dirname(db_path), ROLLUP_DB_NAME)
+
+
+def _tenant_key(db_path):
+    return os.path.basename(db_path)
+
+
+def _write(db_path, statements):
+    """Run (sql, params) statements against the rollup store in one transaction.
+    A failure marks the tenant stale instead of failing the tenant write that already committed."""
+    rollup_path = _rollup_path(db_path)
+    try:
+        ensure_schema(rollup_path)
+        with get_pool(rollup_path).connection() as conn:
+            for sql, params in statements:
+                if isinstance(params, list):
+                    conn.executemany(sql, params)
+                else:
+                    conn.execute(sql, params)
+            conn.commit()
+    except sqlite3.Error:
+        with _stale_lock:
+            _stale_tenants.add(os.path.abspath(db_path))
+
+
+def record_invoices(db_path, day_totals, sign=1):
+    """Add (sign=1) or remove (sign=-1) invoices from a tenant's daily rollups.
+    day_totals rows are (day, count, subtotal, discount_amount, cgst_amount, sgst_amount, total)."""
+    if not is_tenant_db(db_path) or not day_totals:
+        return
+    tenant = _tenant_key(db_path)
+    _write(db_path, [
+        ('INSERT OR IGNORE INTO tenant_totals (db_path, customers) VALUES (?, 0)', (tenant,)),
+        ('''
+            INSERT INTO tenant_daily_totals
+                (db_path, day, invoice_count, subtotal, discount_amount, cgst_amount, sgst_amount, total)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(db_path, day) DO UPDATE SET
+                invoice_count = invoice_count + excluded.invoice_count,
+                subtotal = subtotal + excluded.subtotal,
+                discount_amount = discount_amount + excluded.discount_amount,
+                cgst_amount = cgst_amount + excluded.cgst_amount,
+                sgst_amount = sgst_amount + excluded.sgst_amount,
+                total = total + excluded.total
+        ''', [(tenant, day) + tuple(sign * (value or 0) for value in values) for day, *values in day_totals]),
+        ('DELETE FROM tenant_daily_totals WHERE db_path = ? AND invoice_count <= 0', (tenant,)),
+    ])
+
+
+def record_customers(db_path, delta):
+    """Adjust a tenant's customer count"""
+    if not is_tenant_db(db_path) or not delta:
+        return
+    _write(db_path, [(
+        '''
+            INSERT INTO tenant_totals (db_path, customers) VALUES (?, ?)
+            ON CONFLICT(db_path) DO UPDATE SET customers = customers + excluded.customers
+        ''', (_tenant_key(db_path), delta)
+    )])
+
+
+def forget_tenant(db_path):
+    """Drop a tenant's rollups (e.g. after its database file is deleted)"""
+    tenant = _tenant_key(db_path)
+    _write(db_path, [
+        ('DELETE FROM tenant_daily_totals WHERE db_path = ?', (tenant,)),
+        ('DELETE FROM tenant_totals WHERE db_path = ?', (tenant,)),
+    ])
+
+
+def rebuild_tenant(db_path):
+    """Recompute a tenant's rollups from its database file"""
+    if not is_tenant_db(db_path):
+        return
+    ensure_schema(db_path)
+    with get_pool(db_path).connection() as conn:
+        customers = conn.execute('SELECT COUNT(*) FROM customers').fetchone()[0]
+        # The tenant's trigger-maintained daily_sales_paise already holds the per-day sums
+        day_totals = conn.execute('''
+            SELECT day, invoice_count, subtotal_paise / 100.0, discount_paise / 100.0,
+                   cgst_paise / 100.0, sgst_paise / 100.0, total_paise / 100.0
+            FROM daily_sales_paise
+        ''').fetchall()
+    tenant = _tenant_key(db_path)
+    with _stale_lock:
+        _stale_tenants.discard(os.path.abspath(db_path))
+    _write(db_path, [
+        ('DELETE FROM tenant_daily_totals WHERE db_path = ?', (tenant,)),
+        ('INSERT OR REPLACE INTO tenant_totals (db_path, customers) VALUES (?, ?)', (tenant, customers)),
+        ('''
+            INSERT INTO tenant_daily_totals
+                (db_path, day, invoice_count, subtotal, discount_amount, cgst_amount, sgst_amount, total)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [(tenant,) + tuple(row) for row in day_totals]),
+    ])
+
+
+def rebuild_all(directory='.'):
+    """Recompute the rollups of every tenant database in a directory"""
+    rollup_path = os.path.join(directory, ROLLUP_DB_NAME)
+    ensure_schema(rollup_path)
+    with get_pool(rollup_path).connection() as conn:
+        conn.execute('DELETE FROM tenant_daily_totals')
+        conn.execute('DELETE FROM tenant_totals')
+        conn.commit()
+    tenants = [path for _, path, _ in tenant_databases(directory)]
+    for path in tenants:
+        rebuild_tenant(path)
+    return len(tenants)
+
+
+def get_tenant_totals(directory='.'):
+    """Per-tenant customers, invoices, revenue, tax and discount totals for the admin overview.
+    Tenants that are new to the rollups (or whose last update failed) are rebuilt first,
+    and rollups of deleted files are dropped."""
+    rollup_path = os.path.join(directory, ROLLUP_DB_NAME)
+    ensure_schema(rollup_path)
+    tenants = tenant_databases(directory)
+    on_disk = {_tenant_key(path) for _, path, _ in tenants}
+
+    with get_pool(rollup_path).connection() as conn:
+        known = {row[0] for row in conn.execute('SELECT db_path FROM tenant_totals')}
+    with _stale_lock:
+        stale = {path for _, path, _ in tenants if os.path.abspath(path) in _stale_tenants}
+    for _, path, _ in tenants:
+        if _tenant_key(path) not in known or path in stale:
+            try:
+                rebuild_tenant(path)
+            except sqlite3.Error:
+                pass  # Unreadable files are reported by the federated views
+    for tenant in known - on_disk:
+        forget_tenant(os.path.join(directory, tenant))
+
+    with get_pool(rollup_path).connection() as conn:
+        return pd.read_sql_query('''
+            SELECT
+                t.db_path, t.customers,
+                COALESCE(SUM(d.invoice_count), 0) AS invoices,
+                COALESCE(SUM(d.total), 0) AS revenue,
+                COALESCE(SUM(d.cgst_amount + d.sgst_amount), 0) AS tax,
+                COALESCE(SUM(d.discount_amount), 0) AS discount
+            FROM tenant_totals t
+            LEFT JOIN tenant_daily_totals d ON d.db_path = t.db_path
+            GROUP BY t.db_path
+            ORDER BY t.db_path != ?, t.db_path
+        ''', conn, params=(ADMIN_DB_PATH,))
+
+
+def get_daily_totals(directory='.', db_path=None, start_date=None, end_date=None):
+    """Per-day rollups, optionally for one tenant and/or a date range"""
+    rollup_path = os.path.join(directory, ROLLUP_DB_NAME)
+    ensure_schema(rollup_path)
+    query = 'SELECT * FROM tenant_daily_totals WHERE 1=1'
+    params = []
+    if db_path:
+        query += ' AND db_path = ?'
+        params.append(_tenant_key(db_path))
+    if start_date:
+        query += ' AND day >= ?'
+        params.append(start_date)
+    if end_date:
+        query += ' AND day <= ?'
+        params.append(end_date)
+    query += ' ORDER BY day, db_path'
+    with get_pool(rollup_path).connection() as conn:
+        return pd.read_sql_query(query, conn, params=params)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] != ['rebuild']:
+        print("Usage: python rollups.py rebuild [directory]")
+        sys.exit(1)
+    count = rebuild_all(sys.argv[2] if len(sys.argv) > 2 else '.')
+    print(f"Rebuilt rollups for {count} tenant database(s)")
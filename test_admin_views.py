@@ -3,14 +3,18 @@
 Test script for admin cross-database viewing functionality
 """
 
+import json
 import os
 import sys
 from database import Database
+from connection_pool import close_all_pools, get_pool
 from auth import hash_password
 
 def cleanup_test_files():
     """Remove test database files"""
     import glob
+    # Close pooled connections so the files can be removed
+    close_all_pools()
     test_patterns = ['test_*.db', 'jewelcalc_test*.db', 'jewelcalc_user_*.db', 'jewelcalc_admin.db', 'jewelcalc_auth.db']
     for pattern in test_patterns:
         for f in glob.glob(pattern):
@@ -121,6 +125,298 @@ def test_admin_cross_database_views():
     
     print("\n✅ Admin cross-database views test passed!\n")
 
+def test_federated_queries():
+    """Test admin queries across more tenant files than there are worker threads"""
+    print("Testing Federated Admin Queries...")
+    import time
+    from federation import MAX_WORKERS, federated_query, tenant_databases
+    
+    cleanup_test_files()
+    items = [{
+        'metal': 'Gold 22K', 'weight': 1.0, 'rate': 6000.0,
+        'wastage_percent': 0, 'making_percent': 0, 'item_value': 6000.0,
+        'wastage_amount': 0, 'making_amount': 0, 'line_total': 6000.0
+    }]
+    
+    # More tenants than worker threads
+    tenant_count = MAX_WORKERS * 2 + 1
+    for n in range(1, tenant_count + 1):
+        tenant_db = Database(f'jewelcalc_user_{n}.db')
+        customer_id = tenant_db.add_customer('CUS-00001', f'Tenant {n} Customer', f'90000{n:05d}', '')
+        tenant_db.save_invoice(customer_id, f'INV-T{n:03d}', items, 1.5, 1.5, 0)
+    admin_db = Database('jewelcalc_admin.db')
+    admin_db.add_customer('CUS-00001', 'Admin Copy', '9000000001', '')  # Same phone as tenant 1
+    
+    # A damaged tenant file is skipped instead of failing the whole view
+    with open('jewelcalc_user_999.db', 'wb') as f:
+        f.write(b'not a database' * 100)
+    
+    all_customers = admin_db.get_all_customers_admin()
+    assert len(all_customers) == tenant_count, f"Expected {tenant_count} customers, got {len(all_customers)}"
+    assert 'Admin' not in set(all_customers['database']), "Duplicate admin customer should be hidden"
+    print(f"✓ {tenant_count} tenants read on {MAX_WORKERS} worker threads")
+    
+    all_invoices = admin_db.get_all_invoices_admin()
+    assert len(all_invoices) == tenant_count, f"Expected {tenant_count} invoices, got {len(all_invoices)}"
+    assert all_invoices['sort_ts'].is_monotonic_decreasing, "Invoices should be sorted newest first"
+    assert set(all_invoices['db_path']) == {f'jewelcalc_user_{n}.db' for n in range(1, tenant_count + 1)}
+    failures = all_invoices.attrs['failures']
+    assert [f['db_path'] for f in failures] == ['jewelcalc_user_999.db'], f"Damaged file should be reported: {failures}"
+    print("✓ Invoices combined and sorted in SQL; damaged file skipped and reported")
+    
+    # Page through the heap-merged recent invoices; ties on sort_ts cross databases
+    expected = all_invoices.sort_values(['sort_ts', 'db_path', 'id'], ascending=False)
+    paged = []
+    before = None
+    while True:
+        page = admin_db.get_recent_invoices_admin(4, before=before)
+        paged.extend(zip(page['db_path'], page['id']))
+        if len(page) < 4:
+            break
+        last = page.iloc[-1]
+        before = (last['sort_ts'], last['db_path'], int(last['id']))
+    assert paged == list(zip(expected['db_path'], expected['id'])), "Pages should follow the merged order without gaps"
+    assert page.attrs['failures'][0]['db_path'] == 'jewelcalc_user_999.db', "Damaged file should be reported"
+    assert len(admin_db.get_recent_invoices_admin(10, search='T007')) == 1, "Search should apply in every database"
+    assert admin_db.get_recent_invoices_admin(10, search='T007', end_date='2000-01-01').empty, \
+        "Date range should apply in every database"
+    print("✓ Recent invoices paged through a k-way merge")
+    
+    # Undated invoices (unparseable dates) merge last across databases and stay reachable
+    for n in (1, 2):
+        undated = {
+            'invoice_no': f'INV-UNDATED-{n}', 'customer_id': 1, 'date': 'N/A', 'subtotal': 6000.0,
+            'cgst_percent': 0, 'sgst_percent': 0, 'cgst_amount': 0, 'sgst_amount': 0, 'total': 6000.0,
+        }
+        assert Database(f'jewelcalc_user_{n}.db').import_invoices_json(json.dumps([undated]))[0] == 1
+    expected = admin_db.get_all_invoices_admin().sort_values(['sort_ts', 'db_path', 'id'], ascending=False)
+    paged = []
+    before = None
+    while True:
+        page = admin_db.get_recent_invoices_admin(4, before=before)
+        paged.extend(page['invoice_no'])
+        if len(page) < 4:
+            break
+        last = page.iloc[-1]
+        before = (last['sort_ts'], last['db_path'], int(last['id']))
+    assert paged == expected['invoice_no'].tolist(), "Pages should reach undated invoices"
+    assert paged[-2:] == ['INV-UNDATED-2', 'INV-UNDATED-1'], "Undated invoices should sort last"
+    print("✓ Undated invoices page last through the merge")
+    
+    # A slow tenant times out on its own; the rest are read concurrently and still returned
+    Database('jewelcalc_user_3.db').add_customer('CUS-00002', 'Slow', '9100000000', '')
+    slow_sql = '''
+        WITH RECURSIVE c(x) AS (
+            SELECT 1 UNION ALL
+            SELECT x + 1 FROM c WHERE x < (SELECT COUNT(*) * 1000000000 FROM {db}.customers WHERE name = 'Slow')
+        )
+        SELECT COUNT(*) AS n FROM c
+    '''
+    started = time.monotonic()
+    df = federated_query(slow_sql, 'SELECT r.n, t.db_path FROM results r JOIN tenants t USING (tenant_order)', ['n', 'db_path'],
+                         timeout=0.5)
+    elapsed = time.monotonic() - started
+    failures = {f['db_path']: f['error'] for f in df.attrs['failures']}
+    assert failures.get('jewelcalc_user_3.db') == 'timed out after 0.5s', f"Slow tenant should time out: {failures}"
+    assert len(df) == len(tenant_databases()) - 2, "Every other readable tenant should still answer"
+    assert elapsed < 3, f"Only the slow tenant should wait for the timeout, took {elapsed:.1f}s"
+    print("✓ Each tenant has its own timeout")
+    
+    cleanup_test_files()
+    print("\n✅ Federated admin query test passed!\n")
+
+def test_admin_rollups():
+    """Test that the central rollups track every write path and match a rebuild"""
+    print("Testing Admin Rollups...")
+    from rollups import get_tenant_totals, rebuild_all
+    
+    cleanup_test_files()
+    items = [{
+        'metal': 'Gold 22K', 'weight': 1.0, 'rate': 6000.0,
+        'wastage_percent': 0, 'making_percent': 0, 'item_value': 6000.0,
+        'wastage_amount': 0, 'making_amount': 0, 'line_total': 6000.0
+    }]
+    
+    def expected_totals():
+        """Recompute the overview numbers straight from the tenant files"""
+        rows = {}
+        for path in ('jewelcalc_admin.db', 'jewelcalc_user_1.db', 'jewelcalc_user_2.db'):
+            tenant_db = Database(path)
+            invoices = tenant_db.get_invoices()
+            rows[path] = (len(tenant_db.get_customers()), len(invoices), round(invoices['total'].sum(), 6))
+        return rows
+    
+    def rollup_totals():
+        df = get_tenant_totals()
+        return {row['db_path']: (row['customers'], row['invoices'], round(row['revenue'], 6))
+                for _, row in df.iterrows()}
+    
+    admin_db = Database('jewelcalc_admin.db')
+    admin_db.add_customer('CUS-00001', 'Admin Customer', '9000000000', '')
+    user1_db = Database('jewelcalc_user_1.db')
+    user2_db = Database('jewelcalc_user_2.db')
+    
+    # Every write path updates the rollups incrementally
+    c1 = user1_db.add_customer('CUS-00001', 'One', '9000000001', '')
+    c2 = user1_db.add_customer('CUS-00002', 'Two', '9000000002', '')
+    user1_db.save_invoice(c1, 'INV-R1', items, 1.5, 1.5, 0)
+    user1_db.save_invoice(c1, 'INV-R2', items, 1.5, 1.5, 10)
+    user1_db.save_invoice(c2, 'INV-R3', items, 1.5, 1.5, 0)
+    invoice, _, _ = user1_db.get_invoice_by_number('INV-R1')
+    user1_db.update_invoice(int(invoice['id']), items * 2, 1.5, 1.5, 5)
+    user1_db.duplicate_invoice(int(invoice['id']), 'INV-R1-COPY')
+    invoice, _, _ = user1_db.get_invoice_by_number('INV-R2')
+    user1_db.delete_invoice(int(invoice['id']))
+    user1_db.delete_customer(c2)
+    user2_db.import_customers_csv("account_no,name,phone,address\n,Imported,9000000003,\n")
+    user2_db.import_invoices_ndjson(user1_db.export_invoices_ndjson().splitlines())
+    assert rollup_totals() == expected_totals(), f"Rollups drifted: {rollup_totals()} vs {expected_totals()}"
+    print("✓ Rollups follow save, update, duplicate, delete and import")
+    
+    # A full rebuild gives the same answer
+    assert rebuild_all() == 3, "Rebuild should visit every tenant database"
+    assert rollup_totals() == expected_totals(), "Rebuilt rollups should match the tenant files"
+    print("✓ Rebuild reproduces the incremental rollups")
+    
+    cleanup_test_files()
+    print("\n✅ Admin rollup test passed!\n")
+
+def test_metal_rates():
+    """Test shop-wide metal rates, per-tenant overrides and the shared rate cache"""
+    print("Testing Shop-wide Metal Rates...")
+    import sqlite3
+    from metal_rates import (get_metal_settings, get_shop_rates, get_tenant_overrides, set_shop_rates,
+                             set_tenant_overrides, tenant_overrides_from)
+    
+    cleanup_test_files()
+    assert get_metal_settings('jewelcalc_user_1.db') == {}, "Nothing should be set before the admin saves rates"
+    
+    shop = {
+        'Gold 22K': {'rate': 6000.0, 'wastage': 6.0, 'making': 12.0},
+        'Silver': {'rate': 75.0, 'wastage': 3.0, 'making': 8.0},
+    }
+    set_shop_rates(shop)
+    assert get_shop_rates() == shop, "Shop rates should round-trip in order"
+    assert get_metal_settings('jewelcalc_user_1.db') == shop, "Tenants without overrides get the shop rates"
+    print("✓ Shop-wide rates apply to every tenant")
+    
+    # A user's edited table becomes field-level overrides
+    edited = {**shop, 'Gold 22K': {'rate': 6000.0, 'wastage': 6.0, 'making': 10.0},
+              'Platinum': {'rate': 3000.0, 'wastage': 2.0, 'making': 5.0}}
+    set_tenant_overrides('jewelcalc_user_1.db', tenant_overrides_from('jewelcalc_user_1.db', edited))
+    assert get_tenant_overrides('jewelcalc_user_1.db') == {
+        'Gold 22K': {'making': 10.0}, 'Platinum': {'rate': 3000.0, 'wastage': 2.0, 'making': 5.0}
+    }, "Only changed fields and new metals should be stored"
+    assert get_metal_settings('jewelcalc_user_1.db') == edited, "Overrides should apply on top of the shop rates"
+    assert get_metal_settings('jewelcalc_user_2.db') == shop, "Overrides should not leak to other tenants"
+    
+    # The morning rate update reaches everyone, keeping their overrides
+    set_shop_rates({**shop, 'Gold 22K': {'rate': 6100.0, 'wastage': 6.0, 'making': 12.0}})
+    assert get_metal_settings('jewelcalc_user_1.db')['Gold 22K'] == {'rate': 6100.0, 'wastage': 6.0, 'making': 10.0}, \
+        "New shop rates should combine with existing overrides"
+    print("✓ Per-tenant overrides layer on the shop rates")
+    
+    # Writes from another process invalidate the shared cache through the version row
+    other_process = sqlite3.connect('jewelcalc_auth.db')
+    other_process.execute("UPDATE metal_rates SET rate = 80.0 WHERE metal = 'Silver'")
+    other_process.commit()
+    other_process.close()
+    assert get_metal_settings('jewelcalc_user_2.db')['Silver']['rate'] == 80.0, "Cache should notice outside writes"
+    statements = []
+    with get_pool('jewelcalc_auth.db').connection() as conn:  # Single-threaded reads reuse this connection
+        conn.set_trace_callback(statements.append)
+    get_metal_settings('jewelcalc_user_2.db')
+    with get_pool('jewelcalc_auth.db').connection() as conn:
+        conn.set_trace_callback(None)
+    assert not any('FROM metal_rates ' in sql for sql in statements), "Unchanged rates should come from the cache"
+    print("✓ Rate cache refreshes only when the version changes")
+    
+    cleanup_test_files()
+    print("\n✅ Metal rate test passed!\n")
+
+def test_rate_history():
+    """Test the append-only rate history, point-in-time lookups and as-of joins"""
+    print("Testing Metal Rate History...")
+    import json
+    import random
+    import sqlite3
+    from metal_rates import set_shop_rates
+    from rate_history import board_rates_asof, get_rate_history, rate_at, rates_at, record_rate, to_epoch
+    
+    cleanup_test_files()
+    record_rate('Gold 22K', 5800.0, 6.0, 12.0, '2024-01-01')
+    record_rate('Gold 22K', 5900.0, 6.0, 12.0, '2024-02-15')
+    record_rate('Silver', 70.0, 3.0, 8.0, '2024-01-10')
+    assert rate_at('Gold 22K', '2023-12-31') is None, "No rate before the first entry"
+    assert rate_at('Gold 22K', '2024-01-31 18:00:00')['rate'] == 5800.0, "Lookups should find the rate in effect"
+    assert rate_at('Gold 22K', '2024-02-15')['rate'] == 5900.0, "A rate applies from its effective time"
+    assert rates_at('2024-01-05') == {'Gold 22K': {'rate': 5800.0, 'wastage': 6.0, 'making': 12.0}}, \
+        "Only metals with a rate by then should be listed"
+    statements = []
+    with get_pool('jewelcalc_auth.db').connection() as conn:  # Single-threaded reads reuse this connection
+        conn.set_trace_callback(statements.append)
+    rates_at('2024-02-20')
+    with get_pool('jewelcalc_auth.db').connection() as conn:
+        conn.set_trace_callback(None)
+    assert sum('metal_rate_history' in sql for sql in statements) == 1, \
+        f"All metals should be read after one cache check: {statements}"
+    print("✓ Point-in-time lookups find the rate in effect")
+    
+    # Saving shop rates appends only the metals whose rate changed
+    today = {'Gold 22K': {'rate': 6000.0, 'wastage': 6.0, 'making': 12.0}, 'Silver': {'rate': 70.0, 'wastage': 3.0, 'making': 8.0}}
+    set_shop_rates(today)
+    set_shop_rates(today)
+    history = get_rate_history()
+    assert history['metal'].tolist() == ['Gold 22K'] * 3 + ['Silver'], "Unchanged rates should not be appended again"
+    assert rate_at('Gold 22K', 'now')['rate'] == 6000.0, "Saved shop rates should take effect now"
+    conn = sqlite3.connect('jewelcalc_auth.db')
+    try:
+        conn.execute('DELETE FROM metal_rate_history')
+        assert False, "History rows should not be deletable"
+    except sqlite3.IntegrityError:
+        pass
+    finally:
+        conn.close()
+    print("✓ Rate history is append-only and follows shop rate changes")
+    
+    # Bulk as-of joins agree with single lookups
+    rng = random.Random(24)
+    start, end = to_epoch('2023-12-01'), to_epoch('2024-03-01')
+    metals = [rng.choice(['Gold 22K', 'Silver', 'Platinum']) for _ in range(500)]
+    timestamps = [rng.randint(start, end) for _ in metals]
+    board = board_rates_asof(metals, timestamps)
+    for n, (metal, timestamp) in enumerate(zip(metals, timestamps)):
+        expected = rate_at(metal, timestamp)
+        actual = board.iloc[n]
+        if expected is None:
+            assert actual.isna().all(), f"Row {n} should have no board rate"
+        else:
+            assert actual['board_rate'] == expected['rate'] and actual['board_making'] == expected['making'], f"Row {n}"
+    print("✓ As-of joins match point-in-time lookups")
+    
+    # Reports compare invoiced rates with the board rate of each invoice's date
+    user_db = Database('jewelcalc_user_1.db')
+    customer_id = user_db.add_customer('CUS-00001', 'One', '9000000001', '')
+    def invoice(number, date, rate):
+        return {'invoice_no': number, 'customer_id': customer_id, 'date': date, 'subtotal': 2 * rate, 'total': 2 * rate,
+                'cgst_percent': 0, 'sgst_percent': 0, 'cgst_amount': 0, 'sgst_amount': 0,
+                'items': [{'item_no': 1, 'metal': 'Gold 22K', 'weight': 2.0, 'rate': rate,
+                           'wastage_percent': 0, 'making_percent': 0}]}
+    user_db.import_invoices_json(json.dumps([
+        invoice('INV-H1', '2024-01-20', 5850.0), invoice('INV-H2', '2024-02-20', 5900.0),
+        invoice('INV-H3', '2023-12-20', 5700.0),
+    ]))
+    report = user_db.get_board_rate_comparison('2024-01', '2024-02')
+    assert report['month'].tolist() == ['2024-01', '2024-02'], "Report should cover the month range"
+    assert report['board_rate'].tolist() == [5800.0, 5900.0], "Board rates should be taken as of each invoice"
+    assert report['difference'].tolist() == [50.0, 0.0], "Differences should be invoiced minus board rate"
+    assert user_db.get_board_rate_comparison('2023-12', '2023-12')['board_rate'].isna().all(), \
+        "Items before the first board rate should have none"
+    print("✓ Board rate comparison joins invoices to the rate history")
+    
+    cleanup_test_files()
+    print("\n✅ Rate history test passed!\n")
+
 def main():
     """Run all tests"""
     print("=" * 60)
@@ -134,6 +430,10 @@ def main():
         
         # Run tests
         test_admin_cross_database_views()
+        test_federated_queries()
+        test_admin_rollups()
+        test_metal_rates()
+        test_rate_history()
         
         print("=" * 60)
         print("✅ ALL TESTS PASSED!")
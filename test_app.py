@@ -5,13 +5,24 @@ Test script for JewelCalc authentication and database operations
 
 import os
 import sys
+import time
+import sqlite3
+import json
+import random
+import pandas as pd
+from datetime import datetime
+from io import StringIO, BytesIO
 from database import Database
+from connection_pool import close_all_pools
 from auth import hash_password, verify_password
-from utils import generate_invoice_number, generate_account_number, validate_phone, calculate_item_totals
+from utils import generate_invoice_number, generate_account_number, validate_phone, calculate_item_totals, calculate_item_totals_batch, calculate_invoice_totals, to_paise, from_paise
+from utils import calculate_invoice_totals_batch
 
 def cleanup_test_files():
     """Remove test database files"""
     import glob
+    # Close pooled connections so the files can be removed
+    close_all_pools()
     # Find all test database files dynamically
     test_patterns = ['test_*.db', 'jewelcalc_test*.db']
     for pattern in test_patterns:
@@ -143,6 +154,21 @@ def test_database_operations():
     assert customer['name'] == 'John Smith', "Customer name should be updated"
     print("✓ Update customer works correctly")
     
+    # Test 3.5: Customer search index follows adds, updates and deletes
+    assert db.search_customers('smith')['id'].tolist() == [customer_id], "Search should find the new name"
+    assert db.search_customers('John Doe').empty, "Search should forget the old name"
+    assert db.search_customers('43210')['id'].tolist() == [customer_id], "Search should match phone digits"
+    assert db.search_customers('oak ave')['id'].tolist() == [customer_id], "Search should match the address"
+    assert db.search_customers('cus-00001')['id'].tolist() == [customer_id], "Search should match account numbers"
+    assert db.search_customers('Jo')['id'].tolist() == [customer_id], "Short queries should match name prefixes"
+    assert db.search_customers('%')['id'].tolist() == [], "LIKE wildcards should be matched literally"
+    temp_id = db.add_customer('CUS-00099', 'Temp Searchable', '9000000099')
+    assert db.search_customers('searchab')['id'].tolist() == [temp_id], "New customers should be searchable"
+    assert len(db.search_customers('', limit=1)) == 1, "Empty searches should honour the limit"
+    db.delete_customer(temp_id)
+    assert db.search_customers('searchab').empty, "Deleted customers should drop out of search"
+    print("✓ Customer search works correctly")
+    
     # Test 4: Create invoice
     # Test data for a typical gold invoice
     test_weight = 10.5  # grams
@@ -184,16 +210,100 @@ def test_database_operations():
     assert len(items_df) == 1, "Should have 1 item"
     print("✓ Get invoice by number works correctly")
     
+    # Test 6.5: Batch invoice details and lookup by ID
+    details = db.get_invoice_details(invoice_nos=['INV-00001', 'INV-MISSING'])
+    assert list(details.keys()) == [int(invoice['id'])], "Only existing invoices should be returned"
+    batch_invoice, batch_items, batch_customer = details[int(invoice['id'])]
+    assert batch_invoice['invoice_no'] == 'INV-00001', "Batch header should match"
+    assert len(batch_items) == 1, "Batch items should match"
+    assert batch_customer['name'] == cust['name'], "Batch customer should match"
+    by_id, by_id_items, _ = db.get_invoice_by_id(invoice['id'])
+    assert by_id['invoice_no'] == 'INV-00001' and len(by_id_items) == 1, "Lookup by ID should work"
+    assert db.get_invoice_by_id(999999) == (None, None, None), "Missing ID should return Nones"
+    print("✓ Batch invoice details work correctly")
+    
     # Test 7: Export/Import customers
     csv_data = db.export_customers_csv()
     assert len(csv_data) > 0, "CSV export should have data"
     print("✓ Export customers to CSV works")
     
+    # Test 7.5: Bulk customer import with validation, duplicates and conflict modes
+    csv_import = (
+        "account_no,name,phone,address\n"
+        ",Asha,9000000101,Street 1\n"
+        "CUS-00050,Bala,9000000102,\n"
+        "CUS-00051,Chitra,12345,\n"          # invalid phone
+        "SHOP-7,Devi,9000000103,\n"          # shop's own account number format
+        ",Esha,9000000101,\n"                # duplicate phone in file
+        ",John Updated,9876543210,New St\n"  # existing customer
+    )
+    imported, updated, errors = db.import_customers_csv(csv_import, chunksize=2)
+    assert (imported, updated) == (3, 0), f"Three new customers should import, got {imported}: {errors}"
+    assert [e.split(':')[0] for e in errors] == ['Row 3', 'Row 5', 'Row 6'], errors
+    assert 'skipped' in errors[-1], "Existing phone should be skipped in skip mode"
+    phones = db.get_customers().set_index('phone')
+    assert phones.loc['9000000101', 'account_no'] == 'CUS-00002', "Blank account should get the next number"
+    assert phones.loc['9876543210', 'name'] == 'John Smith', "Skip mode should not touch existing customers"
+    assert phones.loc['9000000103', 'account_no'] == 'SHOP-7', "Any account number format should be kept"
+    imported, updated, errors = db.import_customers_csv(BytesIO(csv_import.encode('utf-8')), mode='upsert')
+    assert (imported, updated) == (0, 4), f"Upsert should update the four valid rows, got {updated}: {errors}"
+    assert db.get_customers().set_index('phone').loc['9876543210', 'name'] == 'John Updated', "Upsert should update"
+    for phone in ('9000000101', '9000000102', '9000000103'):
+        db.delete_customer(int(phones.loc[phone, 'id']))
+    # A chunk the database rejects leaves nothing behind, so later chunks may reuse its rows
+    with db.connection() as conn:
+        conn.execute('''
+            CREATE TRIGGER reject_customer BEFORE INSERT ON customers WHEN NEW.name = 'Rejected'
+            BEGIN SELECT RAISE(ABORT, 'rejected'); END
+        ''')
+    imported, _, errors = db.import_customers_csv(
+        "account_no,name,phone,address\n,Farah,9000000104,\n,Rejected,9000000105,\n,Farah,9000000104,\n",
+        chunksize=2
+    )
+    with db.connection() as conn:
+        conn.execute('DROP TRIGGER reject_customer')
+    assert imported == 1 and len(errors) == 1 and 'rejected' in errors[0], errors
+    farah = db.get_customers().set_index('phone').loc['9000000104']
+    assert farah['account_no'] == 'CUS-00002', "Numbers of a failed chunk should be handed out again"
+    db.delete_customer(int(farah['id']))
+    db.update_customer(customer_id, 'CUS-00001', 'John Smith', '9876543210', '456 Oak Ave')
+    print("✓ Bulk customer CSV import works")
+    
     # Test 8: Export/Import invoices
     json_data = db.export_invoices_json()
     assert len(json_data) > 0, "JSON export should have data"
+    exported = json.loads(json_data)
+    assert [inv['invoice_no'] for inv in exported] == ['INV-00001'], "Export should list every invoice"
+    assert len(exported[0]['items']) == 1, "Exported invoice should carry its items"
+    assert exported[0]['customer']['phone'] == '9876543210', "Exported invoice should carry its customer"
+    export_file = StringIO()
+    db.export_invoices_json(export_file)
+    assert export_file.getvalue() == json_data, "Streaming to a file should match the string export"
     print("✓ Export invoices to JSON works")
     
+    # Test 8.5: NDJSON round trip with per-line errors
+    ndjson_data = db.export_invoices_ndjson()
+    assert ndjson_data.count('\n') == 1, "NDJSON should have one line per invoice"
+    import_db = Database('test_ndjson_import.db')
+    import_db.add_customer('CUS-00001', 'John Doe', '9876543210', '123 Main St')
+    upload = BytesIO((ndjson_data + '{not json\n' + ndjson_data.replace('"customer_id": 1', '"customer_id": 99')).encode('utf-8'))
+    imported, errors = import_db.import_invoices_ndjson(upload, batch_size=1)
+    assert imported == 1, f"One invoice should import, got {imported}"
+    assert len(errors) == 2 and errors[0].startswith('Line 2') and errors[1].startswith('Line 3'), errors
+    imported, errors = import_db.import_invoices_ndjson(ndjson_data.splitlines())
+    assert imported == 0 and 'UNIQUE' in errors[0], "Duplicate invoice numbers should be reported per line"
+    _, imported_items, _ = import_db.get_invoice_by_number('INV-00001')
+    assert len(imported_items) == 1, "Failed re-import should leave no extra items behind"
+    unpriced = json.loads(ndjson_data)
+    unpriced['invoice_no'] = 'INV-UNPRICED'
+    for field in ['item_value', 'wastage_amount', 'making_amount', 'line_total']:
+        unpriced['items'][0].pop(field)
+    assert import_db.import_invoices_ndjson([json.dumps(unpriced)]) == (1, []), "Unpriced items should import"
+    _, unpriced_items, _ = import_db.get_invoice_by_number('INV-UNPRICED')
+    assert unpriced_items.iloc[0]['line_total'] == imported_items.iloc[0]['line_total'], \
+        "Missing item amounts should be priced on import"
+    print("✓ NDJSON invoice import/export works")
+    
     # Test 9: Settings persistence
     test_settings = {'Gold 24K': {'rate': 7000.0, 'wastage': 6.0, 'making': 11.0}}
     db.save_setting('test_metal_settings', test_settings)
@@ -201,6 +311,51 @@ def test_database_operations():
     assert retrieved_settings == test_settings, "Settings should be saved and retrieved correctly"
     print("✓ Settings persistence works correctly")
     
+    # Test 9.1: Settings are served from a cached snapshot until a write bumps the version
+    retrieved_settings['Gold 24K']['rate'] = 1.0
+    assert db.get_setting('test_metal_settings') == test_settings, "Callers should not be able to mutate the cache"
+    statements = []
+    with db.connection() as conn:  # Single-threaded calls reuse this pooled connection
+        conn.set_trace_callback(statements.append)
+    db.get_settings()
+    with db.connection() as conn:
+        conn.set_trace_callback(None)
+    assert not any('FROM settings ' in sql or sql.endswith('FROM settings') for sql in statements), \
+        "An unchanged version should not reload the settings"
+    other_process = sqlite3.connect(db.db_path)
+    other_process.execute("INSERT OR REPLACE INTO settings (key, value, updated_at) VALUES ('cgst', '2.5', '')")
+    other_process.commit()
+    other_process.close()
+    assert db.get_setting('cgst') == 2.5, "Writes from other connections should invalidate the snapshot"
+    db.save_settings({'cgst': 1.5, 'sgst': 1.5})
+    assert Database('test_jewelcalc.db').get_settings()['sgst'] == 1.5, "Instances should share the snapshot"
+    print("✓ Settings snapshot cache invalidates on version changes")
+    
+    # Test 9.5: Keyset pagination of invoices
+    for n in range(2, 6):
+        db.save_invoice(customer_id, f'INV-PAGE-{n}', items, 1.5, 1.5, 0)
+    all_invoices = db.get_invoices()
+    page1 = db.get_invoices(limit=2)
+    last = page1.iloc[-1]
+    page2 = db.get_invoices(limit=2, before=(last['sort_ts'], last['id']))
+    paged = page1['id'].tolist() + page2['id'].tolist()
+    assert paged == all_invoices['id'].tolist()[:4], "Pages should follow the full list order without gaps"
+    assert len(db.get_invoices(limit=10, search='page-3')) == 1, "Search should match invoice number"
+    assert len(db.get_invoices(limit=10, search='john')) == len(all_invoices), "Search should match customer name"
+    assert len(db.get_invoices(search='3210 smith page')) == 4, "Every search word should match somewhere"
+    assert len(db.get_invoices(search='page -4')) == 1, "Short words should narrow indexed matches"
+    assert db.get_invoices(search='page_%').empty, "LIKE wildcards should be matched literally"
+    searched = db.get_invoices(limit=2, search='page')
+    searched_next = db.get_invoices(limit=2, search='page', before=(searched.iloc[-1]['sort_ts'], searched.iloc[-1]['id']))
+    assert len(searched) + len(searched_next) == 4, "Searches should page with the same cursor"
+    today = datetime.now().strftime("%Y-%m-%d")
+    assert len(db.get_invoices(search='page', start_date=today)) == 4, "Date range should include today"
+    assert db.get_invoices(search='page', end_date=today).empty, "End date should be exclusive"
+    for n in range(2, 6):
+        invoice_id = int(db.get_invoices(search=f'INV-PAGE-{n}').iloc[0]['id'])
+        db.delete_invoice(invoice_id)
+    print("✓ Keyset invoice pagination works correctly")
+    
     # Test 10: Duplicate invoice
     invoices = db.get_invoices()
     original_invoice_id = int(invoices.iloc[0]['id'])
@@ -216,18 +371,344 @@ def test_database_operations():
     assert len(sales_report) >= 2, "Sales report should have at least 2 invoices"
     print("✓ Sales report generation works correctly")
     
+    # Test 11.5: Trigger-maintained daily sales summary stays in sync
+    def assert_summary_matches():
+        detail = db.get_sales_report()
+        summary = db.get_sales_summary()
+        assert summary['invoice_count'].sum() == len(detail), "Summary count should match detail rows"
+        for column in ['subtotal', 'discount_amount', 'cgst_amount', 'sgst_amount', 'total']:
+            assert abs(summary[column].sum() - detail[column].sum()) < 0.01, f"Summary {column} should match"
+    assert_summary_matches()
+    db.save_invoice(customer_id, 'INV-SUMMARY', items, 1.5, 1.5, 10)
+    summary_invoice, _, _ = db.get_invoice_by_number('INV-SUMMARY')
+    db.update_invoice(int(summary_invoice['id']), items * 3, 2.5, 2.5, 0)
+    assert_summary_matches()
+    db.delete_invoice(int(summary_invoice['id']))
+    assert_summary_matches()
+    today = datetime.now().strftime("%Y-%m-%d")
+    assert db.get_sales_summary(today, '2999-01-01')['day'].tolist() == [today], "Summary should be per day"
+    assert db.get_sales_summary('2999-01-01').empty, "Summary should respect the date range"
+    print("✓ Daily sales summary stays in sync with invoices")
+    
+    # Test 11.6: Normalized invoice timestamps drive date ranges and period buckets
+    # Imports keep whatever date format the file carried
+    epoch_record = {
+        'invoice_no': 'INV-EPOCH', 'customer_id': customer_id, 'date': '2024-03-15',
+        'subtotal': 100.0, 'cgst_percent': 0, 'sgst_percent': 0, 'cgst_amount': 0, 'sgst_amount': 0, 'total': 100.0,
+        'items': [{**items[0], 'item_no': 1}]
+    }
+    assert db.import_invoices_json(json.dumps([epoch_record]))[0] == 1, "Dated invoice should import"
+    epoch_invoice, _, _ = db.get_invoice_by_number('INV-EPOCH')
+    with db.connection() as conn:
+        date_ts = conn.execute('SELECT date_ts FROM invoices WHERE id = ?', (int(epoch_invoice['id']),)).fetchone()[0]
+    assert date_ts == 1710460800, "Date-only values should normalize to midnight (naive times are read as UTC)"
+    assert db.get_sales_report('2024-03-15', '2024-03-16')['invoice_no'].tolist() == ['INV-EPOCH'], \
+        "Date ranges should include date-only invoices"
+    assert db.get_sales_report('2024-03-15 00:00:01', '2024-03-16').empty, "Ranges should compare full timestamps"
+    for period, start in [('day', '2024-03-15'), ('week', '2024-03-11'), ('month', '2024-03-01')]:
+        buckets = db.get_sales_by_period(period, '2024-01-01', '2025-01-01')
+        assert buckets['period_start'].tolist() == [start], f"{period} bucket should start on {start}"
+    db.delete_invoice(int(epoch_invoice['id']))
+    # As text '2024-03-15T09:30' sorts after '2024-03-15 10:00'; lists, buckets and stats follow date_ts
+    mixed = [{**epoch_record, 'invoice_no': invoice_no, 'date': date}
+             for invoice_no, date in [('INV-MIXED-1', '2024-03-15T09:30:00'), ('INV-MIXED-2', '2024-03-15 10:00:00')]]
+    assert db.import_invoices_json(json.dumps(mixed))[0] == 2, "Mixed-format invoices should import"
+    listed = db.get_invoices(start_date='2024-03-15', end_date='2024-03-16')
+    assert listed['invoice_no'].tolist() == ['INV-MIXED-2', 'INV-MIXED-1'], "Invoices should list by time"
+    assert db.get_sales_summary('2024-03-15', '2024-03-16')['invoice_count'].tolist() == [2], \
+        "Both invoices should land in one day bucket"
+    assert db.get_customer_purchase_analysis(customer_id).iloc[0]['first_purchase'] == '2024-03-15T09:30:00', \
+        "First purchase should be the earliest invoice by time"
+    for invoice_id in listed['id']:
+        db.delete_invoice(int(invoice_id))
+    # Dates that never parse have no date_ts; they list last and keyset pages still reach them
+    undated = {**epoch_record, 'invoice_no': 'INV-UNDATED', 'date': 'N/A'}
+    assert db.import_invoices_json(json.dumps([undated]))[0] == 1, "Unparseable dates should still import"
+    paged = []
+    before = None
+    while True:
+        page = db.get_invoices(limit=1, before=before)
+        paged.extend(page['invoice_no'])
+        if page.empty:
+            break
+        before = (page.iloc[-1]['sort_ts'], page.iloc[-1]['id'])
+    assert paged == db.get_invoices()['invoice_no'].tolist(), "Pages should cover every invoice"
+    assert paged[-1] == 'INV-UNDATED', "Undated invoices should sort last"
+    db.delete_invoice(int(db.get_invoice_by_number('INV-UNDATED')[0]['id']))
+    print("✓ Invoice timestamps normalize dates for range reports")
+    
+    # Test 11.7: Integer paise columns mirror the stored amounts and drive exact sums
+    with db.connection() as conn:
+        mismatched = conn.execute('''
+            SELECT COUNT(*) FROM invoices
+            WHERE subtotal_paise != CAST(ROUND(subtotal * 100) AS INTEGER)
+               OR discount_paise != CAST(ROUND(discount_amount * 100) AS INTEGER)
+               OR total_paise != CAST(ROUND(total * 100) AS INTEGER)
+               OR total_paise != subtotal_paise - discount_paise + cgst_paise + sgst_paise
+        ''').fetchone()[0]
+        paise_sum = conn.execute('SELECT SUM(total_paise) FROM invoices').fetchone()[0]
+    assert mismatched == 0, "Paise columns should match the rupee columns and add up exactly"
+    assert to_paise(db.get_sales_summary()['total'].sum()) == paise_sum, "Daily summary should sum paise exactly"
+    print("✓ Invoice amounts are kept in integer paise")
+    
     # Test 12: Customer purchase analysis
     customer_analysis = db.get_customer_purchase_analysis()
     assert len(customer_analysis) >= 1, "Customer analysis should have data"
     print("✓ Customer purchase analysis works correctly")
     
+    # Test 12.5: Incremental customer lifetime stats match a full recompute
+    def assert_customer_stats_match():
+        with db.connection() as conn:
+            exact = pd.read_sql_query('''
+                SELECT c.account_no, COUNT(i.id) AS invoice_count, COALESCE(SUM(i.total), 0) AS total_amount,
+                       COALESCE(SUM(i.discount_amount), 0) AS total_discount,
+                       (SELECT date FROM invoices WHERE customer_id = c.id ORDER BY date_ts, id LIMIT 1) AS first_purchase,
+                       (SELECT date FROM invoices WHERE customer_id = c.id ORDER BY date_ts DESC, id DESC LIMIT 1)
+                           AS last_purchase
+                FROM customers c LEFT JOIN invoices i ON i.customer_id = c.id
+                GROUP BY c.id ORDER BY c.account_no
+            ''', conn)
+        stats = db.get_top_customers().sort_values('account_no').reset_index(drop=True)
+        assert stats['account_no'].tolist() == exact['account_no'].tolist(), "Every customer should have stats"
+        assert stats['invoice_count'].tolist() == exact['invoice_count'].tolist(), "Invoice counts should match"
+        assert (abs(stats['total_amount'] - exact['total_amount']) < 0.01).all(), "Totals should match"
+        assert (abs(stats['total_discount'] - exact['total_discount']) < 0.01).all(), "Discounts should match"
+        assert stats['first_purchase'].tolist() == exact['first_purchase'].tolist(), "First purchases should match"
+        assert stats['last_purchase'].tolist() == exact['last_purchase'].tolist(), "Last purchases should match"
+    assert_customer_stats_match()
+    big_spender_id = db.add_customer('CUS-STATS', 'Big Spender', '9123456780')
+    assert db.get_customer_purchase_analysis(big_spender_id).iloc[0]['invoice_count'] == 0, \
+        "New customers should start with empty stats"
+    db.save_invoice(big_spender_id, 'INV-STATS-1', items * 5, 1.5, 1.5, 5)
+    db.save_invoice(big_spender_id, 'INV-STATS-2', items, 1.5, 1.5, 0)
+    assert_customer_stats_match()
+    assert db.get_top_customers(1).iloc[0]['name'] == 'Big Spender', "Top customer should be the biggest spender"
+    stats_invoice, _, _ = db.get_invoice_by_number('INV-STATS-1')
+    db.update_invoice(int(stats_invoice['id']), items, 1.5, 1.5, 0)
+    db.delete_invoice(int(db.get_invoice_by_number('INV-STATS-2')[0]['id']))
+    assert_customer_stats_match()
+    db.delete_customer(big_spender_id)
+    assert_customer_stats_match()
+    print("✓ Customer lifetime stats stay in sync with invoices")
+    
     # Test 13: Category report
     category_report = db.get_category_report()
     assert len(category_report) >= 1, "Category report should have data"
     print("✓ Category report generation works correctly")
     
+    # Test 13.5: Metal category rollup matches an exact recompute
+    def assert_category_matches(**kwargs):
+        rollup = db.get_category_report(**kwargs).set_index('metal').sort_index()
+        exact = db.get_category_report(exact=True, **kwargs).set_index('metal').sort_index()
+        assert rollup.index.tolist() == exact.index.tolist(), "Rollup should cover the same metals"
+        assert rollup['invoice_count'].tolist() == exact['invoice_count'].tolist(), "Invoice counts should match"
+        for column in ['total_weight', 'avg_rate', 'total_item_value', 'total_wastage', 'total_making', 'total_amount']:
+            assert (abs(rollup[column] - exact[column]) < 0.01).all(), f"Rollup {column} should match"
+    assert_category_matches()
+    silver = {**items[0], 'metal': 'Silver', 'rate': 80.0}
+    db.save_invoice(customer_id, 'INV-CATEGORY', items + [silver, silver], 1.5, 1.5, 0)
+    assert_category_matches()
+    category_invoice, _, _ = db.get_invoice_by_number('INV-CATEGORY')
+    db.update_invoice(int(category_invoice['id']), [silver], 1.5, 1.5, 0)
+    assert_category_matches()
+    this_month = datetime.now().strftime("%Y-%m")
+    assert db.get_category_months()[0] == this_month, "Current month should have category sales"
+    assert_category_matches(start_month=this_month, end_month=this_month)
+    assert db.get_category_report(start_month='2999-01').empty, "Rollup should respect the month range"
+    db.delete_invoice(int(category_invoice['id']))
+    assert_category_matches()
+    assert 'Silver' not in db.get_category_report()['metal'].tolist(), "Emptied metals should drop out"
+    print("✓ Metal category rollup stays in sync with invoice items")
+    
+    # Test 13.6: What-if repricing recomputes items and invoice GST at new rates
+    current_invoices = db.get_invoices()
+    unchanged, summary = db.reprice_invoices({'Gold 22K': {}, 'Gold 24K': {}})
+    assert len(unchanged) == len(current_invoices), "Every invoice should be included without filters"
+    assert (unchanged['delta'] == 0).all() and summary['delta'] == 0, "Unchanged rates should give a zero delta"
+    db.save_invoice(customer_id, 'INV-WHATIF', [
+        {**items[0], 'metal': 'Gold 22K', 'weight': 2.0, 'rate': 6000.0, 'wastage_percent': 5.0, 'making_percent': 10.0,
+         'item_value': 12000.0, 'wastage_amount': 600.0, 'making_amount': 1200.0, 'line_total': 13800.0},
+        {**items[0], 'metal': 'Silver', 'weight': 10.0, 'rate': 75.0, 'wastage_percent': 0, 'making_percent': 0,
+         'item_value': 750.0, 'wastage_amount': 0, 'making_amount': 0, 'line_total': 750.0},
+    ], 1.5, 1.5, 10)
+    whatif_invoice, _, _ = db.get_invoice_by_number('INV-WHATIF')
+    today = datetime.now().strftime("%Y-%m-%d")
+    repriced, summary = db.reprice_invoices({'Gold 22K': {'rate': 6500.0}, 'Silver': {'rate': 80.0}},
+                                            start_date=today, metals=['Gold 22K'])
+    row = repriced[repriced['invoice_no'] == 'INV-WHATIF'].iloc[0]
+    assert row['repriced_items'] == 1, "Only items of the filtered metals should be repriced"
+    # Gold: 2g x 6500 = 13000 + 5% + 10% = 14950; Silver keeps 750; 10% off 15700 = 14130; GST 211.95 x 2
+    assert row['new_subtotal'] == 15700.0 and row['new_tax'] == 423.9 and row['new_total'] == 14553.9, \
+        "New totals should apply the invoice's discount and GST"
+    assert row['current_total'] == float(whatif_invoice['total']), "Current totals should match the saved invoice"
+    assert row['delta'] == round(row['new_total'] - row['current_total'], 2), "Delta should be new minus current"
+    assert summary['delta'] == round(repriced['delta'].sum(), 2), "Summary delta should add up the invoices"
+    assert db.reprice_invoices({'Gold 22K': {'rate': 1.0}}, customer_id=-1)[0].empty, "Customer filter should apply"
+    db.delete_invoice(int(whatif_invoice['id']))
+    print("✓ What-if repricing reports per-invoice and total deltas")
+    
     print("✅ Database operations tests passed!\n")
 
+def test_connection_pool():
+    """Test pooled connection reuse, bounds and stale-file detection"""
+    print("Testing Connection Pool...")
+    from connection_pool import ConnectionPool, get_pool
+    
+    db = Database('test_pool.db')
+    db.add_customer('CUS-00001', 'Pool Customer', '9000000001', '')
+    
+    # Test 1: Database methods share one process-wide pool per file
+    pool = get_pool('test_pool.db')
+    assert get_pool(os.path.abspath('test_pool.db')) is pool, "Pool should be keyed by absolute path"
+    conn = db.get_connection()
+    conn.close()
+    conn2 = db.get_connection()
+    assert conn2 is conn, "Released connection should be reused"
+    conn2.close()
+    print("✓ Connections are reused")
+    
+    # Test 2: Uncommitted work is rolled back on release
+    with db.connection() as c:
+        c.execute("INSERT INTO customers (account_no, name, phone) VALUES ('X', 'Tmp', '9000000002')")
+    assert len(db.get_customers()) == 1, "Uncommitted insert should be discarded"
+    print("✓ Uncommitted transactions are rolled back on release")
+    
+    # Test 3: Pool size is bounded
+    small = ConnectionPool('test_pool.db', max_size=1, acquire_timeout=0.1)
+    held = small.acquire()
+    try:
+        small.acquire()
+        assert False, "Second acquire should time out"
+    except sqlite3.OperationalError:
+        pass
+    small.release(held)
+    small.close()
+    print("✓ Pool size is bounded")
+    
+    # Test 4: Idle connections are evicted
+    idle_pool = ConnectionPool('test_pool.db', idle_timeout=0)
+    c = idle_pool.acquire()
+    idle_pool.release(c)
+    time.sleep(0.01)
+    assert idle_pool.acquire() is not c, "Idle connection should have been evicted"
+    idle_pool.close()
+    print("✓ Idle connections are evicted")
+    
+    # Test 5: A deleted/recreated file is not served from stale connections
+    os.remove('test_pool.db')
+    db = Database('test_pool.db')
+    assert len(db.get_customers()) == 0, "Recreated database should be empty"
+    print("✓ Stale connections are discarded when the file is replaced")
+    
+    print("✅ Connection pool tests passed!\n")
+
+def test_schema_migrations():
+    """Test versioned schema migrations"""
+    print("Testing Schema Migrations...")
+    from migrations import SCHEMA_VERSION, ensure_schema, get_schema_version
+    
+    # Test 1: New files are created at the latest version
+    db = Database('test_migrations.db')
+    with db.connection() as conn:
+        assert get_schema_version(conn) == SCHEMA_VERSION, "New database should be fully migrated"
+    print(f"✓ New database created at schema version {SCHEMA_VERSION}")
+    
+    # Test 2: Migrations run once per process, later Database() calls skip DDL
+    with db.connection() as conn:
+        conn.execute('PRAGMA user_version = 0')
+    Database('test_migrations.db')
+    with db.connection() as conn:
+        assert get_schema_version(conn) == 0, "Already-migrated file should not be touched again"
+    ensure_schema('test_migrations.db', force=True)
+    with db.connection() as conn:
+        assert get_schema_version(conn) == SCHEMA_VERSION, "Forced migration should run"
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert 'daily_sales_paise' in tables and 'daily_sales' not in tables, "Re-running migrations should end on the latest shape"
+    print("✓ Migrations run once per file per process")
+    
+    # Test 3: Pre-versioning files with existing data are upgraded in place
+    legacy = sqlite3.connect('test_legacy.db')
+    legacy.execute('CREATE TABLE customers (id INTEGER PRIMARY KEY AUTOINCREMENT, account_no TEXT UNIQUE, '
+                   'name TEXT NOT NULL, phone TEXT UNIQUE NOT NULL, address TEXT)')
+    legacy.execute("INSERT INTO customers (account_no, name, phone, address) VALUES ('CUS-00001', 'Old', '9000000003', '')")
+    legacy.commit()
+    legacy.close()
+    legacy_db = Database('test_legacy.db')
+    assert len(legacy_db.get_customers()) == 1, "Existing data should survive migration"
+    assert legacy_db.get_invoices().empty, "Missing tables should be created"
+    print("✓ Legacy database upgraded in place")
+    
+    print("✅ Schema migration tests passed!\n")
+
+def test_pdf_cache():
+    """Test the content-addressed PDF cache"""
+    print("Testing PDF Cache...")
+    import shutil
+    import pandas as pd
+    from pdf_cache import PDFCache
+    
+    cache_dir = 'test_pdf_cache'
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    cache = PDFCache(max_entries=1, cache_dir=cache_dir)
+    invoice = {'id': 1, 'invoice_no': 'INV-CACHE1', 'date': '2024-01-01 10:00:00', 'subtotal': 14160.0,
+               'cgst_percent': 1.5, 'sgst_percent': 1.5, 'cgst_amount': 212.4, 'sgst_amount': 212.4,
+               'discount_percent': 0, 'discount_amount': 0, 'total': 14584.8}
+    items_df = pd.DataFrame([{'item_no': 1, 'metal': 'Gold 22K', 'weight': 2.0, 'rate': 6000.0,
+                              'wastage_percent': 6.0, 'making_percent': 12.0, 'item_value': 12000.0,
+                              'wastage_amount': 720.0, 'making_amount': 1440.0, 'line_total': 14160.0}])
+    customer = {'id': 1, 'account_no': 'CUS-00001', 'name': 'Cache Customer', 'phone': '9876543210', 'address': ''}
+    
+    try:
+        # Test 1: First request renders, the repeat is served from memory
+        pdf = cache.get('a4', invoice, items_df, customer, 'shop_a.db')
+        assert pdf.startswith(b'%PDF'), "Cache should return PDF bytes"
+        assert cache.get('a4', invoice, items_df, customer, 'shop_a.db') == pdf, "Repeat request should return the same PDF"
+        stats = cache.stats()
+        assert stats['misses'] == 1 and stats['hits'] == 1, f"Expected 1 miss and 1 hit, got {stats}"
+        print("✓ Repeat requests served from memory")
+        
+        # Test 2: Editing an item changes the key, so a new PDF is rendered
+        edited = items_df.copy()
+        edited.loc[0, 'weight'] = 3.0
+        cache.get('a4', invoice, edited, customer, 'shop_a.db')
+        stats = cache.stats()
+        assert stats['misses'] == 2, "Edited invoice should not hit the old entry"
+        assert stats['evictions'] == 1 and stats['entries'] == 1, "LRU bound should evict the oldest entry"
+        print("✓ Edited invoices invalidate the cached PDF")
+        
+        # Test 3: Evicted entries come back from the disk tier without re-rendering
+        assert cache.get('a4', invoice, items_df, customer, 'shop_a.db') == pdf, "Disk tier should return the same PDF"
+        assert cache.stats()['disk_hits'] == 1, "Evicted entry should be a disk hit"
+        assert cache.stats()['misses'] == 2, "Disk hit should not re-render"
+        print("✓ Disk tier serves evicted entries")
+        
+        # Test 4: Each tenant's PDFs sit in its own directory and are purged with its data
+        cache.get('a4', invoice, items_df, customer, 'shop_b.db')
+        cache.purge('shop_a.db')
+        assert not os.path.exists(os.path.join(cache_dir, 'shop_a.db')), "Purge should delete the tenant's files"
+        assert os.listdir(os.path.join(cache_dir, 'shop_b.db')), "Other tenants' files should stay"
+        misses = cache.stats()['misses']
+        cache.get('a4', invoice, items_df, customer, 'shop_a.db')
+        assert cache.stats()['misses'] == misses + 1, "Purged PDFs should be rendered again"
+        print("✓ Tenant PDFs are kept apart and purged on request")
+        
+        # Test 5: The disk tier is trimmed from a tracked count, not rescanned on every write
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        small = PDFCache(max_entries=1, cache_dir=cache_dir, max_disk_entries=10)
+        scans = []
+        trim_disk = small._trim_disk
+        small._trim_disk = lambda: (scans.append(1), trim_disk())
+        for n in range(11):
+            small.get('a4', dict(invoice, invoice_no=f'INV-TRIM{n}'), items_df, customer, 'shop_a.db')
+        assert len(scans) == 2, f"Only the first write and the one past the limit should scan, got {len(scans)}"
+        assert len(os.listdir(os.path.join(cache_dir, 'shop_a.db'))) == 9, "Trim should go down to the low-water mark"
+        assert small.stats()['disk_evictions'] == 2, "Trimmed files should be counted as evictions"
+        print("✓ Disk tier trimmed from a tracked count")
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    
+    print("✅ PDF cache tests passed!\n")
+
 def test_utility_functions():
     """Test utility functions"""
     print("Testing Utility Functions...")
@@ -270,6 +751,57 @@ def test_utility_functions():
     assert totals['line_total'] == expected_total, "Line total should be correct"
     print("✓ Item calculation works correctly")
     
+    # Test 5: Batch pricing agrees with calculate_item_totals on random rows (property check)
+    rng = random.Random(20)
+    blanks = [None, '', float('nan'), 'abc']
+    def random_value(low, high):
+        roll = rng.random()
+        if roll < 0.1:
+            return rng.choice(blanks)
+        if roll < 0.15:
+            return -rng.uniform(0, high)
+        value = round(rng.uniform(low, high), rng.choice([0, 2, 3]))
+        return str(value) if roll < 0.25 else value
+    rows = [(random_value(0, 500), random_value(0, 20000), random_value(0, 30), random_value(0, 30))
+            for _ in range(2000)]
+    batch = calculate_item_totals_batch(*zip(*rows))
+    for n, row in enumerate(rows):
+        numbers = [0.0 if v in blanks or v != v else float(v) for v in row]  # v != v for NaN
+        if numbers[0] > 0 and numbers[1] > 0:
+            expected = calculate_item_totals(*numbers)
+        else:
+            expected = {field: 0.0 for field in batch}
+        for field, values in batch.items():
+            assert values[n] == expected[field], f"Row {n} {field}: {values[n]} != {expected[field]} for {row}"
+    assert len(calculate_item_totals_batch([], [], [], [])['line_total']) == 0, "Empty batches should work"
+    print("✓ Batch pricing matches calculate_item_totals")
+    
+    # Test 6: Invoice totals are exact in integer paise
+    totals = calculate_invoice_totals([0.1] * 10 + [0.2], 0, 1.5, 1.5)
+    assert totals['subtotal'] == 120, "Ten 0.10 lines and a 0.20 line should be exactly 1.20"
+    totals = calculate_invoice_totals([74750.0, 1234.565], 2.5, 1.5, 1.5)
+    assert totals['subtotal'] == 7598457, "Line totals should round half up to paise"
+    assert totals['discount_amount'] == 189961, "Discount should round to the nearest paisa"
+    assert totals['cgst_amount'] == totals['sgst_amount'] == 111127, "Taxes should apply to the taxable amount"
+    assert totals['total'] == totals['taxable_amount'] + totals['cgst_amount'] + totals['sgst_amount'], \
+        "Total should be exactly taxable + taxes"
+    assert all(isinstance(value, int) for value in totals.values()), "Totals should be integer paise"
+    assert to_paise('12.345') == 1235 and to_paise(None) == 0 and from_paise(1235) == 12.35, "Paise conversions"
+    print("✓ Invoice totals are exact in integer paise")
+    
+    # Test 7: Batch invoice totals agree with calculate_invoice_totals (property check)
+    invoices = [([round(rng.uniform(0, 200000), rng.choice([2, 3])) for _ in range(rng.randint(1, 5))],
+                 rng.choice([0, 2.5, 3.333, 10]), rng.choice([0, 1.5, 2.5]), rng.choice([0, 1.5, 9]))
+                for _ in range(1000)]
+    line_invoice = [n for n, (lines, *_) in enumerate(invoices) for _ in lines]
+    line_totals = [line for lines, *_ in invoices for line in lines]
+    batch = calculate_invoice_totals_batch(line_invoice, line_totals, *zip(*(percents for _, *percents in invoices)))
+    for n, (lines, *percents) in enumerate(invoices):
+        expected = calculate_invoice_totals(lines, *percents)
+        for key, values in batch.items():
+            assert values[n] == expected[key], f"Invoice {n} {key}: {values[n]} != {expected[key]}"
+    print("✓ Batch invoice totals match calculate_invoice_totals")
+    
     print("✅ Utility functions tests passed!\n")
 
 def main():
@@ -286,6 +818,9 @@ def main():
         # Run tests
         test_authentication()
         test_database_operations()
+        test_connection_pool()
+        test_schema_migrations()
+        test_pdf_cache()
         test_utility_functions()
         
         print("=" * 60)
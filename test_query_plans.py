@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+"""
+Query-plan regression tests for JewelCalc
+
+Runs every Database query through EXPLAIN QUERY PLAN and fails if any of
+them falls back to a full table scan.
+"""
+
+import os
+import sys
+import sqlite3
+from database import Database
+from connection_pool import get_pool, close_all_pools
+
+TEST_DB = 'test_query_plans.db'
+
+# Methods that read a whole table by design (full listings and exports)
+FULL_SCAN_ALLOWED = {
+    'get_customers': {'customers'},
+    'export_customers_csv': {'customers'},
+    'export_invoices_json': {'invoices'},
+    'export_invoices_ndjson': {'invoices'},
+    'import_customers_csv': {'customers'},  # Pre-loads phones and account numbers once
+    'import_invoices_json': {'customers'},  # Pre-loads the customer id set once
+    'import_invoices_ndjson': {'customers'},
+    'search_customers': {'c'},  # Empty/short queries walk rowids newest-first and stop at the limit
+    'get_setting': {'settings'},  # A stale snapshot reloads every key at once
+    'get_settings': {'settings'},
+}
+
+
+def cleanup_test_files():
+    """Remove test database files"""
+    close_all_pools()
+    if os.path.exists(TEST_DB):
+        os.remove(TEST_DB)
+
+
+def capture_statements(db, call):
+    """Run call() and return the SQL statements it sent to SQLite"""
+    statements = []
+    # Single-threaded calls keep reusing the one idle pooled connection
+    pool = get_pool(db.db_path)
+    conn = pool.acquire()
+    conn.set_trace_callback(statements.append)
+    pool.release(conn)
+    try:
+        call()
+    finally:
+        conn = pool.acquire()
+        conn.set_trace_callback(None)
+        pool.release(conn)
+    return [s for s in statements if s.strip() != 'SELECT 1']  # Skip pool health checks
+
+
+def full_scans(conn, statement):
+    """Return the table names a statement reads with a full scan"""
+    head = statement.lstrip().split(None, 1)[0].upper()
+    if head not in ('SELECT', 'UPDATE', 'DELETE', 'WITH'):
+        return []
+    plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + statement).fetchall()]
+    # Scanning a materialized CTE or subquery only reads rows an inner step already selected
+    intermediate = {detail.split()[1] for detail in plan if detail.startswith(('MATERIALIZE ', 'CO-ROUTINE '))}
+    scans = []
+    for detail in plan:
+        # FTS5 lookups show up as 'SCAN x VIRTUAL TABLE INDEX ...'
+        if (detail.startswith('SCAN ') and ' USING ' not in detail and ' VIRTUAL TABLE INDEX ' not in detail
+                and detail != 'SCAN CONSTANT ROW'):
+            table = detail.split()[1]
+            if table not in intermediate and not table.startswith('(subquery-'):
+                scans.append(table)
+    return scans
+
+
+def seed(db):
+    """Populate the database with a little of everything"""
+    db.create_admin_if_not_exists()
+    user_id = db.add_user('planuser', 'hash', 'Plan User', 'plan@test.com', '1234567890')
+    customer_id = db.add_customer('CUS-00001', 'Plan Customer', '9876543210', 'Street')
+    items = [{
+        'metal': 'Gold 22K', 'weight': 2.0, 'rate': 6000.0,
+        'wastage_percent': 6.0, 'making_percent': 12.0, 'item_value': 12000.0,
+        'wastage_amount': 720.0, 'making_amount': 1440.0, 'line_total': 14160.0
+    }]
+    db.save_invoice(customer_id, 'PLAN-000001', items, 1.5, 1.5, 0)
+    invoice, _, _ = db.get_invoice_by_number('PLAN-000001')
+    return user_id, customer_id, int(invoice['id']), items
+
+
+def test_queries_use_indexes():
+    """Test that no Database query falls back to a full table scan"""
+    print("Testing Query Plans...")
+
+    cleanup_test_files()
+    db = Database(TEST_DB)
+    user_id, customer_id, invoice_id, items = seed(db)
+    json_export = db.export_invoices_json()
+    ndjson_export = db.export_invoices_ndjson()
+
+    calls = [
+        ('create_admin_if_not_exists', lambda: db.create_admin_if_not_exists()),
+        ('get_user_by_username', lambda: db.get_user_by_username('planuser')),
+        ('get_all_users', lambda: db.get_all_users()),
+        ('get_pending_users', lambda: db.get_pending_users()),
+        ('approve_user', lambda: db.approve_user(user_id, 1)),
+        ('update_user_role', lambda: db.update_user_role(user_id, 'user')),
+        ('update_user_password', lambda: db.update_user_password(user_id, 'hash2')),
+        ('update_user_profile', lambda: db.update_user_profile(user_id, email='p@test.com')),
+        ('create_password_reset_request', lambda: db.create_password_reset_request('', 'p@test.com', '1234567890')),
+        ('get_pending_password_reset_requests', lambda: db.get_pending_password_reset_requests()),
+        ('resolve_password_reset_request', lambda: db.resolve_password_reset_request(1, 1, 'hash3')),
+        ('reject_password_reset_request', lambda: db.reject_password_reset_request(1)),
+        ('get_customers', lambda: db.get_customers()),
+        ('get_customer_by_id', lambda: db.get_customer_by_id(customer_id)),
+        ('update_customer', lambda: db.update_customer(customer_id, 'CUS-00001', 'Plan C', '9876543210')),
+        ('get_invoices', lambda: db.get_invoices()),
+        ('get_invoices', lambda: db.get_invoices(limit=25, before=(10**11, 10**9))),
+        ('get_invoices', lambda: db.get_invoices(limit=25, search='Plan')),
+        ('get_invoices', lambda: db.get_invoices(limit=25, search='plan 3210', start_date='2000-01-01')),
+        ('iter_invoices', lambda: list(db.iter_invoices(limit=25, before=(10**11, 10**9)))),
+        ('get_invoice_by_number', lambda: db.get_invoice_by_number('PLAN-000001')),
+        ('get_invoice_by_id', lambda: db.get_invoice_by_id(invoice_id)),
+        ('get_invoice_details', lambda: db.get_invoice_details(invoice_nos=['PLAN-000001'])),
+        ('update_invoice', lambda: db.update_invoice(invoice_id, items, 1.5, 1.5, 5)),
+        ('duplicate_invoice', lambda: db.duplicate_invoice(invoice_id, 'PLAN-000002')),
+        ('get_sales_report', lambda: db.get_sales_report('2000-01-01', '2999-01-01')),
+        ('get_sales_report', lambda: db.get_sales_report('2000-01-01')),
+        ('get_sales_report', lambda: db.get_sales_report(None, '2999-01-01')),
+        ('get_sales_summary', lambda: db.get_sales_summary('2000-01-01', '2999-01-01')),
+        ('get_sales_summary', lambda: db.get_sales_summary(None, '2999-01-01')),
+        ('get_sales_by_period', lambda: db.get_sales_by_period('week', '2000-01-01', '2999-01-01')),
+        ('get_sales_by_period', lambda: db.get_sales_by_period('month', '2000-01-01')),
+        ('get_customer_purchase_analysis', lambda: db.get_customer_purchase_analysis()),
+        ('get_customer_purchase_analysis', lambda: db.get_customer_purchase_analysis(customer_id)),
+        ('get_top_customers', lambda: db.get_top_customers(10)),
+        ('search_customers', lambda: db.search_customers('')),
+        ('search_customers', lambda: db.search_customers('9876')),
+        ('get_category_report', lambda: db.get_category_report()),
+        ('get_category_report', lambda: db.get_category_report('2000-01', '2999-12')),
+        ('get_category_report', lambda: db.get_category_report('2000-01', '2999-12', exact=True)),
+        ('reprice_invoices', lambda: db.reprice_invoices({'Gold 22K': {'rate': 7000.0}}, '2024-01-01', '2999-01-01',
+                                                          metals=['Gold 22K'])),
+        ('get_board_rate_comparison', lambda: db.get_board_rate_comparison('2024-01', '2024-12')),
+        ('get_category_months', lambda: db.get_category_months()),
+        ('export_customers_csv', lambda: db.export_customers_csv()),
+        ('import_customers_csv', lambda: db.import_customers_csv(
+            'account_no,name,phone,address\n,New,9000000001,\nCUS-00001,Plan C,9876543210,\n', mode='upsert')),
+        ('export_invoices_json', lambda: db.export_invoices_json()),
+        ('export_invoices_ndjson', lambda: db.export_invoices_ndjson()),
+        ('import_invoices_json', lambda: db.import_invoices_json(json_export.replace('PLAN-', 'JSON-'))),
+        ('import_invoices_ndjson', lambda: db.import_invoices_ndjson(ndjson_export.replace('PLAN-', 'ND-').splitlines())),
+        ('save_setting', lambda: db.save_setting('plan', {'a': 1})),
+        ('get_setting', lambda: db.get_setting('plan')),
+        ('save_settings', lambda: db.save_settings({'plan': {'a': 2}, 'cgst': 1.5})),
+        ('get_settings', lambda: db.get_settings()),
+        ('delete_setting', lambda: db.delete_setting('plan')),
+        ('delete_invoice', lambda: db.delete_invoice(invoice_id)),
+        ('delete_customer', lambda: db.delete_customer(customer_id)),
+    ]
+
+    failures = []
+    with sqlite3.connect(TEST_DB) as plan_conn:
+        for name, call in calls:
+            statements = capture_statements(db, call)
+            assert statements, f"{name} should have issued SQL"
+            allowed = FULL_SCAN_ALLOWED.get(name, set())
+            for statement in statements:
+                for table in full_scans(plan_conn, statement):
+                    if table not in allowed:
+                        failures.append(f"{name}: full scan of {table} in: {' '.join(statement.split())}")
+            print(f"✓ {name}: {len(statements)} statement(s) checked")
+    plan_conn.close()
+
+    assert not failures, "Full table scans found:\n" + "\n".join(failures)
+
+    cleanup_test_files()
+    print("✅ Query plan tests passed!\n")
+
+
+def main():
+    """Run all tests"""
+    print("=" * 60)
+    print("JewelCalc Query Plan Test Suite")
+    print("=" * 60)
+    print()
+
+    try:
+        test_queries_use_indexes()
+
+        print("=" * 60)
+        print("✅ ALL TESTS PASSED!")
+        print("=" * 60)
+
+    except AssertionError as e:
+        print(f"\n❌ TEST FAILED: {e}")
+        sys.exit(1)
+    except Exception as e:
+        print(f"\n❌ ERROR: {e}")
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
+    finally:
+        cleanup_test_files()
+        print("\nTest files cleaned up.")
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,9 @@
 import random
 import string
 import re
+from decimal import Decimal, ROUND_HALF_UP
+import numpy as np
+import pandas as pd
 
 
 def format_currency(amount):
@@ -41,6 +44,12 @@ def validate_phone(phone):
     return phone.isdigit() and len(phone) == 10
 
 
+def validate_phones(phones):
+    """Vectorized validate_phone for a pandas Series of strings"""
+    phones = phones.astype(str)
+    return phones.str.isdigit() & (phones.str.len() == 10)
+
+
 def calculate_item_totals(weight, rate, wastage_percent, making_percent):
     """Calculate item totals"""
     item_value = float(weight) * float(rate)
@@ -54,3 +63,114 @@ def calculate_item_totals(weight, rate, wastage_percent, making_percent):
         'making_amount': making_amount,
         'line_total': line_total
     }
+
+
+def numeric_array(values):
+    """Float array of values; blanks, None, non-numeric text and NaN become 0"""
+    series = pd.Series(np.atleast_1d(np.asarray(values, dtype=object)), dtype=object)
+    return pd.to_numeric(series, errors='coerce').fillna(0.0).to_numpy(dtype=float)
+
+
+def calculate_item_totals_batch(weight, rate, wastage_percent, making_percent):
+    """Vectorized calculate_item_totals over equal-length array-likes.
+    Inputs go through numeric_array, and rows without a positive weight and rate
+    price at zero. Returns the same keys as calculate_item_totals, as float arrays."""
+    weight = numeric_array(weight)
+    rate = numeric_array(rate)
+    wastage_percent = numeric_array(wastage_percent)
+    making_percent = numeric_array(making_percent)
+    
+    # Same operation order as calculate_item_totals, so priced rows match it exactly
+    item_value = np.where((weight > 0) & (rate > 0), weight * rate, 0.0)
+    wastage_amount = item_value * wastage_percent / 100
+    making_amount = item_value * making_percent / 100
+    line_total = item_value + wastage_amount + making_amount
+    
+    return {
+        'item_value': item_value,
+        'wastage_amount': wastage_amount,
+        'making_amount': making_amount,
+        'line_total': line_total
+    }
+
+
+PAISE_PER_RUPEE = 100
+
+
+def _round_half_up(value):
+    """Round a Decimal to a whole number, halves away from zero"""
+    return int(value.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def to_paise(amount):
+    """Rupees (float, int, str or Decimal) to integer paise; blanks, None and NaN are 0"""
+    if amount is None or amount == '' or amount != amount:
+        return 0
+    return _round_half_up(Decimal(str(amount)) * PAISE_PER_RUPEE)
+
+
+def from_paise(paise):
+    """Integer paise to rupees"""
+    return paise / PAISE_PER_RUPEE
+
+
+def calculate_invoice_totals(line_totals, discount_percent, cgst_percent, sgst_percent):
+    """Invoice totals in integer paise.
+    Each line total is rounded to paise before summing; the discount and each tax are
+    rounded to the nearest paisa, and the total is exactly taxable + CGST + SGST."""
+    def percent_of(paise, percent):
+        return _round_half_up(Decimal(paise) * Decimal(str(percent or 0)) / 100)
+    
+    subtotal = sum(to_paise(line_total) for line_total in line_totals)
+    discount_amount = percent_of(subtotal, discount_percent)
+    taxable_amount = subtotal - discount_amount
+    cgst_amount = percent_of(taxable_amount, cgst_percent)
+    sgst_amount = percent_of(taxable_amount, sgst_percent)
+    
+    return {
+        'subtotal': subtotal,
+        'discount_amount': discount_amount,
+        'taxable_amount': taxable_amount,
+        'cgst_amount': cgst_amount,
+        'sgst_amount': sgst_amount,
+        'total': taxable_amount + cgst_amount + sgst_amount
+    }
+
+
+def _round_half_up_array(values):
+    """Round a float array to whole numbers, halves away from zero.
+    Values are first rounded to 6 decimals so float noise (1.005 * 100 = 100.49999...)
+    rounds like the decimal value it stands for, matching _round_half_up."""
+    values = np.round(values, 6)
+    return (np.sign(values) * np.floor(np.abs(values) + 0.5)).astype(np.int64)
+
+
+def paise_array(amounts):
+    """Vectorized to_paise: rupee amounts to an int64 paise array"""
+    return _round_half_up_array(numeric_array(amounts) * PAISE_PER_RUPEE)
+
+
+def calculate_invoice_totals_batch(line_invoice, line_totals, discount_percent, cgst_percent, sgst_percent):
+    """Vectorized calculate_invoice_totals for many invoices at once.
+    line_invoice holds each line's invoice position (0..n-1) in the per-invoice percent
+    arrays. Returns the same keys as calculate_invoice_totals, as int64 paise arrays."""
+    discount_percent = numeric_array(discount_percent)
+    
+    def percent_of(paise, percent):
+        return _round_half_up_array(paise * numeric_array(percent) / 100)
+    
+    subtotal = np.zeros(len(discount_percent), dtype=np.int64)
+    np.add.at(subtotal, np.asarray(line_invoice, dtype=np.int64), paise_array(line_totals))
+    discount_amount = percent_of(subtotal, discount_percent)
+    taxable_amount = subtotal - discount_amount
+    cgst_amount = percent_of(taxable_amount, cgst_percent)
+    sgst_amount = percent_of(taxable_amount, sgst_percent)
+    
+    return {
+        'subtotal': subtotal,
+        'discount_amount': discount_amount,
+        'taxable_amount': taxable_amount,
+        'cgst_amount': cgst_amount,
+        'sgst_amount': sgst_amount,
+        'total': taxable_amount + cgst_amount + sgst_amount
+    }